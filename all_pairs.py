@@ -0,0 +1,281 @@
+"""All-pairs user similarity, computed tile by tile on a process pool.
+
+The user x user similarity matrix is cut into square tiles. Each tile is
+computed from dense blocks of just its own users' ratings, so a worker's
+memory depends on the tile width rather than the number of users, and the
+width is picked to keep every worker together under a memory ceiling.
+
+Finished tiles are written to a directory as they come in, holding either
+the tile's similarities or just each user's top k within it. A rerun
+after a crash skips the tiles already on disk.
+"""
+
+import glob
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from correlation import pearson_from_stats_many
+from neighbors import NeighborIndex
+
+# Dense rating blocks are float32, which holds the integer sums exactly for
+# far more movies than any MovieLens release has
+BLOCK_DTYPE = np.float32
+
+
+def tile_width(num_movies, memory_limit, processes):
+    """Return the widest tile whose working set fits in memory_limit bytes.
+
+    Each of the processes holds six width x num_movies rating blocks
+    (scores, rated flags and squared scores for the tile's rows and for its
+    columns) and about ten width x width float arrays of sums and results.
+    """
+
+    budget = float(memory_limit) / processes
+    block = 6 * num_movies * np.dtype(BLOCK_DTYPE).itemsize
+    result = 10 * 8
+
+    width = (-block + np.sqrt(block * block + 4 * result * budget)) / (2 * result)
+    return max(int(width), 1)
+
+
+class AllPairs(object):
+    """Tiled all-pairs similarity over a RatingsMatrix, saved to directory.
+
+    With k, each tile keeps only every user's k most similar users within
+    it, and neighbor_index() merges those into a NeighborIndex. Without k,
+    tiles hold their full similarity blocks. width, if given, overrides
+    the tile width memory_limit allows.
+    """
+
+    def __init__(self, matrix, directory, k=None, memory_limit=2 ** 30,
+                 processes=None, width=None):
+        self.matrix = matrix
+        self.directory = directory
+        self.k = k
+        self.processes = processes or multiprocessing.cpu_count()
+        self.width = width or tile_width(len(matrix.movie_ids), memory_limit,
+                                         self.processes)
+
+        num_users = len(matrix.user_ids)
+        starts = range(0, num_users, self.width)
+        self.tiles = [(a, b) for n, a in enumerate(starts) for b in starts[n:]]
+
+    def run(self):
+        """Compute every tile that isn't already on disk.
+
+        Returns how many tiles were computed.
+        """
+
+        self._prepare()
+
+        pending = [tile for tile in self.tiles
+                   if not os.path.exists(self._path(tile))]
+
+        global _all_pairs
+        _all_pairs = self
+        started = time.time()
+
+        # Workers are forked after _all_pairs is set, so they share the
+        # matrix rather than each getting a pickled copy
+        pool = multiprocessing.Pool(self.processes) if self.processes > 1 else None
+
+        try:
+            tiles = (pool.imap_unordered(_compute_tile, pending) if pool
+                     else (_compute_tile(tile) for tile in pending))
+
+            for done, tile in enumerate(tiles, 1):
+                elapsed = max(time.time() - started, 1e-6)
+                print "  Tiles: %d/%d, %.1f tiles/sec" % (
+                    done, len(pending), done / elapsed)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+            _all_pairs = None
+
+        return len(pending)
+
+    def _prepare(self):
+        """Create the directory, clearing out tiles from a different run."""
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        manifest = {'fingerprint': self.matrix.fingerprint(),
+                    'users': len(self.matrix.user_ids),
+                    'width': self.width,
+                    'k': self.k}
+        path = os.path.join(self.directory, 'manifest.json')
+
+        try:
+            with open(path) as f:
+                current = json.load(f) == manifest
+        except (IOError, ValueError):
+            current = False
+
+        if not current:
+            for stale in glob.glob(os.path.join(self.directory, 'tile-*.npz')):
+                os.remove(stale)
+
+            with open(path + '.tmp', 'w') as f:
+                json.dump(manifest, f)
+            os.rename(path + '.tmp', path)
+
+    def _path(self, tile):
+        return os.path.join(self.directory, 'tile-%d-%d.npz' % tile)
+
+    def _end(self, start):
+        return min(start + self.width, len(self.matrix.user_ids))
+
+    def compute_tile(self, tile):
+        """Compute one tile and write it to disk."""
+
+        a, b = tile
+        sims = self.tile_similarities(a, b)
+
+        if self.k is None:
+            arrays = {'sims': sims}
+        else:
+            if a == b:
+                np.fill_diagonal(sims, -np.inf)
+
+            arrays = {}
+            arrays['row_indexes'], arrays['row_sims'] = _top_k(sims, self.k)
+            arrays['row_indexes'] += b
+
+            if a != b:
+                arrays['col_indexes'], arrays['col_sims'] = _top_k(sims.T,
+                                                                   self.k)
+                arrays['col_indexes'] += a
+
+        # Write under a temporary name so a crash never leaves half a tile
+        path = self._path(tile)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(path + '.tmp', path)
+
+    def tile_similarities(self, a, b):
+        """Return the similarities between users a:a+width and b:b+width."""
+
+        scores_a, rated_a = self.matrix.dense_rows(a, self._end(a), BLOCK_DTYPE)
+        scores_b, rated_b = self.matrix.dense_rows(b, self._end(b), BLOCK_DTYPE)
+        rated_b = rated_b.T
+        scores_b = scores_b.T
+
+        def dot(x, y):
+            return x.dot(y).astype(float)
+
+        return pearson_from_stats_many(dot(rated_a, rated_b),
+                                       dot(scores_a, rated_b),
+                                       dot(rated_a, scores_b),
+                                       dot(scores_a * scores_a, rated_b),
+                                       dot(rated_a, scores_b * scores_b),
+                                       dot(scores_a, scores_b))
+
+    def similarities(self):
+        """Return the full user x user similarity matrix from the tiles."""
+
+        num_users = len(self.matrix.user_ids)
+        sims = np.empty((num_users, num_users))
+
+        for a, b in self.tiles:
+            block = np.load(self._path((a, b)))['sims']
+            sims[a:self._end(a), b:self._end(b)] = block
+            sims[b:self._end(b), a:self._end(a)] = block.T
+
+        return sims
+
+    def neighbor_index(self, engine):
+        """Merge the tiles' top k into a NeighborIndex for engine."""
+
+        width = max(min(self.k, len(engine.user_ids) - 1), 0)
+
+        pieces = dict((a, []) for a, b in self.tiles if a == b)
+        for a, b in self.tiles:
+            saved = np.load(self._path((a, b)))
+            pieces[a].append((saved['row_indexes'], saved['row_sims']))
+            if a != b:
+                pieces[b].append((saved['col_indexes'], saved['col_sims']))
+
+        indexes = np.empty((len(engine.user_ids), width), dtype=int)
+        sims = np.empty(indexes.shape)
+
+        for a in sorted(pieces):
+            candidates = np.hstack([piece[0] for piece in pieces[a]])
+            candidate_sims = np.hstack([piece[1] for piece in pieces[a]])
+            top, top_sims = _top_k(candidate_sims, width)
+            rows = np.arange(len(top))[:, np.newaxis]
+
+            indexes[a:self._end(a)] = candidates[rows, top]
+            sims[a:self._end(a)] = top_sims
+
+        return NeighborIndex(engine, self.k, indexes=indexes, sims=sims)
+
+
+def _top_k(sims, k):
+    """Return (columns, values) of the k largest entries in each row."""
+
+    width = min(k, sims.shape[1])
+    rows = np.arange(len(sims))[:, np.newaxis]
+
+    if width == 0:
+        return np.empty((len(sims), 0), dtype=int), np.empty((len(sims), 0))
+
+    top = np.argpartition(-sims, width - 1, axis=1)[:, :width]
+    return top, sims[rows, top]
+
+
+_all_pairs = None
+
+
+def _compute_tile(tile):
+    """Pool entry point: compute one tile of the builder being run."""
+
+    _all_pairs.compute_tile(tile)
+    return tile
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--processes', type=int, default=None,
+                        help="worker processes (default: one per CPU); set "
+                             "OPENBLAS_NUM_THREADS=1 so they don't contend "
+                             "for cores")
+    parser.add_argument('--memory-mb', type=int, default=None,
+                        help="memory ceiling for all workers together")
+    parser.add_argument('--all', action='store_true',
+                        help="keep every similarity rather than saving the "
+                             "top-k neighbor index")
+    args = parser.parse_args()
+
+    from server import app
+    from model import connect_to_db, get_similarity_engine
+
+    connect_to_db(app)
+    app.config['SQLALCHEMY_ECHO'] = False
+
+    with app.app_context():
+        engine = get_similarity_engine()
+
+    memory_mb = args.memory_mb or app.config['ALL_PAIRS_MEMORY_MB']
+    k = None if args.all else app.config['NEIGHBOR_COUNT']
+    all_pairs = AllPairs(engine.matrix, app.config['ALL_PAIRS_DIR'], k,
+                         memory_mb * 2 ** 20, args.processes)
+
+    print "%d users in %d tiles of %d, %d processes" % (
+        len(engine.user_ids), len(all_pairs.tiles), all_pairs.width,
+        all_pairs.processes)
+
+    started = time.time()
+    all_pairs.run()
+    print "Computed in %.1fs" % (time.time() - started)
+
+    if k is not None:
+        all_pairs.neighbor_index(engine).save(app.config['NEIGHBOR_INDEX_PATH'])
+        print "Saved neighbors to %s" % app.config['NEIGHBOR_INDEX_PATH']
@@ -0,0 +1,13 @@
+"""Benchmarks on synthetic MovieLens-scale data.
+
+    python -m benchmarks.generate 1m benchmarks/data/1m
+    python -m benchmarks.run benchmarks/data/1m --output before.json
+    (change something)
+    python -m benchmarks.run benchmarks/data/1m --output after.json
+    python -m benchmarks.compare before.json after.json
+
+    python -m benchmarks.scaling benchmarks/data/1m --processes 1 2 4 8
+    python -m benchmarks.rating_writes postgresql:///ratings_bench
+
+Run these from the project root, so the app's modules can be imported.
+"""
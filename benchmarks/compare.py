@@ -0,0 +1,116 @@
+"""Compare two benchmark runs and flag regressions.
+
+    python -m benchmarks.compare before.json after.json
+
+Each benchmark's median (or --statistic) is compared. One that got
+slower by more than --threshold (a fraction) and by more than
+--min-difference seconds, so tiny timings don't flag on noise, is a
+regression, and the command exits with status 1.
+
+Timings on a busy or shared machine can drift by tens of percent between
+otherwise identical runs, so compare runs made back to back on a quiet
+machine, or raise --threshold.
+"""
+
+import json
+
+
+def compare(old, new, threshold=0.25, min_difference=0.0001,
+            statistic='median'):
+    """Return (name, old time, new time, ratio, verdict) per benchmark.
+
+    Times are the given statistic of each benchmark's samples. verdict is
+    'regression', 'improvement', 'same', 'added' or 'removed'. old and
+    new are results as written by benchmarks.run.
+    """
+
+    old_results, new_results = old['results'], new['results']
+    rows = []
+
+    for name in sorted(set(old_results) | set(new_results)):
+        if name not in old_results:
+            rows.append((name, None, new_results[name][statistic], None,
+                         'added'))
+            continue
+
+        if name not in new_results:
+            rows.append((name, old_results[name][statistic], None, None,
+                         'removed'))
+            continue
+
+        before = old_results[name][statistic]
+        after = new_results[name][statistic]
+        ratio = after / before if before else float('inf')
+
+        if abs(after - before) <= min_difference:
+            verdict = 'same'
+        elif ratio > 1 + threshold:
+            verdict = 'regression'
+        elif ratio < 1 / (1 + threshold):
+            verdict = 'improvement'
+        else:
+            verdict = 'same'
+
+        rows.append((name, before, after, ratio, verdict))
+
+    return rows
+
+
+def warnings(old, new):
+    """Return reasons the two runs may not be comparable."""
+
+    found = []
+
+    for key in ['ratings', 'users', 'movies', 'database', 'neighbor_count',
+                'neighbor_search', 'python', 'numpy']:
+        if old['meta'].get(key) != new['meta'].get(key):
+            found.append("%s differs: %s vs %s" % (key, old['meta'].get(key),
+                                                   new['meta'].get(key)))
+
+    return found
+
+
+def _milliseconds(seconds):
+    return "%12.3f" % (seconds * 1000) if seconds is not None else " " * 12
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="slowdown, as a fraction, that counts as a "
+                             "regression (default: 0.25)")
+    parser.add_argument('--min-difference', type=float, default=0.0001,
+                        help="seconds a time must move by to count "
+                             "(default: 0.0001)")
+    parser.add_argument('--statistic', default='median',
+                        choices=['median', 'min', 'mean', 'p95'])
+    args = parser.parse_args()
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    for warning in warnings(old, new):
+        print "Warning: %s" % warning
+
+    rows = compare(old, new, args.threshold, args.min_difference,
+                   args.statistic)
+
+    print "%-28s %12s %12s %7s  %s" % ("benchmark", "old ms", "new ms",
+                                       "ratio", "")
+    for name, before, after, ratio, verdict in rows:
+        print "%-28s %s %s %7s  %s" % (
+            name, _milliseconds(before), _milliseconds(after),
+            "%.2fx" % ratio if ratio is not None else "",
+            verdict.upper() if verdict == 'regression' else verdict)
+
+    regressions = [row for row in rows if row[4] == 'regression']
+    if regressions:
+        print "%d regression(s)" % len(regressions)
+        sys.exit(1)
@@ -0,0 +1,221 @@
+"""Generate synthetic ratings in the MovieLens 100k file format.
+
+Writes u.user, u.item and u.data, which seed.py loads like the real
+thing, at the size of a MovieLens release or any other. Movie popularity
+and user activity follow power laws, as they do in MovieLens: a few
+blockbusters and heavy raters account for much of the data. Scores come
+from user and movie biases plus a few latent taste factors, so users who
+agree on some movies tend to agree on others and similarity means
+something.
+"""
+
+import os
+
+import numpy as np
+
+# (ratings, users, movies) of each MovieLens release
+SCALES = {'100k': (100000, 943, 1682),
+          '1m': (1000000, 6040, 3706),
+          '10m': (10000000, 69878, 10677)}
+
+# Every MovieLens user has rated at least this many movies
+MIN_RATINGS = 20
+
+# MovieLens timestamps run from September 1997 to April 1998 (100k)
+FIRST_TIMESTAMP = 874724710
+LAST_TIMESTAMP = 893286638
+
+OCCUPATIONS = ['administrator', 'artist', 'educator', 'engineer',
+               'entertainment', 'executive', 'healthcare', 'homemaker',
+               'lawyer', 'librarian', 'marketing', 'none', 'other',
+               'programmer', 'retired', 'salesman', 'scientist', 'student',
+               'technician', 'writer']
+
+GENRES = 19
+
+
+def power_law(count, exponent, rand):
+    """Return weights summing to 1 that fall off as rank ** -exponent.
+
+    Ranks are shuffled, so the heaviest weight isn't always the first.
+    """
+
+    weights = np.arange(1, count + 1, dtype=float) ** -exponent
+    rand.shuffle(weights)
+    return weights / weights.sum()
+
+
+def user_activity(num_users, num_ratings, num_movies, exponent, rand):
+    """Return how many movies each user rates, about num_ratings in all."""
+
+    least = min(MIN_RATINGS, num_movies)
+    extra = max(num_ratings - least * num_users, 0)
+    weights = power_law(num_users, exponent, rand)
+
+    # Nobody rates every movie; past half of them, unpopular movies are
+    # too rare to draw
+    most = max(num_movies // 2, least)
+    counts = np.minimum(least + np.floor(weights * extra).astype(int), most)
+
+    # Hand what the capped users couldn't take to everyone else
+    for _ in range(10):
+        short = num_ratings - counts.sum()
+        room = counts < most
+        if short <= 0 or not room.any():
+            break
+
+        more = np.zeros(num_users, dtype=int)
+        more[room] = np.floor(weights[room] / weights[room].sum() * short)
+        leftover = short - more.sum()
+        more[np.argsort(-weights * room)[:leftover]] += 1
+
+        counts = np.minimum(counts + more, most)
+
+    return counts
+
+
+def sample_pairs(counts, popularity, rand, rounds=20):
+    """Return (users, movies): counts[u] distinct movies for each user u.
+
+    Movies are drawn by popularity. Draws are made with replacement, for
+    everyone at once, and repeated for whoever still falls short after
+    duplicates are dropped. A user can end up short if the rounds run out.
+    """
+
+    num_users, num_movies = len(counts), len(popularity)
+    keys = np.array([], dtype=np.int64)
+    needed = counts.copy()
+
+    for _ in range(rounds):
+        if not needed.any():
+            break
+
+        # Overdraw a little, since some draws repeat movies
+        draws = np.ceil(needed * 1.2).astype(int) + (needed > 0)
+        users = np.repeat(np.arange(num_users, dtype=np.int64), draws)
+        movies = rand.choice(num_movies, size=len(users), p=popularity)
+
+        keys = np.concatenate([keys, users * num_movies + movies])
+        first = np.sort(np.unique(keys, return_index=True)[1])
+        keys = keys[first]
+
+        # Keep each user's first counts[u] movies
+        users = keys // num_movies
+        order = np.argsort(users, kind='mergesort')
+        have = np.bincount(users, minlength=num_users)
+        starts = np.cumsum(have) - have
+        ranks = np.empty(len(keys), dtype=int)
+        ranks[order] = np.arange(len(keys)) - np.repeat(starts, have)
+        keys = keys[ranks < counts[users]]
+
+        needed = counts - np.bincount(keys // num_movies, minlength=num_users)
+
+    keys.sort()
+    return keys // num_movies, keys % num_movies
+
+
+def scores_for(users, movies, popularity, rand, factors=5,
+               chunk_size=1000000):
+    """Return a 1-5 score for each (user, movie) pair.
+
+    A score is a global mean, plus the user's and movie's biases, plus
+    the dot product of their taste factors, plus noise. Popular movies
+    get a slightly higher bias, as they do in MovieLens.
+    """
+
+    num_users, num_movies = users.max() + 1, len(popularity)
+
+    user_bias = rand.normal(0, 0.45, num_users)
+    movie_bias = rand.normal(0, 0.5, num_movies)
+    log_popularity = np.log(popularity)
+    movie_bias += 0.15 * (log_popularity - log_popularity.mean())
+    user_factors = rand.normal(0, 0.45, (num_users, factors))
+    movie_factors = rand.normal(0, 0.45, (num_movies, factors))
+
+    scores = np.empty(len(users), dtype=np.int8)
+
+    for start in range(0, len(users), chunk_size):
+        u = users[start:start + chunk_size]
+        m = movies[start:start + chunk_size]
+        raw = (3.5 + user_bias[u] + movie_bias[m] +
+               (user_factors[u] * movie_factors[m]).sum(axis=1) +
+               rand.normal(0, 0.95, len(u)))
+        scores[start:start + chunk_size] = np.clip(np.rint(raw), 1, 5)
+
+    return scores
+
+
+def generate(directory, num_ratings, num_users, num_movies,
+             popularity_exponent=0.5, activity_exponent=0.5, seed=0):
+    """Write u.user, u.item and u.data to directory.
+
+    Returns a summary: how many ratings, users and movies were written,
+    and the share of ratings that went to the top 1% of movies.
+    """
+
+    rand = np.random.RandomState(seed)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    popularity = power_law(num_movies, popularity_exponent, rand)
+    counts = user_activity(num_users, num_ratings, num_movies,
+                           activity_exponent, rand)
+    users, movies = sample_pairs(counts, popularity, rand)
+    scores = scores_for(users, movies, popularity, rand)
+    timestamps = rand.randint(FIRST_TIMESTAMP, LAST_TIMESTAMP, len(users))
+
+    with open(os.path.join(directory, 'u.user'), 'w') as f:
+        for user_id in range(1, num_users + 1):
+            f.write("%d|%d|%s|%s|%05d\n" % (
+                user_id, rand.randint(7, 74), 'MF'[rand.randint(2)],
+                OCCUPATIONS[rand.randint(len(OCCUPATIONS))],
+                rand.randint(100000)))
+
+    with open(os.path.join(directory, 'u.item'), 'w') as f:
+        for movie_id in range(1, num_movies + 1):
+            year = rand.randint(1920, 1999)
+            f.write("%d|Synthetic Movie %d (%d)|01-Jan-%d||"
+                    "http://example.com/movies/%d|%s\n" % (
+                        movie_id, movie_id, year, year, movie_id,
+                        '|'.join('0' * GENRES)))
+
+    np.savetxt(os.path.join(directory, 'u.data'),
+               np.column_stack([users + 1, movies + 1, scores, timestamps]),
+               fmt='%d', delimiter='\t')
+
+    top = np.sort(np.bincount(movies, minlength=num_movies))[::-1]
+    return {'ratings': len(users), 'users': num_users, 'movies': num_movies,
+            'top_1_percent_share':
+                float(top[:max(num_movies // 100, 1)].sum()) / len(users)}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('scale', choices=sorted(SCALES) + ['custom'])
+    parser.add_argument('directory')
+    parser.add_argument('--ratings', type=int, help="with 'custom'")
+    parser.add_argument('--users', type=int, help="with 'custom'")
+    parser.add_argument('--movies', type=int, help="with 'custom'")
+    parser.add_argument('--popularity-exponent', type=float, default=0.5)
+    parser.add_argument('--activity-exponent', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.scale == 'custom':
+        if not (args.ratings and args.users and args.movies):
+            parser.error("'custom' needs --ratings, --users and --movies")
+        num_ratings, num_users, num_movies = args.ratings, args.users, \
+            args.movies
+    else:
+        num_ratings, num_users, num_movies = SCALES[args.scale]
+
+    summary = generate(args.directory, num_ratings, num_users, num_movies,
+                       args.popularity_exponent, args.activity_exponent,
+                       args.seed)
+    print ("Wrote %(ratings)d ratings by %(users)d users of %(movies)d "
+           "movies; the top 1%% of movies have %(top_1_percent_share).0f%% "
+           "of ratings" % dict(summary, top_1_percent_share=100 *
+                               summary['top_1_percent_share']))
@@ -0,0 +1,127 @@
+"""Benchmark rating writes and lookups with and without the rating indexes.
+
+"Before" is the old schema and write path: no (user_id, movie_id) or
+users.email index, and each write SELECTs the rating then updates or
+inserts it. "After" has both indexes and writes with one upsert.
+
+This loads MovieLens from --data-dir (a release, or the output of
+benchmarks.generate) into the database given, so point it at a scratch
+PostgreSQL database:
+
+    createdb ratings_bench
+    python -m benchmarks.rating_writes postgresql:///ratings_bench
+"""
+
+import random
+import time
+
+from model import connect_to_db, db, Rating, User, upsert_ratings
+from server import app
+import seed
+
+
+def timed(function, args_list):
+    """Return per-call latencies in milliseconds, sorted."""
+
+    latencies = []
+    for args in args_list:
+        started = time.time()
+        function(*args)
+        latencies.append((time.time() - started) * 1000)
+
+    return sorted(latencies)
+
+
+def read_then_write(user_id, movie_id, score):
+    """The old write path: look the rating up, then update or insert it."""
+
+    rating = Rating.query.filter_by(movie_id=movie_id, user_id=user_id).first()
+    if rating:
+        rating.score = score
+    else:
+        db.session.add(Rating(movie_id=movie_id, user_id=user_id, score=score))
+    db.session.commit()
+
+
+def upsert(user_id, movie_id, score):
+    upsert_ratings(user_id, {movie_id: score})
+    db.session.commit()
+
+
+def rating_lookup(user_id, movie_id):
+    Rating.query.filter_by(movie_id=movie_id, user_id=user_id).first()
+
+
+def email_lookup(email):
+    User.query.filter_by(email=email).first()
+
+
+def report(label, latencies):
+    print "  %-15s median %.3f ms  p95 %.3f ms" % (
+        label, latencies[len(latencies) // 2],
+        latencies[int(len(latencies) * 0.95)])
+
+
+def set_indexes(present):
+    """Create or drop the indexes under test."""
+
+    connection = db.session.connection()
+    indexes = Rating.__table__.indexes | User.__table__.indexes
+
+    for index in indexes:
+        if index.name in ('ix_ratings_user_id_movie_id', 'ix_users_email'):
+            if present:
+                index.create(bind=connection)
+            else:
+                index.drop(bind=connection)
+
+    db.session.commit()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('db_uri')
+    parser.add_argument('--data-dir', default='seed_data')
+    parser.add_argument('--samples', type=int, default=2000)
+    args = parser.parse_args()
+
+    connect_to_db(app, args.db_uri)
+    app.config['SQLALCHEMY_ECHO'] = False
+
+    db.drop_all()
+    db.create_all()
+
+    data_format = seed.find_format(args.data_dir)
+    seed.load_users(args.data_dir, data_format, 10000)
+    seed.load_movies(args.data_dir, data_format, 10000)
+    seed.load_ratings(args.data_dir, data_format, 10000)
+
+    user_ids = [user_id for user_id, in db.session.query(User.user_id)]
+    movie_ids = [movie_id for movie_id, in db.session.query(Rating.movie_id)
+                 .distinct()]
+    db.session.execute("UPDATE users SET email = 'user' || user_id || "
+                       "'@example.com'")
+    db.session.commit()
+
+    rand = random.Random(0)
+
+    for label, present, write in [("Before", False, read_then_write),
+                                  ("After", True, upsert)]:
+        # Fresh pairs for each run, so both see the same mix of new and
+        # existing ratings
+        writes = [(rand.choice(user_ids), rand.choice(movie_ids),
+                   rand.randint(1, 5)) for _ in range(args.samples)]
+        lookups = [(user_id, movie_id) for user_id, movie_id, score in writes]
+        emails = [("user%d@example.com" % rand.choice(user_ids),)
+                  for _ in range(args.samples)]
+
+        set_indexes(present)
+        db.session.execute("ANALYZE")
+        db.session.commit()
+
+        print label
+        report("write", timed(write, writes))
+        report("rating lookup", timed(rating_lookup, lookups))
+        report("email lookup", timed(email_lookup, emails))
@@ -0,0 +1,235 @@
+"""Time loading, similarity and prediction on a MovieLens-format data set.
+
+Loads the data set into a scratch database with seed.py, then times
+each of these over a random sample:
+- Pearson similarity: correlation.pearson over co-rated pairs, and
+  User.similarity, with caches emptied first
+- User.get_predicted_rating
+- the eye's opinion
+- the /movies/<id> page, through the Flask test client
+
+The results, with each one's median and 95th percentile, are written as
+JSON for benchmarks.compare.
+
+The database is dropped and recreated, so only point --db-uri at one you
+don't mind losing. By default a temporary SQLite file is used.
+"""
+
+import datetime
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+import cache
+import correlation
+import eye
+import model
+import seed
+from model import connect_to_db, db, User, Movie
+from server import app, get_eye_rating
+
+# Bumped when results are laid out differently
+FORMAT_VERSION = 1
+
+
+def summarize(seconds):
+    """Return the sample count and timing statistics of a list of durations."""
+
+    seconds = np.asarray(seconds, dtype=float)
+
+    return {'samples': len(seconds),
+            'min': float(seconds.min()),
+            'median': float(np.median(seconds)),
+            'mean': float(seconds.mean()),
+            'p95': float(np.percentile(seconds, 95)),
+            'total': float(seconds.sum())}
+
+
+def timed(function, args_list, before=None):
+    """Return summarized durations of function(*args) for each args.
+
+    before, if given, runs untimed ahead of each call.
+    """
+
+    seconds = []
+
+    for args in args_list:
+        if before is not None:
+            before()
+
+        started = time.time()
+        function(*args)
+        seconds.append(time.time() - started)
+
+    return summarize(seconds)
+
+
+def git_commit():
+    """Return the checked-out commit, or None outside a git work tree."""
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(data_dir, db_uri, samples=200, seed_value=0, neighbor_count=50,
+        neighbor_search='exact'):
+    """Run every benchmark and return the results, ready to dump as JSON."""
+
+    app.config['NEIGHBOR_COUNT'] = neighbor_count
+    app.config['NEIGHBOR_SEARCH'] = neighbor_search
+    app.config['NEIGHBOR_INDEX_PATH'] = os.path.join(tempfile.gettempdir(),
+                                                     'benchmark-neighbors.npz')
+    app.config['EYE_JUDGMENT_PATH'] = os.path.join(tempfile.gettempdir(),
+                                                   'benchmark-eye.npz')
+    app.config['SQLALCHEMY_ECHO'] = False
+    connect_to_db(app, db_uri)
+
+    rand = np.random.RandomState(seed_value)
+    results = {}
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        data_format = seed.find_format(data_dir)
+        for name, load in [('seed.load_users', seed.load_users),
+                           ('seed.load_movies', seed.load_movies),
+                           ('seed.load_ratings', seed.load_ratings)]:
+            results[name] = timed(load, [(data_dir, data_format, 10000)])
+
+        # The eye of judgment is whoever rated first
+        first_user = User.query.order_by(User.user_id).first()
+        first_user.email = eye.EYE_EMAIL
+        db.session.commit()
+        eye._eye = None
+        model.reload_ratings()
+
+        def warm_up():
+            model.get_similarity_engine()
+            model.get_neighbor_index()
+
+        results['warm_up'] = timed(warm_up, [()])
+
+        engine = model.get_similarity_engine()
+        matrix = engine.matrix
+        user_ids = rand.choice(engine.user_ids, (samples, 2)).tolist()
+        movie_ids = rand.choice(engine.movie_ids, samples).tolist()
+
+        pairs = []
+        for user_id, other_user_id in user_ids:
+            mine, theirs = matrix.co_rated(engine.user_index[user_id],
+                                           engine.user_index[other_user_id])
+            pairs.append((zip(mine.tolist(), theirs.tolist()),))
+
+        results['correlation.pearson'] = timed(correlation.pearson, pairs)
+
+        users = dict((user.user_id, user) for user in User.query.filter(
+            User.user_id.in_(set(sum(user_ids, [])))))
+        results['User.similarity'] = timed(
+            lambda user_id, other_user_id:
+                users[user_id].similarity(users[other_user_id]),
+            user_ids, before=cache.reset)
+
+        results['User.get_predicted_rating'] = timed(
+            lambda user_id, movie_id:
+                users[user_id].get_predicted_rating(movie_id),
+            zip([user_id for user_id, other in user_ids], movie_ids),
+            before=cache.reset)
+
+        movies = dict((movie.movie_id, movie) for movie in
+                      Movie.query.filter(Movie.movie_id.in_(set(movie_ids))))
+        results['get_eye_rating (first)'] = timed(
+            get_eye_rating, [(movies[movie_ids[0]],)])
+        results['get_eye_rating'] = timed(
+            get_eye_rating, [(movies[movie_id],) for movie_id in movie_ids])
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = user_ids[0][0]
+            session['email'] = "user%d" % user_ids[0][0]
+
+        def get_movie_page(movie_id):
+            response = client.get('/movies/%d' % movie_id)
+            assert response.status_code == 200, response.status
+
+        results['/movies/<id>'] = timed(get_movie_page,
+                                        [(movie_id,) for movie_id in movie_ids])
+
+        meta = {'format_version': FORMAT_VERSION,
+                'created_at': datetime.datetime.now().isoformat(),
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'data_dir': data_dir,
+                'database': db.engine.name,
+                'ratings': int(matrix.nnz),
+                'users': len(engine.user_ids),
+                'movies': len(engine.movie_ids),
+                'samples': samples,
+                'neighbor_count': neighbor_count,
+                'neighbor_search': neighbor_search}
+
+    return {'meta': meta, 'results': results}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('data_dir', help="a MovieLens release, or the output "
+                                         "of benchmarks.generate")
+    parser.add_argument('--output', help="where to write the JSON results "
+                                         "(default: benchmarks/results/"
+                                         "<time>.json)")
+    parser.add_argument('--db-uri', help="a scratch database, which is "
+                                         "dropped and recreated (default: a "
+                                         "temporary SQLite file)")
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--neighbor-count', type=int, default=50,
+                        help="0 to predict from every rater")
+    parser.add_argument('--neighbor-search', choices=['exact', 'lsh'],
+                        default='exact',
+                        help="'lsh' avoids the all-pairs build on large "
+                             "data sets")
+    args = parser.parse_args()
+
+    db_file = None
+    db_uri = args.db_uri
+    if db_uri is None:
+        handle, db_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        db_uri = 'sqlite:///' + db_file
+
+    try:
+        report = run(args.data_dir, db_uri, args.samples, args.seed,
+                     args.neighbor_count or None, args.neighbor_search)
+    finally:
+        if db_file is not None:
+            os.remove(db_file)
+
+    output = args.output or os.path.join(
+        'benchmarks', 'results',
+        datetime.datetime.now().strftime('%Y%m%d-%H%M%S.json'))
+    if os.path.dirname(output) and not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    print
+    print "%-28s %8s %12s %12s" % ("benchmark", "samples", "median ms",
+                                   "p95 ms")
+    for name, result in sorted(report['results'].items()):
+        print "%-28s %8d %12.3f %12.3f" % (name, result['samples'],
+                                           result['median'] * 1000,
+                                           result['p95'] * 1000)
+    print "Wrote %s" % output
@@ -0,0 +1,125 @@
+"""Time the tiled all-pairs build at several process counts.
+
+    OPENBLAS_NUM_THREADS=1 python -m benchmarks.scaling benchmarks/data/1m
+
+Process counts are given with --processes (1, 2, 4 and 8 by default).
+Every run computes the same tiles, at the width the memory ceiling allows
+the largest process count, into a fresh directory. Each count's time is
+reported with its speedup over the first count and its efficiency (speedup
+per process), which stays near 1 while the build scales linearly. Speedup
+can't exceed the machine's cores, so compare counts up to that.
+"""
+
+import datetime
+import multiprocessing
+import platform
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import seed
+from all_pairs import AllPairs, tile_width
+from ratings_matrix import RatingsMatrix
+
+# Bumped when results are laid out differently
+FORMAT_VERSION = 1
+
+
+def load_matrix(data_dir):
+    """Read a MovieLens release's ratings straight into a RatingsMatrix."""
+
+    data_format = seed.find_format(data_dir)
+    rows = [(int(fields[0]), int(fields[1]), seed.parse_score(fields[2]))
+            for fields in seed.read_rows(data_dir, data_format, 'ratings')]
+
+    return RatingsMatrix.from_rows(rows)
+
+
+def scaling(matrix, process_counts, k=50, memory_limit=2 ** 30, repeat=1):
+    """Return (processes, seconds, speedup, efficiency) per process count.
+
+    seconds is the best of repeat runs. Speedup is against the first
+    count, and efficiency is speedup per process relative to it.
+    """
+
+    width = tile_width(len(matrix.movie_ids), memory_limit,
+                       max(process_counts))
+    rows = []
+
+    for processes in process_counts:
+        best = None
+
+        for _ in range(repeat):
+            directory = tempfile.mkdtemp()
+            try:
+                all_pairs = AllPairs(matrix, directory, k, memory_limit,
+                                     processes, width)
+                started = time.time()
+                all_pairs.run()
+                seconds = time.time() - started
+            finally:
+                shutil.rmtree(directory)
+
+            best = seconds if best is None else min(best, seconds)
+
+        rows.append((processes, best))
+
+    base_processes, base_seconds = rows[0]
+
+    return [(processes, seconds, base_seconds / seconds,
+             base_seconds / seconds * base_processes / processes)
+            for processes, seconds in rows]
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('data_dir', help="a MovieLens release, or the output "
+                                         "of benchmarks.generate")
+    parser.add_argument('--processes', type=int, nargs='+',
+                        default=[1, 2, 4, 8])
+    parser.add_argument('--neighbor-count', type=int, default=50,
+                        help="k of the top-k tiles; 0 keeps every "
+                             "similarity")
+    parser.add_argument('--memory-mb', type=int, default=1024,
+                        help="memory ceiling for all workers together")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="runs per process count; the best is kept")
+    parser.add_argument('--output', help="also write the results as JSON")
+    args = parser.parse_args()
+
+    matrix = load_matrix(args.data_dir)
+    rows = scaling(matrix, args.processes, args.neighbor_count or None,
+                   args.memory_mb * 2 ** 20, args.repeat)
+
+    print
+    print "%d users, %d movies, %d ratings; %d CPUs" % (
+        len(matrix.user_ids), len(matrix.movie_ids), matrix.nnz,
+        multiprocessing.cpu_count())
+    print "%9s %10s %8s %10s" % ("processes", "seconds", "speedup",
+                                 "efficiency")
+    for processes, seconds, speedup, efficiency in rows:
+        print "%9d %10.2f %7.2fx %10.2f" % (processes, seconds, speedup,
+                                            efficiency)
+
+    if args.output:
+        report = {'meta': {'format_version': FORMAT_VERSION,
+                           'created_at': datetime.datetime.now().isoformat(),
+                           'data_dir': args.data_dir,
+                           'ratings': matrix.nnz,
+                           'users': len(matrix.user_ids),
+                           'movies': len(matrix.movie_ids),
+                           'cpus': multiprocessing.cpu_count(),
+                           'python': platform.python_version(),
+                           'numpy': np.__version__},
+                  'results': [dict(zip(['processes', 'seconds', 'speedup',
+                                        'efficiency'], row))
+                              for row in rows]}
+
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print "Wrote %s" % args.output
@@ -0,0 +1,143 @@
+"""Bounded caches for similarities and predictions."""
+
+from collections import OrderedDict
+import time
+
+
+# Returned by get() on a miss, so a cached None can be told apart from one
+MISSING = object()
+
+
+class LRUCache(object):
+    """Least-recently-used cache with a size cap and a time-to-live."""
+
+    def __init__(self, maxsize=10000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=MISSING):
+        """Return the cached value for key, or default on a miss."""
+
+        entry = self.entries.pop(key, None)
+
+        if entry is None:
+            self.misses += 1
+            return default
+
+        value, expires_at = entry
+        if expires_at < time.time():
+            self.expirations += 1
+            self.misses += 1
+            return default
+
+        # Re-insert so the entry moves to the most recently used end
+        self.entries[key] = entry
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Store value under key, evicting the oldest entry if full."""
+
+        self.entries.pop(key, None)
+        self.entries[key] = (value, time.time() + self.ttl)
+
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Drop every entry, keeping the counters."""
+
+        self.entries.clear()
+
+    def stats(self):
+        """Return a dictionary of the cache's counters."""
+
+        return {'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations}
+
+
+class RatingsVersions(object):
+    """Counters that change whenever ratings behind a cached value change.
+
+    A user's version moves when they rate anything, which covers any
+    similarity involving them, and when their set of nearest neighbors
+    changes. A movie's version moves when anyone who rated
+    it rates anything, since that changes either their score for the movie
+    or their weight in predictions for it. The total moves on every write.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.users = {}
+        self.movies = {}
+
+    def user(self, user_id):
+        return self.users.get(user_id, 0)
+
+    def movie(self, movie_id):
+        return self.movies.get(movie_id, 0)
+
+    def reset(self):
+        """Start over, as when every rating may have changed."""
+
+        self.total += 1
+        self.users = {}
+        self.movies = {}
+
+    def touch(self, user_ids):
+        """Record that something behind these users' predictions changed."""
+
+        for user_id in user_ids:
+            self.users[user_id] = self.user(user_id) + 1
+
+    def bump(self, user_id, rated_movie_ids):
+        """Record that user_id, who has rated rated_movie_ids, rated something."""
+
+        self.total += 1
+        self.users[user_id] = self.user(user_id) + 1
+
+        for movie_id in rated_movie_ids:
+            self.movies[movie_id] = self.movie(movie_id) + 1
+
+
+similarity_cache = LRUCache()
+prediction_cache = LRUCache()
+ratings_versions = RatingsVersions()
+
+
+def configure(maxsize, ttl):
+    """Resize the shared caches, dropping anything already cached."""
+
+    for shared_cache in (similarity_cache, prediction_cache):
+        shared_cache.maxsize = maxsize
+        shared_cache.ttl = ttl
+        shared_cache.clear()
+
+
+def reset():
+    """Forget every cached value and ratings version."""
+
+    similarity_cache.clear()
+    prediction_cache.clear()
+    ratings_versions.reset()
+
+
+def stats():
+    """Return the counters of the shared caches."""
+
+    return {'similarity': similarity_cache.stats(),
+            'prediction': prediction_cache.stats()}
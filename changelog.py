@@ -0,0 +1,163 @@
+"""Consume the rating change log, refreshing derived data off the request path.
+
+Every rating write appends (user_id, movie_id, old score, new score,
+time) to the rating_changes table in the same transaction. This consumer
+reads the log in batches after its saved offset, brings the in-memory
+matrix up to date, then rewrites only what the batch touched:
+
+* the rating summaries of the movies rated,
+* the stored predictions of the users who rated,
+* the eye of judgment's saved judgments, which web workers pick up.
+
+Each batch's rewrites are committed with the new offset, along with the
+ids skipped below it by transactions that hadn't committed yet, which
+later batches look for again. They're recomputed from current ratings
+rather than applied as deltas, so a batch that runs twice (say, after a
+crash between writing and committing) does no harm. Run it alongside the
+web workers, with DERIVED_UPDATES set to 'consumer' so they leave this
+work to it:
+
+    python changelog.py
+"""
+
+import datetime
+import time
+
+from model import db, RatingChange, DERIVED_DATA_CONSUMER
+from model import get_consumer_cursor, set_consumer_cursor
+from model import get_consumer_offset, latest_change_id
+from model import apply_user_scores, clear_predictions
+from model import refresh_movie_rating_summaries
+from model import Prediction
+from eye import get_eye
+
+
+def read_changes(cursor, batch_size, settle=1.0):
+    """Return up to batch_size unread changes at cursor, in log order.
+
+    Changes logged in the last settle seconds are left for next time, so
+    fewer transactions are still committing behind the newest id read.
+    Any that are anyway come back through the cursor's gaps.
+    """
+
+    settled = datetime.datetime.now() - datetime.timedelta(seconds=settle)
+
+    return cursor.read(batch_size, settled)
+
+
+def apply_changes(changes):
+    """Refresh the data derived from the ratings that changes touched.
+
+    The caller is responsible for committing.
+    """
+
+    # The latest score for each user's movies, in log order
+    latest = {}
+    for change in changes:
+        latest.setdefault(change.user_id, {})[change.movie_id] = \
+            change.new_score
+
+    # As on the request path, so the neighbors and factors that
+    # predictions are made from see the new scores too
+    for user_id, scores in latest.items():
+        apply_user_scores(user_id, scores.keys(), scores.values())
+
+    user_ids = sorted(latest)
+    movie_ids = set(change.movie_id for change in changes)
+
+    refresh_movie_rating_summaries(movie_ids)
+    refresh_predictions(user_ids)
+
+    the_eye = get_eye()
+    if the_eye is not None:
+        the_eye.refresh()
+
+
+def refresh_predictions(user_ids):
+    """Recompute the stored predictions of user_ids.
+
+    The caller is responsible for committing.
+    """
+
+    # Imported here, since seed imports model and server
+    from seed import predict_users
+
+    clear_predictions(user_ids)
+
+    computed_at = datetime.datetime.now()
+    rows = [{'user_id': user_id, 'movie_id': movie_id,
+             'predicted_score': score, 'computed_at': computed_at}
+            for user_id, movie_id, score in predict_users(user_ids)]
+
+    if rows:
+        db.session.execute(Prediction.__table__.insert(), rows)
+
+
+def consume(name=DERIVED_DATA_CONSUMER, batch_size=1000, settle=1.0):
+    """Process one batch of the log. Returns how many changes it held."""
+
+    cursor = get_consumer_cursor(name)
+    changes = read_changes(cursor, batch_size, settle)
+
+    if changes:
+        apply_changes(changes)
+
+    if cursor.advance(changes):
+        set_consumer_cursor(name, cursor)
+
+    db.session.commit()
+    return len(changes)
+
+
+def lag(name=DERIVED_DATA_CONSUMER):
+    """Return a consumer's (changes waiting, seconds the oldest has waited)."""
+
+    offset = get_consumer_offset(name)
+    waiting = RatingChange.query.filter(RatingChange.change_id > offset)
+    oldest = db.session.query(db.func.min(RatingChange.changed_at)).filter(
+        RatingChange.change_id > offset).scalar()
+
+    if oldest is None:
+        return 0, 0.0
+
+    return (waiting.count(),
+            (datetime.datetime.now() - oldest).total_seconds())
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from model import connect_to_db
+    from server import app
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help="changes per batch")
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help="seconds to wait when the log is caught up")
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help="seconds before a logged change is read")
+    parser.add_argument('--once', action='store_true',
+                        help="catch up with the log, then exit")
+    args = parser.parse_args()
+
+    connect_to_db(app)
+    app.config['SQLALCHEMY_ECHO'] = False
+
+    with app.app_context():
+        db.create_all()
+        print "Log at change %d, consumer at %d" % (
+            latest_change_id(), get_consumer_offset(DERIVED_DATA_CONSUMER))
+
+        while True:
+            started = time.time()
+            count = consume(batch_size=args.batch_size, settle=args.settle)
+
+            if count:
+                waiting, seconds = lag()
+                print ("Applied %d changes in %.2fs; lag %d changes, %.1fs"
+                       % (count, time.time() - started, waiting, seconds))
+            elif args.once:
+                break
+            else:
+                time.sleep(args.interval)
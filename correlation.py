@@ -2,24 +2,49 @@
 
 from math import sqrt
 
+import numpy as np
+
 
 def pearson(pairs):
     """Return Pearson correlation for pairs.
     Using a set of pairwise ratings, produces a Pearson similarity rating.
+
+    pairs can be any iterable (a generator is fine); it's read once, keeping
+    only running sums.
     """
 
-    series_1 = [float(pair[0]) for pair in pairs]
-    series_2 = [float(pair[1]) for pair in pairs]
+    size = 0
+    sum_1 = sum_2 = 0
+    squares_1 = squares_2 = 0
+    product_sum = 0
+
+    for n, m in pairs:
+        x = float(n)
+        y = float(m)
 
-    sum_1 = sum(series_1)
-    sum_2 = sum(series_2)
+        size += 1
+        sum_1 += x
+        sum_2 += y
+        squares_1 += x * x
+        squares_2 += y * y
+        product_sum += n * m
 
-    squares_1 = sum([n * n for n in series_1])
-    squares_2 = sum([n * n for n in series_2])
+    return pearson_from_stats(size, sum_1, sum_2,
+                              squares_1, squares_2, product_sum)
 
-    product_sum = sum([n * m for n, m in pairs])
 
-    size = len(pairs)
+def pearson_from_stats(size, sum_1, sum_2, squares_1, squares_2, product_sum):
+    """Return Pearson correlation from running sums over the pairs.
+
+    These are the sufficient statistics of a set of pairs: its size, the sum
+    and sum of squares of each series, and the sum of the products.
+    """
+
+    if size == 0:
+        return 0
+
+    sum_1 = float(sum_1)
+    sum_2 = float(sum_2)
 
     numerator = product_sum - ((sum_1 * sum_2) / size)
 
@@ -32,3 +57,88 @@ def pearson(pairs):
         return 0
 
     return numerator / denominator
+
+
+def pearson_many(reference, candidates, reference_mask=None,
+                 candidate_masks=None):
+    """Return the Pearson correlation of one vector with each of many.
+
+    reference is a 1-D array and candidates a 2-D array with one candidate
+    per row. Each correlation is over the positions where both the
+    reference and that candidate are present, per the masks; by default an
+    entry is present when it's nonzero. Gives the same values as pearson()
+    on the co-present pairs, including 0 for no overlap or no variance.
+    """
+
+    reference = np.asarray(reference, dtype=float)
+    candidates = np.atleast_2d(np.asarray(candidates, dtype=float))
+
+    if reference_mask is None:
+        reference_mask = reference != 0
+    if candidate_masks is None:
+        candidate_masks = candidates != 0
+
+    reference_mask = np.asarray(reference_mask, dtype=float)
+    candidate_masks = np.asarray(candidate_masks, dtype=float)
+
+    # Zero out absent entries so they drop out of every sum
+    mine = reference * reference_mask
+    theirs = candidates * candidate_masks
+
+    return pearson_from_stats_many(
+        candidate_masks.dot(reference_mask),
+        candidate_masks.dot(mine),
+        theirs.dot(reference_mask),
+        candidate_masks.dot(mine * mine),
+        (theirs * theirs).dot(reference_mask),
+        theirs.dot(mine))
+
+
+def pearson_from_stats_many(size, sum_1, sum_2, squares_1, squares_2,
+                            product_sum):
+    """Elementwise pearson_from_stats over arrays of running sums.
+
+    The arithmetic is ordered exactly as in pearson_from_stats so the two
+    agree bit for bit.
+    """
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        numerator = product_sum - ((sum_1 * sum_2) / size)
+
+        denominator = np.sqrt(
+            (squares_1 - (sum_1 * sum_1) / size) *
+            (squares_2 - (sum_2 * sum_2) / size)
+        )
+
+        result = numerator / denominator
+        result[(size == 0) | ~(denominator > 0)] = 0
+
+    return result
+
+
+if __name__ == "__main__":
+    # Micro-benchmark: one pearson() call per candidate against a single
+    # pearson_many() call over all of them.
+
+    import timeit
+
+    rand = np.random.RandomState(0)
+    num_candidates, num_movies = 1000, 1700
+    reference = rand.randint(1, 6, num_movies) * (rand.rand(num_movies) < 0.1)
+    candidates = (rand.randint(1, 6, (num_candidates, num_movies)) *
+                  (rand.rand(num_candidates, num_movies) < 0.1))
+
+    def one_at_a_time():
+        return [pearson((x, y) for x, y in zip(reference, row) if x and y)
+                for row in candidates]
+
+    def all_at_once():
+        return pearson_many(reference, candidates)
+
+    assert np.allclose(one_at_a_time(), all_at_once())
+
+    for name, function in [("pearson", one_at_a_time),
+                           ("pearson_many", all_at_once)]:
+        seconds = min(timeit.repeat(function, number=1, repeat=5))
+        print "%-13s %d candidates x %d movies: %.2f ms" % (
+            name, num_candidates, num_movies, seconds * 1000)
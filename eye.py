@@ -0,0 +1,129 @@
+"""The eye of judgment's opinion of every movie."""
+
+from flask import current_app
+import numpy as np
+import os
+import zipfile
+
+import cache
+import metrics
+from model import User, get_similarity_engine, predict_many
+
+EYE_EMAIL = 'the-eye@of-judgment.com'
+
+
+class EyeOfJudgment(object):
+    """The eye's score for every movie, kept as one array.
+
+    Movies the eye has rated get its score; the rest get its predicted
+    score. The array is recomputed when any rating changes and saved to
+    disk, so a restart with the same ratings doesn't redo the sweep.
+    """
+
+    def __init__(self, user_id, path):
+        self.user_id = user_id
+        self.path = path
+        self.version = None
+        self.movie_index = {}
+        self.judgments = np.array([])
+
+        self.load()
+
+    def judgment(self, movie_id):
+        """Return the eye's score for movie_id, or None if it has none."""
+
+        if self.version != cache.ratings_versions.total:
+            self.refresh()
+
+        j = self.movie_index.get(movie_id)
+
+        if j is None or np.isnan(self.judgments[j]):
+            return None
+        else:
+            return self.judgments[j]
+
+    @metrics.timed('eye_refresh')
+    def refresh(self):
+        """Recompute every judgment from the current ratings.
+
+        If the change log's consumer has already saved judgments for these
+        ratings, they're read instead.
+        """
+
+        if self.load():
+            return
+
+        engine = get_similarity_engine()
+        movie_ids = engine.movie_ids
+
+        judgments = predict_many(self.user_id, movie_ids)
+
+        if self.user_id in engine.user_index:
+            movies, scores = engine.matrix.row(engine.user_index[self.user_id])
+            judgments[movies] = scores
+
+        self.movie_index = dict((movie_id, j)
+                                for j, movie_id in enumerate(movie_ids))
+        self.judgments = judgments
+        self.version = cache.ratings_versions.total
+
+        self.save(engine.fingerprint())
+
+    def save(self, fingerprint):
+        """Write the judgments to disk, tagged with the ratings' fingerprint.
+
+        Every worker may save, so each writes its own temporary file and
+        renames it into place; readers never see half a file.
+        """
+
+        temporary = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(temporary, 'wb') as f:
+            np.savez(f, user_id=self.user_id, fingerprint=fingerprint,
+                     movie_ids=np.array(sorted(self.movie_index,
+                                               key=self.movie_index.get)),
+                     judgments=self.judgments)
+        os.rename(temporary, self.path)
+
+    def load(self):
+        """Read saved judgments if they match the current ratings.
+
+        Returns whether they did. A missing or unreadable file doesn't.
+        """
+
+        try:
+            with np.load(self.path) as npz:
+                saved = dict((name, npz[name]) for name in npz.files)
+        except (IOError, ValueError, KeyError, zipfile.BadZipfile):
+            return False
+
+        engine = get_similarity_engine()
+        if (int(saved['user_id']) != self.user_id or
+                str(saved['fingerprint']) != engine.fingerprint()):
+            return False
+
+        self.movie_index = dict((movie_id, j) for j, movie_id
+                                in enumerate(saved['movie_ids'].tolist()))
+        self.judgments = saved['judgments']
+        self.version = cache.ratings_versions.total
+
+        return True
+
+
+_eye = None
+
+
+def get_eye():
+    """Return the shared eye of judgment, or None if the eye isn't a user."""
+
+    global _eye
+
+    if _eye is None:
+        the_eye = User.query.filter_by(email=EYE_EMAIL).first()
+
+        if the_eye is None:
+            return None
+
+        _eye = EyeOfJudgment(the_eye.user_id,
+                             current_app.config['EYE_JUDGMENT_PATH'])
+
+    return _eye
@@ -0,0 +1,283 @@
+"""Matrix factorization: offline ALS training and O(d) predictions.
+
+Each score is modeled as
+
+    global mean + user bias + movie bias + user factors . movie factors
+
+and the biases and factors are learned by alternating least squares over a
+RatingsMatrix. Running this module trains from the database and saves an
+artifact, or reports accuracy and latency against the Pearson predictor.
+"""
+
+import glob
+import os
+import time
+
+import numpy as np
+
+# Bumped when the artifact layout changes, so old files aren't misread
+FORMAT_VERSION = 1
+
+
+class FactorModel(object):
+    """Learned biases and latent factors for every user and movie."""
+
+    def __init__(self, mean, user_ids, user_biases, user_factors,
+                 movie_ids, movie_biases, movie_factors, regularization,
+                 trained_at=None):
+        self.mean = mean
+        self.user_ids = list(user_ids)
+        self.user_biases = user_biases
+        self.user_factors = user_factors
+        self.movie_ids = list(movie_ids)
+        self.movie_biases = movie_biases
+        self.movie_factors = movie_factors
+        self.regularization = regularization
+        self.trained_at = trained_at or time.time()
+
+        self.user_index = dict((user_id, i)
+                               for i, user_id in enumerate(self.user_ids))
+        self.movie_index = dict((movie_id, j)
+                                for j, movie_id in enumerate(self.movie_ids))
+
+    def predict(self, user_id, movie_id):
+        """Return the predicted score, or None for an unknown movie."""
+
+        j = self.movie_index.get(movie_id)
+        if j is None:
+            return None
+
+        score = self.mean + self.movie_biases[j]
+
+        i = self.user_index.get(user_id)
+        if i is not None:
+            score += (self.user_biases[i] +
+                      self.user_factors[i].dot(self.movie_factors[j]))
+
+        return min(max(score, 1), 5)
+
+    def predict_many(self, user_id, movie_ids):
+        """Return predictions aligned with movie_ids (NaN for unknown movies)."""
+
+        known = np.array([movie_id in self.movie_index
+                          for movie_id in movie_ids], dtype=bool)
+        columns = np.array([self.movie_index[movie_id]
+                            for movie_id in np.asarray(movie_ids)[known]],
+                           dtype=int)
+
+        scores = self.mean + self.movie_biases[columns]
+
+        i = self.user_index.get(user_id)
+        if i is not None:
+            scores += (self.user_biases[i] +
+                       self.movie_factors[columns].dot(self.user_factors[i]))
+
+        predictions = np.empty(len(movie_ids))
+        predictions.fill(np.nan)
+        predictions[known] = np.clip(scores, 1, 5)
+
+        return predictions
+
+    def fold_in(self, user_id, movie_ids, scores):
+        """Refit one user's bias and factors to their current ratings.
+
+        Movie factors stay fixed, so this is a single least-squares solve
+        of size d + 1 and new ratings count without a retrain.
+        """
+
+        pairs = [(self.movie_index[movie_id], score)
+                 for movie_id, score in zip(movie_ids, scores)
+                 if movie_id in self.movie_index]
+        if not pairs:
+            return
+
+        columns, scores = zip(*pairs)
+        bias, factors = _solve(self.movie_factors[list(columns)],
+                               np.array(scores, dtype=float) - self.mean -
+                               self.movie_biases[list(columns)],
+                               self.regularization)
+
+        if user_id not in self.user_index:
+            self.user_index[user_id] = len(self.user_ids)
+            self.user_ids.append(user_id)
+            self.user_biases = np.append(self.user_biases, 0)
+            self.user_factors = np.vstack([self.user_factors,
+                                           np.zeros(len(factors))])
+
+        i = self.user_index[user_id]
+        self.user_biases[i] = bias
+        self.user_factors[i] = factors
+
+    def save(self, directory):
+        """Write the model to a new versioned file in directory."""
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        path = os.path.join(directory, "factors-%d.npz" % (self.trained_at *
+                                                           1000))
+        np.savez(path, format_version=FORMAT_VERSION, mean=self.mean,
+                 user_ids=self.user_ids, user_biases=self.user_biases,
+                 user_factors=self.user_factors, movie_ids=self.movie_ids,
+                 movie_biases=self.movie_biases,
+                 movie_factors=self.movie_factors,
+                 regularization=self.regularization,
+                 trained_at=self.trained_at)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        """Read a model saved by save()."""
+
+        saved = np.load(path)
+
+        if int(saved['format_version']) != FORMAT_VERSION:
+            raise ValueError("%s has artifact format %s, expected %s"
+                             % (path, saved['format_version'], FORMAT_VERSION))
+
+        return cls(float(saved['mean']), saved['user_ids'].tolist(),
+                   saved['user_biases'], saved['user_factors'],
+                   saved['movie_ids'].tolist(), saved['movie_biases'],
+                   saved['movie_factors'], float(saved['regularization']),
+                   float(saved['trained_at']))
+
+    @classmethod
+    def load_latest(cls, directory):
+        """Read the newest model in directory, or None if there isn't one."""
+
+        paths = glob.glob(os.path.join(directory, "factors-*.npz"))
+        if not paths:
+            return None
+
+        newest = max(paths, key=lambda path: int(
+            os.path.basename(path)[len("factors-"):-len(".npz")]))
+        return cls.load(newest)
+
+
+def train(matrix, factors=20, regularization=5.0, iterations=15, seed=0):
+    """Fit a FactorModel to a RatingsMatrix by alternating least squares."""
+
+    num_users, num_movies = matrix.shape
+    mean = matrix.row_sums.sum() / max(matrix.nnz, 1)
+
+    rand = np.random.RandomState(seed)
+    user_factors = rand.normal(0, 0.1, (num_users, factors))
+    movie_factors = rand.normal(0, 0.1, (num_movies, factors))
+    user_biases = np.zeros(num_users)
+    movie_biases = np.zeros(num_movies)
+
+    for iteration in range(iterations):
+        for i in range(num_users):
+            movies, scores = matrix.row(i)
+            if len(movies):
+                user_biases[i], user_factors[i] = _solve(
+                    movie_factors[movies],
+                    scores - mean - movie_biases[movies], regularization)
+
+        for j in range(num_movies):
+            users, scores = matrix.column(j)
+            if len(users):
+                movie_biases[j], movie_factors[j] = _solve(
+                    user_factors[users],
+                    scores - mean - user_biases[users], regularization)
+
+    return FactorModel(mean, matrix.user_ids, user_biases, user_factors,
+                       matrix.movie_ids, movie_biases, movie_factors,
+                       regularization)
+
+
+def _solve(other_factors, targets, regularization):
+    """Return the (bias, factors) minimizing regularized squared error.
+
+    Solves for one row's bias and factors given the factors of the rows it
+    was rated against and the residual targets.
+    """
+
+    design = np.hstack([np.ones((len(targets), 1)), other_factors])
+    penalty = regularization * np.eye(design.shape[1])
+
+    solution = np.linalg.solve(design.T.dot(design) + penalty,
+                               design.T.dot(targets))
+    return solution[0], solution[1:]
+
+
+def report(data_path, factors, regularization, iterations, neighbor_count,
+           test_fraction=0.2, latency_samples=1000):
+    """Print RMSE and prediction latency of ALS against Pearson on a split."""
+
+    from neighbors import NeighborIndex
+    from ratings_matrix import RatingsMatrix
+    from similarity import SimilarityEngine
+
+    data = np.loadtxt(data_path, usecols=(0, 1, 2), dtype=np.int64)
+    rand = np.random.RandomState(0)
+    is_test = rand.rand(len(data)) < test_fraction
+    train_data, test_data = data[~is_test], data[is_test]
+
+    matrix = RatingsMatrix(train_data[:, 0], train_data[:, 1],
+                           train_data[:, 2])
+    print "%d training ratings, %d test ratings" % (len(train_data),
+                                                    len(test_data))
+
+    started = time.time()
+    model = train(matrix, factors, regularization, iterations)
+    print "ALS: trained in %.1fs" % (time.time() - started)
+
+    engine = SimilarityEngine(matrix)
+    index = NeighborIndex(engine, neighbor_count)
+
+    predictors = [
+        ("ALS", model.predict_many),
+        ("Pearson top-%d" % neighbor_count,
+         lambda user_id, movie_ids: engine.predict_many(user_id, movie_ids,
+                                                        index)),
+        ("Pearson, all raters", engine.predict_many),
+    ]
+
+    for name, predict_many in predictors:
+        errors = []
+        for user_id in np.unique(test_data[:, 0]):
+            mine = test_data[test_data[:, 0] == user_id]
+            predictions = predict_many(user_id, mine[:, 1].tolist())
+            errors.extend(predictions - mine[:, 2])
+
+        errors = np.array(errors)
+        covered = ~np.isnan(errors)
+        rmse = np.sqrt(np.mean(errors[covered] ** 2))
+
+        samples = test_data[rand.choice(len(test_data), latency_samples)]
+        started = time.time()
+        for user_id, movie_id, score in samples:
+            predict_many(user_id, [movie_id])
+        latency = (time.time() - started) / latency_samples
+
+        print "%-20s RMSE %.4f  coverage %5.1f%%  %.3f ms/prediction" % (
+            name, rmse, 100.0 * covered.mean(), latency * 1000)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('command', choices=['train', 'report'])
+    parser.add_argument('--factors', type=int, default=20)
+    parser.add_argument('--regularization', type=float, default=5.0)
+    parser.add_argument('--iterations', type=int, default=15)
+    parser.add_argument('--data', default='seed_data/u.data',
+                        help="ratings file for the report")
+    args = parser.parse_args()
+
+    from server import app
+    from model import connect_to_db, get_ratings_matrix
+
+    connect_to_db(app)
+
+    if args.command == 'train':
+        app.config['SQLALCHEMY_ECHO'] = False
+        with app.app_context():
+            model = train(get_ratings_matrix(), args.factors,
+                          args.regularization, args.iterations)
+        print "Saved %s" % model.save(app.config['FACTORS_DIR'])
+    else:
+        report(args.data, args.factors, args.regularization, args.iterations,
+               app.config['NEIGHBOR_COUNT'] or 50)
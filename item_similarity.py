@@ -0,0 +1,101 @@
+"""Item-item collaborative filtering from precomputed movie neighbors."""
+
+import numpy as np
+
+from correlation import pearson_from_stats_many
+from ratings_matrix import gather_groups
+from similarity import SimilarityEngine
+
+
+def movie_neighbor_rows(matrix, k, min_overlap=20):
+    """Yield (movie_id, other_movie_id, similarity) for each movie's top k.
+
+    Movies are compared by the Pearson correlation of the scores their
+    common raters gave them. Pairs with fewer than min_overlap common raters
+    are skipped, since a couple of agreeing raters would otherwise make
+    obscure movies look perfectly similar. Only positive similarities are
+    kept.
+    """
+
+    engine = SimilarityEngine(matrix.transposed())
+    sums = engine.pair_sums()
+    size = sums[0]
+    sims = pearson_from_stats_many(*sums)
+
+    # Only size is needed from here on; don't hold the other movie x movie
+    # sums while rows are yielded
+    del sums
+
+    sims[size < min_overlap] = 0
+    np.fill_diagonal(sims, 0)
+
+    movie_ids = engine.user_ids
+    width = min(k, len(movie_ids) - 1)
+
+    for i, row in enumerate(sims):
+        if width <= 0:
+            break
+
+        top = np.argpartition(-row, width - 1)[:width]
+        for j in top[row[top] > 0]:
+            yield movie_ids[i], movie_ids[j], float(row[j])
+
+
+class ItemNeighbors(object):
+    """Each movie's most similar movies, held as CSR-style arrays."""
+
+    def __init__(self, rows):
+        """Build from (movie_id, other_movie_id, similarity) rows."""
+
+        rows = sorted(rows)
+
+        self.movie_ids = sorted(set(row[0] for row in rows) |
+                                set(row[1] for row in rows))
+        self.movie_index = dict((movie_id, i)
+                                for i, movie_id in enumerate(self.movie_ids))
+
+        owners = np.array([self.movie_index[row[0]] for row in rows], dtype=int)
+        self.ptr = np.zeros(len(self.movie_ids) + 1, dtype=int)
+        np.cumsum(np.bincount(owners, minlength=len(self.movie_ids)),
+                  out=self.ptr[1:])
+        self.others = np.array([self.movie_index[row[1]] for row in rows],
+                               dtype=int)
+        self.sims = np.array([row[2] for row in rows], dtype=float)
+
+    def predict_many(self, rated_movie_ids, scores, movie_ids):
+        """Predict scores for movie_ids from a user's scores on other movies.
+
+        Each prediction is the similarity-weighted mean of the user's scores
+        on the target's neighbors. Returns an array aligned with movie_ids,
+        holding NaN where the user has rated none of the neighbors.
+        """
+
+        mine = np.zeros(len(self.movie_ids))
+        rated = np.zeros(len(self.movie_ids))
+        for movie_id, score in zip(rated_movie_ids, scores):
+            if movie_id in self.movie_index:
+                mine[self.movie_index[movie_id]] = score
+                rated[self.movie_index[movie_id]] = 1
+
+        known = np.array([movie_id in self.movie_index
+                          for movie_id in movie_ids], dtype=bool)
+        targets = [self.movie_index[movie_id]
+                   for movie_id in np.asarray(movie_ids)[known]]
+
+        owners, positions = gather_groups(self.ptr, targets)
+        others = self.others[positions]
+        sims = self.sims[positions]
+
+        numerator = np.bincount(owners, weights=sims * mine[others],
+                                minlength=len(targets))
+        denominator = np.bincount(owners, weights=sims * rated[others],
+                                  minlength=len(targets))
+
+        predictions = np.empty(len(movie_ids))
+        predictions.fill(np.nan)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            predictions[known] = np.where(denominator != 0,
+                                          numerator / denominator, np.nan)
+
+        return predictions
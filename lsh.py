@@ -0,0 +1,235 @@
+"""Approximate nearest-neighbor users by random-hyperplane LSH."""
+
+import time
+
+import numpy as np
+
+from correlation import pearson_from_stats_many
+
+
+class LSHIndex(object):
+    """Approximate k most similar users, found through hash buckets.
+
+    Each user's ratings, centered on their mean, are projected onto random
+    hyperplanes, and the signs of each group of bits projections make up
+    the user's key in one of several hash tables. Users whose centered
+    vectors point the same way (which is what Pearson measures) tend to
+    share a bucket in at least one table. A query scores only the users
+    sharing one of its buckets, with exact Pearson, so its cost depends on
+    bucket sizes rather than on the number of users.
+
+    Offers the same neighbors() and refresh_user() as NeighborIndex, so it
+    can stand in for one.
+    """
+
+    def __init__(self, engine, k, tables=16, bits=6, seed=0, chunk_size=256):
+        self.engine = engine
+        self.k = k
+        self.tables = tables
+        self.bits = bits
+        self.rand = np.random.RandomState(seed)
+
+        self.planes = np.empty((0, tables * bits), dtype=np.float32)
+        self.place_values = 1 << np.arange(bits)
+        self.buckets = [{} for _ in range(tables)]
+        self.keys = {}
+
+        num_users = len(engine.user_ids)
+        for start in range(0, num_users, chunk_size):
+            stop = min(start + chunk_size, num_users)
+            for i, keys in zip(range(start, stop), self._keys(start, stop)):
+                self._add(i, keys)
+
+    def _keys(self, start, stop):
+        """Return the bucket keys of users start:stop, one row per user.
+
+        Users with no ratings have nothing to hash and get None.
+        """
+
+        matrix = self.engine.matrix
+        self._grow_planes()
+
+        scores, rated = matrix.dense_rows(start, stop, np.float32)
+        counts = matrix.row_counts[start:stop]
+        means = matrix.row_sums[start:stop] / np.maximum(counts, 1)
+        centered = (scores - means[:, np.newaxis].astype(np.float32)) * rated
+
+        signs = centered.dot(self.planes) > 0
+        keys = signs.reshape(-1, self.tables, self.bits).dot(self.place_values)
+
+        return [tuple(row) if count else None
+                for row, count in zip(keys.tolist(), counts)]
+
+    def _grow_planes(self):
+        """Draw hyperplane coordinates for movies added since the last call."""
+
+        missing = len(self.engine.movie_ids) - len(self.planes)
+
+        if missing > 0:
+            more = self.rand.normal(size=(missing, self.planes.shape[1]))
+            self.planes = np.vstack([self.planes, more.astype(np.float32)])
+
+    def _add(self, i, keys):
+        self.keys[i] = keys
+
+        if keys is not None:
+            for table, key in zip(self.buckets, keys):
+                table.setdefault(key, set()).add(i)
+
+    def _remove(self, i):
+        keys = self.keys.pop(i, None)
+
+        if keys is not None:
+            for table, key in zip(self.buckets, keys):
+                table[key].discard(i)
+                if not table[key]:
+                    del table[key]
+
+    def candidates(self, i):
+        """Return the indexes of users sharing any of user i's buckets."""
+
+        keys = self.keys.get(i)
+        if keys is None:
+            return np.array([], dtype=int)
+
+        found = set()
+        for table, key in zip(self.buckets, keys):
+            found.update(table[key])
+        found.discard(i)
+
+        return np.array(sorted(found), dtype=int)
+
+    def neighbors(self, user_id):
+        """Return (user indexes, sims) of user_id's approximate top k."""
+
+        if user_id not in self.engine.user_index:
+            return np.array([], dtype=int), np.array([])
+
+        i = self.engine.user_index[user_id]
+        candidates = self.candidates(i)
+        sims = self.similarities(i, candidates)
+
+        if len(candidates) > self.k:
+            top = np.argpartition(-sims, self.k - 1)[:self.k]
+            candidates, sims = candidates[top], sims[top]
+
+        return candidates, sims
+
+    def similarities(self, i, others):
+        """Return user i's exact Pearson similarity to each user in others."""
+
+        matrix = self.engine.matrix
+        movies, scores = matrix.row(i)
+        mine = np.zeros(len(self.engine.movie_ids))
+        mine[movies] = scores
+        rated = np.zeros(len(self.engine.movie_ids))
+        rated[movies] = 1
+
+        owners, their_movies, theirs = matrix.gather_rows(others)
+        shared = rated[their_movies]
+        mine = mine[their_movies]
+        theirs = theirs * shared
+
+        def total(weights):
+            return np.bincount(owners, weights=weights, minlength=len(others))
+
+        return pearson_from_stats_many(total(shared), total(mine),
+                                       total(theirs), total(mine * mine),
+                                       total(theirs * theirs),
+                                       total(mine * theirs))
+
+    def insert(self, user_id):
+        """(Re)hash user_id from their current ratings.
+
+        Call this when a user is created or their ratings change. Returns
+        the ids of users who shared a bucket with them before or after,
+        whose neighbors may have changed.
+        """
+
+        if user_id not in self.engine.user_index:
+            return [user_id]
+
+        i = self.engine.user_index[user_id]
+        affected = set(self.candidates(i))
+
+        self._remove(i)
+        self._add(i, self._keys(i, i + 1)[0])
+        affected.update(self.candidates(i))
+
+        return [user_id] + [self.engine.user_ids[j] for j in sorted(affected)]
+
+    refresh_user = insert
+
+
+def recall_at_k(index, engine, user_ids, k):
+    """Return the mean fraction of each user's exact top k that index finds.
+
+    A neighbor found counts if it's at least as similar as the exact kth,
+    so ties don't count against the index. Also returns the mean number of
+    candidates scored per query.
+    """
+
+    recalls = []
+    candidates = []
+
+    for user_id in user_ids:
+        i = engine.user_index[user_id]
+        exact = engine.similarities(user_id)
+        exact[i] = -np.inf
+        width = min(k, len(exact) - 1)
+        kth = np.partition(-exact, width - 1)[width - 1]
+
+        found, sims = index.neighbors(user_id)
+        hits = (-exact[found] <= kth).sum()
+        recalls.append(min(hits, width) / float(width))
+        candidates.append(len(index.candidates(i)))
+
+    return np.mean(recalls), np.mean(candidates)
+
+
+if __name__ == "__main__":
+    # Tune the index: recall@k and query time against exact Pearson.
+
+    import argparse
+
+    from ratings_matrix import RatingsMatrix
+    from similarity import SimilarityEngine
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--data', default='seed_data/u.data')
+    parser.add_argument('--k', type=int, default=50)
+    parser.add_argument('--tables', type=int, nargs='+', default=[4, 8, 16])
+    parser.add_argument('--bits', type=int, nargs='+', default=[4, 6, 8])
+    parser.add_argument('--sample', type=int, default=200)
+    args = parser.parse_args()
+
+    engine = SimilarityEngine(RatingsMatrix.from_file(args.data))
+    rand = np.random.RandomState(0)
+    sample = rand.choice(engine.user_ids, min(args.sample,
+                                              len(engine.user_ids)),
+                         replace=False).tolist()
+
+    started = time.time()
+    for user_id in sample:
+        engine.similarities(user_id)
+    exact_ms = (time.time() - started) * 1000 / len(sample)
+
+    print "%d users, exact Pearson: %.2f ms/query" % (len(engine.user_ids),
+                                                      exact_ms)
+
+    for tables in args.tables:
+        for bits in args.bits:
+            started = time.time()
+            index = LSHIndex(engine, args.k, tables, bits)
+            build = time.time() - started
+
+            started = time.time()
+            for user_id in sample:
+                index.neighbors(user_id)
+            query_ms = (time.time() - started) * 1000 / len(sample)
+
+            recall, candidates = recall_at_k(index, engine, sample, args.k)
+            print ("tables %2d bits %2d: recall@%d %.3f, %6.1f candidates, "
+                   "%.2f ms/query, built in %.1fs" % (
+                       tables, bits, args.k, recall, candidates, query_ms,
+                       build))
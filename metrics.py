@@ -0,0 +1,263 @@
+"""Request, SQL and hot-path metrics, exposed in Prometheus text format.
+
+instrument(app) times every request by route and counts the SQL
+statements each one runs, through SQLAlchemy engine events. timed()
+wraps the recommendation hot paths. render() returns everything in the
+text format Prometheus scrapes; server.py serves it at /metrics.
+
+Metrics live in the process that recorded them, so with several worker
+processes each is scraped (or summed) separately.
+"""
+
+from functools import wraps
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds in seconds, from a cached lookup to a slow page
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Metric(object):
+    """A named family of samples, one child per combination of labels."""
+
+    kind = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.children = {}
+
+        registry.append(self)
+
+    def labels(self, *values):
+        """Return the child for these label values, creating it if new."""
+
+        child = self.children.get(values)
+
+        if child is None:
+            child = self.children[values] = self.new_child()
+
+        return child
+
+    def render(self):
+        """Return this metric's lines in Prometheus text format."""
+
+        lines = ["# HELP %s %s" % (self.name, self.help_text),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+
+        for values in sorted(self.children):
+            labels = zip(self.label_names, values)
+            lines.extend(self.children[values].render(self.name, labels))
+
+        return lines
+
+
+class Counter(Metric):
+    """A total that only goes up."""
+
+    kind = 'counter'
+
+    def new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        """Add to the unlabelled total."""
+
+        self.labels().inc(amount)
+
+
+class _CounterChild(object):
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self, name, labels):
+        return ["%s%s %s" % (name, _format_labels(labels), _number(self.value))]
+
+
+class Histogram(Metric):
+    """Counts of observations at or under each bucket's upper bound."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(),
+                 buckets=SECONDS_BUCKETS):
+        super(Histogram, self).__init__(name, help_text, label_names)
+        self.buckets = tuple(buckets)
+
+    def new_child(self):
+        return _HistogramChild(self.buckets)
+
+
+class _HistogramChild(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        # Buckets are cumulative, so every bound at or above value counts it
+        for n, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[n] += 1
+
+        self.count += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        lines = ["%s_bucket%s %d" % (name,
+                                     _format_labels(labels +
+                                                    [('le', _number(bound))]),
+                                     count)
+                 for bound, count in zip(self.buckets, self.counts)]
+        lines.append("%s_bucket%s %d" % (name,
+                                         _format_labels(labels +
+                                                        [('le', '+Inf')]),
+                                         self.count))
+        lines.append("%s_sum%s %s" % (name, _format_labels(labels),
+                                      _number(self.sum)))
+        lines.append("%s_count%s %d" % (name, _format_labels(labels),
+                                        self.count))
+
+        return lines
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    def escape(value):
+        return (str(value).replace('\\', r'\\').replace('"', r'\"')
+                .replace('\n', r'\n'))
+
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value))
+                             for name, value in labels)
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = []
+
+request_seconds = Histogram('http_request_duration_seconds',
+                            "Time to handle a request.", ['route', 'method'])
+requests_total = Counter('http_requests_total', "Requests handled.",
+                         ['route', 'method', 'status'])
+request_statements = Histogram('sql_statements_per_request',
+                               "SQL statements run while handling a request.",
+                               ['route'], STATEMENT_BUCKETS)
+request_sql_seconds = Histogram('sql_seconds_per_request',
+                                "Time spent in SQL while handling a request.",
+                                ['route'])
+statements_total = Counter('sql_statements_total',
+                           "SQL statements run, in or out of requests.")
+sql_seconds_total = Counter('sql_seconds_total',
+                            "Time spent running SQL statements.")
+hot_path_seconds = Histogram('hot_path_duration_seconds',
+                             "Time spent in recommendation hot paths.",
+                             ['path'])
+
+
+def timed(path):
+    """Decorate a function to record its duration under path."""
+
+    def decorator(function):
+        child = hot_path_seconds.labels(path)
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                child.observe(time.time() - started)
+
+        return wrapper
+
+    return decorator
+
+
+def instrument(app):
+    """Time app's requests and count the SQL statements each one runs."""
+
+    app.before_request(_start_request)
+    app.after_request(_note_status)
+    app.teardown_request(_finish_request)
+
+    if not event.contains(Engine, 'before_cursor_execute', _start_statement):
+        event.listen(Engine, 'before_cursor_execute', _start_statement)
+        event.listen(Engine, 'after_cursor_execute', _finish_statement)
+
+
+def _route():
+    """Return the URL rule that matched, so ids don't split the metrics."""
+
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+def _start_request():
+    g.metrics_started = time.time()
+    g.sql_statements = 0
+    g.sql_seconds = 0.0
+
+
+def _note_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+def _finish_request(exception):
+    # Runs for failed requests too, which never reach after_request. A
+    # request can also fail before _start_request runs.
+    if not hasattr(g, 'metrics_started'):
+        return
+
+    route = _route()
+    status = 500 if exception is not None else getattr(g, 'metrics_status',
+                                                       500)
+
+    request_seconds.labels(route, request.method).observe(
+        time.time() - g.metrics_started)
+    requests_total.labels(route, request.method, str(status)).inc()
+    request_statements.labels(route).observe(g.sql_statements)
+    request_sql_seconds.labels(route).observe(g.sql_seconds)
+
+
+def _start_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    conn.info.setdefault('metrics_started', []).append(time.time())
+
+
+def _finish_statement(conn, cursor, statement, parameters, context,
+                      executemany):
+    elapsed = time.time() - conn.info['metrics_started'].pop()
+
+    statements_total.inc()
+    sql_seconds_total.inc(elapsed)
+
+    if has_request_context() and hasattr(g, 'sql_statements'):
+        g.sql_statements += 1
+        g.sql_seconds += elapsed
+
+
+def render():
+    """Return every metric in Prometheus text format."""
+
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,73 @@
+-- Add the unique (user_id, movie_id) index that rating upserts rely on, and
+-- an index on users.email for logins and the eye lookup.
+--
+-- Run with psql, outside a transaction (CONCURRENTLY needs that), so the
+-- tables stay writable while the indexes build:
+--
+--     psql ratings -f migrations/001_rating_indexes.sql
+--
+-- It's safe to rerun. If the unique index fails to build, say because a
+-- duplicate rating was written after the duplicates were removed, the
+-- script stops and leaves an INVALID index; running it again drops that
+-- index, removes the new duplicates and builds it again.
+--
+-- The summaries of movies that had duplicates are rebuilt here, and the
+-- stored predictions of users who had them are deleted, to be computed
+-- again on demand or by:
+--
+--     python seed.py predictions --incremental
+--
+-- Restart the web workers afterwards so their in-memory ratings, and the
+-- eye's judgments, are reloaded without the duplicates.
+
+\set ON_ERROR_STOP on
+
+-- A failed or interrupted CREATE INDEX CONCURRENTLY leaves an INVALID index
+-- behind, which IF NOT EXISTS would then skip
+SELECT format('DROP INDEX CONCURRENTLY %s', indexrelid::regclass)
+FROM pg_index
+WHERE indexrelid IN (to_regclass('ix_ratings_user_id_movie_id'),
+                     to_regclass('ix_users_email'))
+  AND NOT indisvalid
+\gexec
+
+BEGIN;
+
+-- Keep only the newest of any duplicate ratings
+CREATE TEMPORARY TABLE duplicate_ratings ON COMMIT DROP AS
+SELECT rating_id, user_id, movie_id FROM (
+    SELECT rating_id, user_id, movie_id,
+           row_number() OVER (PARTITION BY user_id, movie_id
+                              ORDER BY rating_id DESC) AS newer
+    FROM ratings
+) ranked
+WHERE newer > 1;
+
+DELETE FROM ratings
+WHERE rating_id IN (SELECT rating_id FROM duplicate_ratings);
+
+-- The summaries counted the duplicates, and predictions were made from them
+DELETE FROM movie_rating_summaries
+WHERE movie_id IN (SELECT movie_id FROM duplicate_ratings);
+
+INSERT INTO movie_rating_summaries (movie_id, count, score_sum, score_squares,
+                                    count_1, count_2, count_3, count_4,
+                                    count_5)
+SELECT movie_id, count(*), sum(score), sum(score * score),
+       count(*) FILTER (WHERE score = 1), count(*) FILTER (WHERE score = 2),
+       count(*) FILTER (WHERE score = 3), count(*) FILTER (WHERE score = 4),
+       count(*) FILTER (WHERE score = 5)
+FROM ratings
+WHERE movie_id IN (SELECT movie_id FROM duplicate_ratings)
+GROUP BY movie_id;
+
+DELETE FROM predictions
+WHERE user_id IN (SELECT user_id FROM duplicate_ratings);
+
+COMMIT;
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_ratings_user_id_movie_id
+    ON ratings (user_id, movie_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_email
+    ON users (email);
@@ -0,0 +1,11 @@
+-- Drop the co-rating stats table, the persisted per-pair sums that every
+-- rating write used to update for each of the movie's other raters.
+--
+-- Similarity is computed from the in-memory ratings matrix instead: a
+-- write sets one score there, and a user's sums against everyone come
+-- from SimilarityEngine.user_pair_sums, fed to pearson_from_stats_many.
+-- Nothing read the table, so keeping it up to date was pure write cost:
+--
+--     psql ratings -f migrations/002_drop_co_rating_stats.sql
+
+DROP TABLE IF EXISTS co_rating_stats;
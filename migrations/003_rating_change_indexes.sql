@@ -0,0 +1,23 @@
+-- Index the rating change log by user and by movie, so the JSON API can
+-- find the newest change behind a resource for its ETag.
+--
+-- Run with psql, outside a transaction (CONCURRENTLY needs that):
+--
+--     psql ratings -f migrations/003_rating_change_indexes.sql
+
+\set ON_ERROR_STOP on
+
+-- A failed or interrupted CREATE INDEX CONCURRENTLY leaves an INVALID index
+-- behind, which IF NOT EXISTS would then skip
+SELECT format('DROP INDEX CONCURRENTLY %s', indexrelid::regclass)
+FROM pg_index
+WHERE indexrelid IN (to_regclass('ix_rating_changes_user_id_change_id'),
+                     to_regclass('ix_rating_changes_movie_id_change_id'))
+  AND NOT indisvalid
+\gexec
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_rating_changes_user_id_change_id
+    ON rating_changes (user_id, change_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_rating_changes_movie_id_change_id
+    ON rating_changes (movie_id, change_id);
@@ -0,0 +1,24 @@
+-- Add the indexes keyset pagination reads pages from: movies by
+-- (title, movie_id) for /movies, and ratings by (movie_id, rating_id) for
+-- a movie's ratings on its page and in the JSON API.
+--
+-- Run with psql, outside a transaction (CONCURRENTLY needs that):
+--
+--     psql ratings -f migrations/004_pagination_indexes.sql
+
+\set ON_ERROR_STOP on
+
+-- A failed or interrupted CREATE INDEX CONCURRENTLY leaves an INVALID index
+-- behind, which IF NOT EXISTS would then skip
+SELECT format('DROP INDEX CONCURRENTLY %s', indexrelid::regclass)
+FROM pg_index
+WHERE indexrelid IN (to_regclass('ix_movies_title_movie_id'),
+                     to_regclass('ix_ratings_movie_id_rating_id'))
+  AND NOT indisvalid
+\gexec
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_movies_title_movie_id
+    ON movies (title, movie_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ratings_movie_id_rating_id
+    ON ratings (movie_id, rating_id);
@@ -1,7 +1,18 @@
 """Models and database functions for Ratings project."""
 
 from flask_sqlalchemy import SQLAlchemy
-import correlation
+import cache
+import datetime
+import metrics
+import numpy as np
+import similarity
+from lsh import LSHIndex
+from neighbors import NeighborIndex
+from ratings_matrix import RatingsMatrix
+from item_similarity import ItemNeighbors
+from factorization import FactorModel
+import snapshot
+import time
 # This is the connection to the PostgreSQL database; we're getting this through
 # the Flask-SQLAlchemy helper library. On this, we can find the `session`
 # object, where we do most of our interactions (like committing, etc.)
@@ -12,6 +23,9 @@ db = SQLAlchemy()
 ##############################################################################
 # Model definitions
 
+SCORES = range(1, 6)
+
+
 class User(db.Model):
     """User of ratings website."""
 
@@ -22,6 +36,9 @@ class User(db.Model):
                                                self.email)
         
     __tablename__ = "users"
+    __table_args__ = (
+        db.Index('ix_users_email', 'email'),
+    )
 
     user_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     email = db.Column(db.String(64), nullable=True)
@@ -30,40 +47,75 @@ class User(db.Model):
     zipcode = db.Column(db.String(15), nullable=True)
 
 
+    @metrics.timed('get_predicted_rating')
     def get_predicted_rating(self, movie_id):
         """Predict a user's rating for a movie based on other users' ratings."""
 
-        movie = db.session.query(Movie).filter_by(movie_id=movie_id).one()
-        ratings = movie.ratings
-        user_sim_and_score_pairs = [(self.similarity(rating.user), rating) 
-                                    for rating in ratings]
+        versions = cache.ratings_versions
+        key = (self.user_id, movie_id,
+               versions.user(self.user_id), versions.movie(movie_id))
 
-        user_sim_and_score_pairs.sort(reverse=True)
-        similarity, rating = user_sim_and_score_pairs[0]
+        prediction = cache.prediction_cache.get(key)
+        if prediction is cache.MISSING:
+            prediction = self._compute_predicted_rating(movie_id)
+            cache.prediction_cache.set(key, prediction)
 
-        numerator = sum([rating.score * sim for sim, rating in user_sim_and_score_pairs])
-        denominator = sum([sim for sim, r in user_sim_and_score_pairs])
+        return prediction
 
-        if denominator != 0:
-            return numerator/denominator
-        else:
+    def _compute_predicted_rating(self, movie_id):
+        """Predict one movie's rating without going through the cache."""
+
+        prediction = self.predict_many([movie_id])[0]
+
+        if np.isnan(prediction):
             return None
+        else:
+            return prediction
+
+    def predict_many(self, movie_ids):
+        """Predict this user's ratings for many movies at once."""
+
+        return predict_many(self.user_id, movie_ids)
+
+    @metrics.timed('recommend')
+    def recommend(self, n):
+        """Return up to n (movie_id, prediction) pairs for unrated movies.
 
+        Every movie the user hasn't rated is scored in one pass, and the top
+        n are picked by partial selection rather than sorting everything.
+        """
+
+        engine = get_similarity_engine()
+        rated = set(engine.movies_rated_by(self.user_id))
+        candidates = [movie_id for movie_id in engine.movie_ids
+                      if movie_id not in rated]
+
+        predictions = self.predict_many(candidates)
+        scored = np.flatnonzero(~np.isnan(predictions))
+
+        if len(scored) > n:
+            best = np.argpartition(-predictions[scored], n - 1)[:n]
+            scored = scored[best]
+
+        scored = scored[np.argsort(-predictions[scored])]
+
+        return [(candidates[i], predictions[i]) for i in scored]
+
+    @metrics.timed('similarity')
     def similarity(self, other_user):
         """Determine how similar two users' tastes in movies are."""
 
-        pairs = []
-        my_ratings = User.generate_dict_of_ratings(self)
-        other_ratings = User.generate_dict_of_ratings(other_user)
+        versions = cache.ratings_versions
+        key = (self.user_id, other_user.user_id,
+               versions.user(self.user_id), versions.user(other_user.user_id))
 
-        for movie_id, my_score in my_ratings.iteritems():
-            if movie_id in other_ratings:
-                pairs.append((my_score, other_ratings[movie_id]))
+        sim = cache.similarity_cache.get(key)
+        if sim is cache.MISSING:
+            engine = get_similarity_engine()
+            sim = engine.similarity(self.user_id, other_user.user_id)
+            cache.similarity_cache.set(key, sim)
 
-        if pairs:
-            return correlation.pearson(pairs)
-        else:
-            return 0
+        return sim
 
 
     @staticmethod
@@ -82,6 +134,9 @@ class Movie(db.Model):
     """Movies to be rated."""
 
     __tablename__ = "movies"
+    __table_args__ = (
+        db.Index('ix_movies_title_movie_id', 'title', 'movie_id'),
+    )
 
     movie_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     title = db.Column(db.String(128), nullable=False)
@@ -93,6 +148,11 @@ class Rating(db.Model):
     """User written movie ratings."""
 
     __tablename__ = "ratings"
+    __table_args__ = (
+        db.Index('ix_ratings_movie_id_rating_id', 'movie_id', 'rating_id'),
+        db.Index('ix_ratings_user_id_movie_id', 'user_id', 'movie_id',
+                 unique=True),
+    )
 
     rating_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     movie_id = db.Column(db.Integer, db.ForeignKey('movies.movie_id'), nullable=False)
@@ -110,20 +170,869 @@ class Rating(db.Model):
                     self.score)
 
 
+class MovieRatingSummary(db.Model):
+    """Running totals of a movie's ratings, kept in step with the ratings."""
+
+    __tablename__ = "movie_rating_summaries"
+
+    movie_id = db.Column(db.Integer, db.ForeignKey('movies.movie_id'), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    score_sum = db.Column(db.Integer, nullable=False, default=0)
+    score_squares = db.Column(db.Integer, nullable=False, default=0)
+    count_1 = db.Column(db.Integer, nullable=False, default=0)
+    count_2 = db.Column(db.Integer, nullable=False, default=0)
+    count_3 = db.Column(db.Integer, nullable=False, default=0)
+    count_4 = db.Column(db.Integer, nullable=False, default=0)
+    count_5 = db.Column(db.Integer, nullable=False, default=0)
+
+    movie = db.relationship("Movie", backref=db.backref("rating_summary", uselist=False))
+
+    def __repr__(self):
+        """Provide helpful representation when printed."""
+
+        s = "<MovieRatingSummary movie_id=%s count=%s score_sum=%s>"
+        return s % (self.movie_id, self.count, self.score_sum)
+
+    def average(self):
+        """Return the mean score, or None if there are no ratings."""
+
+        if self.count:
+            return float(self.score_sum) / self.count
+        else:
+            return None
+
+    def histogram(self):
+        """Return a list of (score, number of ratings) for scores 1-5."""
+
+        return [(score, getattr(self, 'count_%d' % score))
+                for score in SCORES]
+
+    def add_score(self, score, sign=1):
+        """Add (or with sign=-1, remove) one rating's score."""
+
+        self.count += sign
+        self.score_sum += sign * score
+        self.score_squares += sign * score * score
+
+        column = 'count_%d' % score
+        if hasattr(self, column):
+            setattr(self, column, getattr(self, column) + sign)
+
+
+class MovieSimilarity(db.Model):
+    """One of a movie's most similar movies, for item-item predictions."""
+
+    __tablename__ = "movie_similarities"
+
+    movie_id = db.Column(db.Integer, db.ForeignKey('movies.movie_id'), primary_key=True)
+    other_movie_id = db.Column(db.Integer, db.ForeignKey('movies.movie_id'), primary_key=True)
+    similarity = db.Column(db.Float, nullable=False)
+
+    other_movie = db.relationship("Movie", foreign_keys=[other_movie_id])
+
+    def __repr__(self):
+        """Provide helpful representation when printed."""
+
+        s = "<MovieSimilarity movie_id=%s other_movie_id=%s similarity=%s>"
+        return s % (self.movie_id, self.other_movie_id, self.similarity)
+
+
+class Prediction(db.Model):
+    """A precomputed prediction of a user's score for a movie they haven't rated."""
+
+    __tablename__ = "predictions"
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), primary_key=True)
+    movie_id = db.Column(db.Integer, db.ForeignKey('movies.movie_id'), primary_key=True)
+    predicted_score = db.Column(db.Float, nullable=False)
+    computed_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        """Provide helpful representation when printed."""
+
+        s = "<Prediction user_id=%s movie_id=%s predicted_score=%s>"
+        return s % (self.user_id, self.movie_id, self.predicted_score)
+
+
+class RatingChange(db.Model):
+    """One entry in the append-only log of rating changes.
+
+    Every new or changed rating is logged in the same transaction that
+    writes it, so consumers (see changelog.py) can refresh derived data
+    from the log instead of on the request path. There are no foreign
+    keys, so the log outlives the rows it describes.
+    """
+
+    __tablename__ = "rating_changes"
+    __table_args__ = (
+        db.Index('ix_rating_changes_user_id_change_id', 'user_id',
+                 'change_id'),
+        db.Index('ix_rating_changes_movie_id_change_id', 'movie_id',
+                 'change_id'),
+    )
+
+    change_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    movie_id = db.Column(db.Integer, nullable=False)
+    old_score = db.Column(db.Integer, nullable=True)
+    new_score = db.Column(db.Integer, nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        """Provide helpful representation when printed."""
+
+        s = "<RatingChange change_id=%s user_id=%s movie_id=%s %s->%s>"
+        return s % (self.change_id, self.user_id, self.movie_id,
+                    self.old_score, self.new_score)
+
+
+class ConsumerOffset(db.Model):
+    """The last rating change a consumer of the log has processed."""
+
+    __tablename__ = "consumer_offsets"
+
+    name = db.Column(db.String(64), primary_key=True)
+    change_id = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        """Provide helpful representation when printed."""
+
+        return "<ConsumerOffset name=%s change_id=%s>" % (self.name,
+                                                          self.change_id)
+
+
+class ConsumerGap(db.Model):
+    """A change_id below a consumer's offset that it hasn't seen yet."""
+
+    __tablename__ = "consumer_gaps"
+
+    name = db.Column(db.String(64), primary_key=True)
+    change_id = db.Column(db.Integer, primary_key=True)
+    missed_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        """Provide helpful representation when printed."""
+
+        return "<ConsumerGap name=%s change_id=%s>" % (self.name,
+                                                       self.change_id)
+
+
+# The consumer that keeps summaries, stored predictions and the eye's
+# judgments up to date
+DERIVED_DATA_CONSUMER = 'derived'
+
+
 ##############################################################################
 # Helper functions
 
-def connect_to_db(app):
+def is_postgres():
+    """Return whether we're talking to PostgreSQL."""
+
+    return db.engine.dialect.name == 'postgresql'
+
+
+# One round trip: lock and read the user's current scores for the batch,
+# insert or update every row against the unique (user_id, movie_id) index,
+# and return each changed row with its score before and after. The insert
+# reads from "old" so the rows are locked and read before they're written;
+# left until the final SELECT, FOR UPDATE would skip the rows this statement
+# had just updated. Rows that aren't changing are left out up front.
+UPSERT_RATINGS = db.text("""
+    WITH old AS (
+        SELECT movie_id, score FROM ratings
+        WHERE user_id = :user_id AND movie_id = ANY(CAST(:movie_ids AS integer[]))
+        FOR UPDATE
+    ), new AS (
+        INSERT INTO ratings (user_id, movie_id, score)
+        SELECT :user_id, batch.movie_id, batch.score
+        FROM unnest(CAST(:movie_ids AS integer[]),
+                    CAST(:scores AS integer[])) AS batch (movie_id, score)
+        LEFT JOIN old ON old.movie_id = batch.movie_id
+        WHERE old.score IS DISTINCT FROM batch.score
+        ON CONFLICT (user_id, movie_id)
+        DO UPDATE SET score = EXCLUDED.score
+        WHERE ratings.score <> EXCLUDED.score
+        RETURNING movie_id, score
+    )
+    SELECT new.movie_id, old.score, new.score
+    FROM new LEFT JOIN old ON old.movie_id = new.movie_id
+""")
+
+
+def upsert_ratings(user_id, new_scores):
+    """Write a user's scores, returning (movie_id, old_score, new_score) changes.
+
+    new_scores maps movie_id to score. On PostgreSQL this is the single
+    UPSERT_RATINGS statement; elsewhere the existing ratings are read in one
+    query and then updated or added. Unchanged scores aren't reported. The
+    caller is responsible for committing.
+    """
+
+    if not new_scores:
+        return []
+
+    if is_postgres():
+        movie_ids = list(new_scores)
+        rows = db.session.execute(UPSERT_RATINGS, {
+            'user_id': user_id,
+            'movie_ids': movie_ids,
+            'scores': [new_scores[movie_id] for movie_id in movie_ids]})
+        return [tuple(row) for row in rows]
+
+    existing = dict((rating.movie_id, rating) for rating in Rating.query.filter(
+        Rating.user_id == user_id, Rating.movie_id.in_(list(new_scores))))
+    changes = []
+
+    for movie_id, new_score in new_scores.items():
+        rating = existing.get(movie_id)
+
+        if rating:
+            old_score = rating.score
+            rating.score = new_score
+        else:
+            old_score = None
+            db.session.add(Rating(movie_id=movie_id,
+                                  user_id=user_id,
+                                  score=new_score))
+
+        if old_score != new_score:
+            changes.append((movie_id, old_score, new_score))
+
+    return changes
+
+
+@metrics.timed('predict_many')
+def predict_many(user_id, movie_ids):
+    """Predict a user's ratings for many movies at once.
+
+    With PREDICTOR set to 'item', this uses the movie similarity table (see
+    predict_many_from_items), and with 'factors' the trained factor model,
+    where each prediction is one dot product. Otherwise raters' scores are
+    weighted by their similarity to the user. With a neighbor index only
+    the user's k nearest neighbors count, so the cost doesn't grow with a
+    movie's popularity. Returns an array aligned with movie_ids, holding NaN
+    where there is nothing to predict from.
+    """
+
+    if _predictor == 'item':
+        return predict_many_from_items(user_id, movie_ids)
+
+    if _predictor == 'factors' and get_factor_model() is not None:
+        return get_factor_model().predict_many(user_id, movie_ids)
+
+    return get_similarity_engine().predict_many(user_id, movie_ids,
+                                                get_neighbor_index())
+
+
+def predict_many_from_items(user_id, movie_ids):
+    """Predict a user's ratings from their own scores on similar movies.
+
+    Only the user's ratings and the precomputed movie similarity table are
+    needed, not other users' ratings.
+    """
+
+    engine = get_similarity_engine()
+
+    if user_id in engine.user_index:
+        movies, scores = engine.matrix.row(engine.user_index[user_id])
+        rated_movie_ids = [engine.movie_ids[j] for j in movies]
+    else:
+        rated_movie_ids, scores = [], []
+
+    return get_item_neighbors().predict_many(rated_movie_ids, scores,
+                                             movie_ids)
+
+
+def get_stored_prediction(user_id, movie_id):
+    """Return the precomputed prediction for a user and movie, or None."""
+
+    prediction = Prediction.query.get((user_id, movie_id))
+
+    if prediction is None:
+        return None
+    else:
+        return prediction.predicted_score
+
+
+def clear_predictions(user_ids):
+    """Delete the users' precomputed predictions once their ratings change.
+
+    Reads then fall back to live predictions, and the next incremental run
+    of the predictions job recomputes these users. The caller is
+    responsible for committing.
+    """
+
+    Prediction.query.filter(Prediction.user_id.in_(user_ids)).delete(
+        synchronize_session=False)
+
+
+def log_rating_changes(user_id, changes):
+    """Append a user's (movie_id, old_score, new_score) changes to the log.
+
+    The caller is responsible for committing, along with the ratings.
+    """
+
+    if not changes:
+        return
+
+    changed_at = datetime.datetime.now()
+    db.session.execute(RatingChange.__table__.insert(), [
+        {'user_id': user_id, 'movie_id': movie_id, 'old_score': old_score,
+         'new_score': new_score, 'changed_at': changed_at}
+        for movie_id, old_score, new_score in changes])
+
+
+def latest_change_id(user_id=None, movie_id=None):
+    """Return the id of the newest logged rating change, or 0.
+
+    Given user_id or movie_id, only that user's or movie's changes count.
+    """
+
+    query = db.session.query(db.func.max(RatingChange.change_id))
+
+    if user_id is not None:
+        query = query.filter(RatingChange.user_id == user_id)
+    if movie_id is not None:
+        query = query.filter(RatingChange.movie_id == movie_id)
+
+    return query.scalar() or 0
+
+
+# Change ids are handed out before transactions commit, so a change can
+# commit after a later one has been read. Readers remember the ids missing
+# below their position and look for them again, until GAP_TIMEOUT seconds
+# have passed and the transaction that took the id must have rolled back.
+GAP_TIMEOUT = 600
+
+
+class ChangeCursor(object):
+    """A position in the rating change log that doesn't skip late commits.
+
+    change_id is the newest change read. gaps maps each id below it that
+    hasn't been read yet to when it was first missed.
+    """
+
+    def __init__(self, change_id=0, gaps=None):
+        self.change_id = change_id
+        self.gaps = dict(gaps or {})
+
+    @classmethod
+    def at(cls, change_id, window=1000):
+        """Return a cursor at change_id, missing whatever isn't visible yet.
+
+        Ids among the window just below change_id that no committed change
+        holds yet become gaps, so they're read once their transactions
+        commit.
+        """
+
+        first = max(change_id - window, 0) + 1
+        visible = set(visible_id for visible_id, in
+                      db.session.query(RatingChange.change_id).filter(
+                          RatingChange.change_id >= first,
+                          RatingChange.change_id <= change_id))
+
+        now = datetime.datetime.now()
+        return cls(change_id, dict((missing, now) for missing in
+                                   range(first, change_id + 1)
+                                   if missing not in visible))
+
+    def read(self, limit=None, settled=None):
+        """Return the changes after the cursor or in its gaps, in log order.
+
+        Changes logged after settled (a datetime), if given, are left for
+        next time.
+        """
+
+        unread = RatingChange.change_id > self.change_id
+        if self.gaps:
+            unread = db.or_(unread,
+                            RatingChange.change_id.in_(sorted(self.gaps)))
+
+        query = RatingChange.query.filter(unread)
+        if settled is not None:
+            query = query.filter(RatingChange.changed_at <= settled)
+
+        return query.order_by(RatingChange.change_id).limit(limit).all()
+
+    def advance(self, changes, now=None):
+        """Move past changes (as read), noting the ids they skipped.
+
+        Returns whether the cursor moved or its gaps changed.
+        """
+
+        now = now or datetime.datetime.now()
+        before = (self.change_id, sorted(self.gaps))
+
+        previous = self.change_id
+        for change in changes:
+            self.gaps.pop(change.change_id, None)
+
+            if change.change_id > previous:
+                for missing in range(previous + 1, change.change_id):
+                    self.gaps[missing] = now
+                previous = change.change_id
+
+        self.change_id = previous
+
+        timeout = datetime.timedelta(seconds=GAP_TIMEOUT)
+        self.gaps = dict((change_id, missed_at)
+                         for change_id, missed_at in self.gaps.items()
+                         if now - missed_at < timeout)
+
+        return (self.change_id, sorted(self.gaps)) != before
+
+
+def get_consumer_cursor(name):
+    """Return the named consumer's ChangeCursor, with the gaps it saved."""
+
+    gaps = dict((gap.change_id, gap.missed_at)
+                for gap in ConsumerGap.query.filter_by(name=name))
+
+    return ChangeCursor(get_consumer_offset(name), gaps)
+
+
+def set_consumer_cursor(name, cursor):
+    """Save the named consumer's ChangeCursor.
+
+    The caller is responsible for committing, along with whatever the
+    consumer derived from the changes it read.
+    """
+
+    set_consumer_offset(name, cursor.change_id)
+    ConsumerGap.query.filter_by(name=name).delete(synchronize_session=False)
+
+    if cursor.gaps:
+        db.session.execute(ConsumerGap.__table__.insert(), [
+            {'name': name, 'change_id': change_id, 'missed_at': missed_at}
+            for change_id, missed_at in sorted(cursor.gaps.items())])
+
+
+def get_consumer_offset(name):
+    """Return the last change_id the named consumer processed, or 0."""
+
+    offset = ConsumerOffset.query.get(name)
+    return offset.change_id if offset is not None else 0
+
+
+def set_consumer_offset(name, change_id):
+    """Record that the named consumer has processed up to change_id.
+
+    The caller is responsible for committing, along with whatever the
+    consumer derived from those changes.
+    """
+
+    db.session.merge(ConsumerOffset(name=name, change_id=change_id))
+
+
+def update_movie_rating_summary(movie_id, old_score, new_score):
+    """Fold a new or changed score into the movie's rating summary.
+
+    The caller is responsible for committing.
+    """
+
+    update_movie_rating_summaries([(movie_id, old_score, new_score)])
+
+
+def update_movie_rating_summaries(changes):
+    """Fold (movie_id, old_score, new_score) changes into rating summaries.
+
+    Every summary involved is read in one query. The caller is responsible
+    for committing.
+    """
+
+    movie_ids = set(movie_id for movie_id, old_score, new_score in changes)
+    if not movie_ids:
+        return
+
+    summaries = dict((summary.movie_id, summary) for summary in
+                     MovieRatingSummary.query.filter(
+                         MovieRatingSummary.movie_id.in_(list(movie_ids))))
+
+    for movie_id, old_score, new_score in changes:
+        summary = summaries.get(movie_id)
+
+        if summary is None:
+            summary = MovieRatingSummary(movie_id=movie_id, count=0,
+                                         score_sum=0, score_squares=0,
+                                         count_1=0, count_2=0, count_3=0,
+                                         count_4=0, count_5=0)
+            summaries[movie_id] = summary
+            db.session.add(summary)
+
+        if old_score is not None:
+            summary.add_score(old_score, sign=-1)
+        summary.add_score(new_score)
+
+
+def rebuild_movie_rating_summaries():
+    """Recompute every movie's rating summary in one grouped query."""
+
+    refresh_movie_rating_summaries()
+    db.session.commit()
+
+
+def refresh_movie_rating_summaries(movie_ids=None):
+    """Recompute the summaries of movie_ids (default: every movie).
+
+    Unlike update_movie_rating_summaries, this reads the ratings
+    themselves, so it's right however many times it runs. The caller is
+    responsible for committing.
+    """
+
+    summaries = MovieRatingSummary.query
+    columns = [Rating.movie_id,
+               db.func.count(Rating.rating_id),
+               db.func.sum(Rating.score),
+               db.func.sum(Rating.score * Rating.score)]
+    columns.extend(db.func.sum(db.case([(Rating.score == score, 1)], else_=0))
+                   for score in SCORES)
+    totals = db.session.query(*columns)
+
+    if movie_ids is not None:
+        movie_ids = list(movie_ids)
+        summaries = summaries.filter(
+            MovieRatingSummary.movie_id.in_(movie_ids))
+        totals = totals.filter(Rating.movie_id.in_(movie_ids))
+
+    summaries.delete(synchronize_session=False)
+
+    names = ['movie_id', 'count', 'score_sum', 'score_squares']
+    names.extend('count_%d' % score for score in SCORES)
+
+    db.session.execute(MovieRatingSummary.__table__.insert().from_select(
+        names, totals.group_by(Rating.movie_id)))
+
+
+_ratings_matrix = None
+_similarity_engine = None
+
+# Where the in-memory ratings are in the rating change log, and the users
+# whose ratings were replayed onto a snapshot's
+_ratings_cursor = None
+_replayed_user_ids = set()
+
+
+def get_ratings_matrix():
+    """Return the shared in-memory ratings matrix, loading it on first use.
+
+    It's mapped from the current snapshot when there is one, with the
+    rating changes logged since the snapshot was built replayed onto it,
+    and otherwise read from the database.
+    """
+
+    global _ratings_matrix, _ratings_cursor
+
+    if _ratings_matrix is None:
+        current = get_snapshot()
+
+        if current is not None:
+            loaded_at = datetime.datetime.now()
+            _ratings_cursor = ChangeCursor(
+                current.change_id,
+                dict((gap, loaded_at) for gap in current.gaps))
+            _ratings_matrix = current.ratings_matrix()
+
+            for user_id, movie_ids, scores in read_new_scores(_ratings_matrix):
+                _ratings_matrix.set_scores(user_id, movie_ids, scores)
+                _replayed_user_ids.add(user_id)
+        else:
+            _ratings_cursor = ChangeCursor.at(latest_change_id())
+            rows = db.session.query(Rating.user_id, Rating.movie_id,
+                                    Rating.score)
+            _ratings_matrix = RatingsMatrix.from_rows(rows)
+
+    return _ratings_matrix
+
+
+def read_new_scores(matrix):
+    """Read the changes logged after _ratings_cursor, and move past them.
+
+    Returns (user_id, movie_ids, scores) for each user with a score that
+    matrix doesn't hold yet, so a process's own writes aren't repeated.
+    """
+
+    changes = _ratings_cursor.read()
+    _ratings_cursor.advance(changes)
+
+    # The latest score for each user's movies, in log order
+    latest = {}
+    for change in changes:
+        latest.setdefault(change.user_id, {})[change.movie_id] = \
+            change.new_score
+
+    new_scores = []
+
+    for user_id, scores in sorted(latest.items()):
+        if user_id in matrix.user_index:
+            movies, held = matrix.row(matrix.user_index[user_id])
+            held = dict((matrix.movie_ids[j], score)
+                        for j, score in zip(movies, held))
+            scores = dict((movie_id, score) for movie_id, score
+                          in scores.items() if held.get(movie_id) != score)
+
+        if scores:
+            new_scores.append((user_id, scores.keys(), scores.values()))
+
+    return new_scores
+
+
+def catch_up_ratings():
+    """Apply rating changes logged by other processes since the last look.
+
+    Does nothing until the ratings are loaded, or more often than every
+    RATINGS_CATCH_UP_INTERVAL seconds. Returns the ids of users whose
+    ratings changed.
+    """
+
+    global _ratings_caught_up_at
+
+    now = time.time()
+    if (_ratings_matrix is None or
+            now - _ratings_caught_up_at < _ratings_catch_up_interval):
+        return []
+
+    _ratings_caught_up_at = now
+
+    new_scores = read_new_scores(_ratings_matrix)
+    for user_id, movie_ids, scores in new_scores:
+        apply_user_scores(user_id, movie_ids, scores)
+
+    return [user_id for user_id, movie_ids, scores in new_scores]
+
+
+def apply_user_scores(user_id, movie_ids, scores):
+    """Bring the in-memory ratings, caches and neighbors up to date.
+
+    Call after user_id's scores for movie_ids changed to scores.
+    """
+
+    engine = get_similarity_engine()
+    engine.set_scores(user_id, movie_ids, scores)
+    cache.ratings_versions.bump(user_id, engine.movies_rated_by(user_id))
+    fold_in_user(user_id)
+
+    index = get_neighbor_index()
+    if index is not None:
+        cache.ratings_versions.touch(index.refresh_user(user_id))
+
+
+def get_similarity_engine():
+    """Return the shared similarity engine over the ratings matrix."""
+
+    global _similarity_engine
+
+    if _similarity_engine is None:
+        _similarity_engine = similarity.SimilarityEngine(get_ratings_matrix())
+
+    return _similarity_engine
+
+
+_neighbor_index = None
+_neighbor_count = None
+_neighbor_index_path = None
+_neighbor_search = 'exact'
+_lsh_tables = None
+_lsh_bits = None
+_item_neighbors = None
+_predictor = 'user'
+_factors_dir = None
+_factor_model = None
+
+
+def get_neighbor_index():
+    """Return the shared neighbor index, or None if neighbors are disabled.
+
+    With NEIGHBOR_SEARCH set to 'lsh', this is an approximate LSHIndex,
+    built in memory. Otherwise the exact index is mapped from the current
+    snapshot if that has one for k, read from NEIGHBOR_INDEX_PATH when it
+    was built for the current users and k, and computed from scratch
+    otherwise.
+    """
+
+    global _neighbor_index
+
+    if _neighbor_count is None:
+        return None
+
+    if _neighbor_index is None and _neighbor_search == 'lsh':
+        _neighbor_index = LSHIndex(get_similarity_engine(), _neighbor_count,
+                                   _lsh_tables, _lsh_bits)
+
+    if _neighbor_index is None:
+        engine = get_similarity_engine()
+        mapped = (get_snapshot() and
+                  get_snapshot().neighbor_index(engine, _neighbor_count))
+
+        # The snapshot's neighbors predate the ratings replayed onto it
+        if mapped:
+            for user_id in sorted(_replayed_user_ids):
+                mapped.refresh_user(user_id)
+
+        _neighbor_index = (mapped or
+                           NeighborIndex.load(_neighbor_index_path, engine,
+                                              _neighbor_count) or
+                           NeighborIndex(engine, _neighbor_count))
+
+    return _neighbor_index
+
+
+def add_user_to_index(user_id):
+    """Add a newly created user to the ratings matrix and neighbor index."""
+
+    engine = get_similarity_engine()
+    engine.set_scores(user_id, [], [])
+
+    index = get_neighbor_index()
+    if index is not None:
+        cache.ratings_versions.touch(index.refresh_user(user_id))
+
+
+def get_item_neighbors():
+    """Return the movie similarity table, loading it on first use."""
+
+    global _item_neighbors
+
+    if _item_neighbors is None:
+        rows = db.session.query(MovieSimilarity.movie_id,
+                                MovieSimilarity.other_movie_id,
+                                MovieSimilarity.similarity)
+        _item_neighbors = ItemNeighbors(rows)
+
+    return _item_neighbors
+
+
+def get_factor_model():
+    """Return the newest trained factor model, or None if there isn't one."""
+
+    global _factor_model
+
+    if _factor_model is None and _factors_dir is not None:
+        _factor_model = FactorModel.load_latest(_factors_dir)
+
+    return _factor_model
+
+
+def fold_in_user(user_id):
+    """Refit a user's factors to their current ratings, if factors are in use."""
+
+    model = get_factor_model() if _predictor == 'factors' else None
+    if model is None:
+        return
+
+    engine = get_similarity_engine()
+    if user_id in engine.user_index:
+        movies, scores = engine.matrix.row(engine.user_index[user_id])
+        model.fold_in(user_id, [engine.movie_ids[j] for j in movies], scores)
+
+
+_snapshot_dir = None
+_snapshot = None
+_snapshot_check_interval = 5
+_snapshot_checked_at = 0
+_ratings_catch_up_interval = 5
+_ratings_caught_up_at = 0
+
+
+def get_snapshot():
+    """Return the mapped current snapshot, or None if there isn't one."""
+
+    global _snapshot
+
+    if _snapshot is None and _snapshot_dir is not None:
+        path = snapshot.current_snapshot(_snapshot_dir)
+        if path is not None:
+            _snapshot = snapshot.Snapshot(path)
+
+    return _snapshot
+
+
+def check_snapshot():
+    """Switch to a newly published snapshot, if there is one.
+
+    The current link is looked at no more than every
+    SNAPSHOT_CHECK_INTERVAL seconds. On a switch the in-memory ratings state
+    and caches are dropped, so they're rebuilt from the new snapshot and
+    the rating changes logged since it was built.
+    """
+
+    global _snapshot, _snapshot_checked_at
+
+    now = time.time()
+    if (_snapshot_dir is None or
+            now - _snapshot_checked_at < _snapshot_check_interval):
+        return
+
+    _snapshot_checked_at = now
+
+    path = snapshot.current_snapshot(_snapshot_dir)
+    if path is None or (_snapshot is not None and path == _snapshot.path):
+        return
+
+    _snapshot = snapshot.Snapshot(path)
+    reload_ratings()
+    cache.reset()
+
+
+def reload_ratings():
+    """Drop the in-memory ratings state so it's rebuilt on next use."""
+
+    global _ratings_matrix, _similarity_engine, _neighbor_index
+    global _item_neighbors, _factor_model, _ratings_cursor
+
+    _ratings_matrix = None
+    _ratings_cursor = None
+    _replayed_user_ids.clear()
+    _similarity_engine = None
+    _neighbor_index = None
+    _item_neighbors = None
+    _factor_model = None
+
+
+def connect_to_db(app, db_uri='postgresql:///ratings'):
     """Connect the database to our Flask app."""
 
     # Configure to use our PstgreSQL database
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///ratings'
-    app.config['SQLALCHEMY_ECHO'] = True
+    app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
+    # Logging every statement slows every request, so only the debug
+    # server does it unless SQLALCHEMY_ECHO says otherwise
+    app.config.setdefault('SQLALCHEMY_ECHO', app.debug)
+    app.config.setdefault('CACHE_MAX_SIZE', 10000)
+    app.config.setdefault('CACHE_TTL', 3600)
+    app.config.setdefault('NEIGHBOR_COUNT', 50)
+    app.config.setdefault('NEIGHBOR_INDEX_PATH', 'neighbors.npz')
+    app.config.setdefault('NEIGHBOR_SEARCH', 'exact')
+    app.config.setdefault('LSH_TABLES', 16)
+    app.config.setdefault('LSH_BITS', 6)
+    app.config.setdefault('EYE_JUDGMENT_PATH', 'eye.npz')
+    app.config.setdefault('PREDICTOR', 'user')
+    app.config.setdefault('ITEM_NEIGHBOR_COUNT', 50)
+    app.config.setdefault('FACTORS_DIR', 'factors')
+    app.config.setdefault('ALL_PAIRS_DIR', 'all_pairs')
+    app.config.setdefault('ALL_PAIRS_MEMORY_MB', 1024)
+    app.config.setdefault('SNAPSHOT_DIR', None)
+    app.config.setdefault('SNAPSHOT_CHECK_INTERVAL', 5)
+    app.config.setdefault('RATINGS_CATCH_UP_INTERVAL', 5)
     # app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
     db.app = app
     db.init_app(app)
 
+    cache.configure(app.config['CACHE_MAX_SIZE'], app.config['CACHE_TTL'])
+
+    global _neighbor_count, _neighbor_index_path, _predictor, _factors_dir
+    global _snapshot_dir, _snapshot_check_interval, _ratings_catch_up_interval
+    global _neighbor_search, _lsh_tables, _lsh_bits
+    _neighbor_count = app.config['NEIGHBOR_COUNT']
+    _neighbor_index_path = app.config['NEIGHBOR_INDEX_PATH']
+    _neighbor_search = app.config['NEIGHBOR_SEARCH']
+    _lsh_tables = app.config['LSH_TABLES']
+    _lsh_bits = app.config['LSH_BITS']
+    _predictor = app.config['PREDICTOR']
+    _factors_dir = app.config['FACTORS_DIR']
+    _snapshot_dir = app.config['SNAPSHOT_DIR']
+    _snapshot_check_interval = app.config['SNAPSHOT_CHECK_INTERVAL']
+    _ratings_catch_up_interval = app.config['RATINGS_CATCH_UP_INTERVAL']
+
 
 if __name__ == "__main__":
     # As a convenience, if we run this module interactively, it will leave
@@ -0,0 +1,186 @@
+"""Top-k most similar users for each user."""
+
+import os
+import zipfile
+
+import numpy as np
+
+
+class NeighborIndex(object):
+    """The k most similar users for every user in a SimilarityEngine.
+
+    Neighbors are stored as two user x k arrays aligned with the engine's
+    user indexes: the neighbors' indexes and their similarities.
+    """
+
+    def __init__(self, engine, k, indexes=None, sims=None):
+        self.engine = engine
+        self.k = k
+        self.dirty = set()
+
+        if indexes is None:
+            self.build()
+        else:
+            self.indexes = indexes
+            self.sims = sims
+
+    def build(self):
+        """Compute every user's neighbors from the all-pairs matrix."""
+
+        all_sims = self.engine.all_similarities()
+        np.fill_diagonal(all_sims, -np.inf)
+
+        self.indexes = np.empty((len(all_sims), self._width()), dtype=int)
+        self.sims = np.empty(self.indexes.shape)
+
+        for i, row in enumerate(all_sims):
+            self.indexes[i], self.sims[i] = self._top_k(row)
+
+        self.dirty = set()
+
+    def _width(self):
+        """Return how many neighbors each user gets."""
+
+        return max(min(self.k, len(self.engine.user_ids) - 1), 0)
+
+    def _top_k(self, row):
+        """Return (indexes, sims) of the k largest entries of row."""
+
+        width = self._width()
+        top = np.argpartition(-row, width - 1)[:width] if width else []
+        return top, row[top]
+
+    def neighbors(self, user_id):
+        """Return (user indexes, sims) of user_id's nearest neighbors."""
+
+        if user_id not in self.engine.user_index:
+            return np.array([], dtype=int), np.array([])
+
+        i = self.engine.user_index[user_id]
+        self._grow()
+
+        if i in self.dirty:
+            self._recompute(i)
+
+        return self.indexes[i], self.sims[i]
+
+    def _recompute(self, i):
+        """Recompute one user's neighbors from their similarity row."""
+
+        self._own_arrays()
+        row = self.engine.similarities(self.engine.user_ids[i])
+        row[i] = -np.inf
+        self.indexes[i], self.sims[i] = self._top_k(row)
+        self.dirty.discard(i)
+
+    def _grow(self):
+        """Add rows for users the engine has gained since the last build."""
+
+        if self.indexes.shape[1] != self._width():
+            self.build()
+            return
+
+        missing = len(self.engine.user_ids) - len(self.indexes)
+
+        if missing > 0:
+            first = len(self.indexes)
+            width = self.indexes.shape[1]
+            self.indexes = np.vstack([self.indexes,
+                                      np.zeros((missing, width), dtype=int)])
+            self.sims = np.vstack([self.sims,
+                                   np.full((missing, width), -np.inf)])
+            self.dirty.update(range(first, first + missing))
+
+    def _own_arrays(self):
+        """Copy the arrays before changing them if they're read-only."""
+
+        if not self.indexes.flags.writeable:
+            self.indexes = np.array(self.indexes)
+            self.sims = np.array(self.sims)
+
+    def refresh_user(self, user_id):
+        """Bring the index up to date after user_id's ratings changed.
+
+        user_id's own row is recomputed. Every other row is patched with
+        its new similarity to user_id: added if it now makes the top k,
+        updated in place if it was already there and rose, and marked for
+        recomputation if it fell (since someone else may now outrank it).
+        Returns the ids of users whose neighbors changed.
+        """
+
+        self._grow()
+
+        # A lone user has no neighbors, and there are no rows to patch
+        if not self._width():
+            return [user_id]
+
+        self._own_arrays()
+
+        i = self.engine.user_index[user_id]
+        new_sims = self.engine.similarities(user_id)
+
+        contains = self.indexes == i
+        was_neighbor = contains.any(axis=1)
+        positions = contains.argmax(axis=1)
+        rows = np.arange(len(self.indexes))
+
+        old_sims = self.sims[rows, positions]
+        rose = was_neighbor & (new_sims >= old_sims)
+        fell = was_neighbor & ~rose
+        self.sims[rose, positions[rose]] = new_sims[rose]
+
+        worst = self.sims.argmin(axis=1)
+        entered = ~was_neighbor & (new_sims > self.sims[rows, worst])
+        entered[i] = False
+        self.indexes[entered, worst[entered]] = i
+        self.sims[entered, worst[entered]] = new_sims[entered]
+
+        self.dirty.update(np.flatnonzero(fell))
+        self._recompute(i)
+
+        changed = np.flatnonzero(rose | fell | entered)
+        return [user_id] + [self.engine.user_ids[j] for j in changed]
+
+    def save(self, path):
+        """Write the index to an .npz file, replacing it all at once."""
+
+        for i in list(self.dirty):
+            self._recompute(i)
+
+        temporary = '%s.%d.tmp' % (path, os.getpid())
+        with open(temporary, 'wb') as f:
+            np.savez(f, k=self.k, user_ids=np.array(self.engine.user_ids),
+                     indexes=self.indexes, sims=self.sims)
+        os.rename(temporary, path)
+
+    @classmethod
+    def load(cls, path, engine, k):
+        """Read an index saved for engine's users, or None if it won't fit.
+
+        A missing or unreadable file doesn't fit either.
+        """
+
+        try:
+            with np.load(path) as npz:
+                saved = dict((name, npz[name]) for name in npz.files)
+        except (IOError, ValueError, KeyError, zipfile.BadZipfile):
+            return None
+
+        if (int(saved['k']) != k or
+                list(saved['user_ids']) != list(engine.user_ids)):
+            return None
+
+        return cls(engine, k, indexes=saved['indexes'], sims=saved['sims'])
+
+
+if __name__ == "__main__":
+    # Rebuild the saved index from the ratings in the database.
+
+    from server import app
+    from model import connect_to_db, get_similarity_engine
+
+    connect_to_db(app)
+
+    index = NeighborIndex(get_similarity_engine(), app.config['NEIGHBOR_COUNT'])
+    index.save(app.config['NEIGHBOR_INDEX_PATH'])
+    print "Saved neighbors for %d users" % len(index.indexes)
@@ -0,0 +1,97 @@
+"""Keyset (cursor) pagination for SQLAlchemy queries."""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import namedtuple
+import json
+
+from sqlalchemy import tuple_
+
+Page = namedtuple('Page', ['items', 'prev_cursor', 'next_cursor'])
+
+
+class InvalidCursor(ValueError):
+    """A cursor that didn't come from encode_cursor for these keys."""
+
+
+def paginate(query, keys, after=None, before=None, page_size=50):
+    """Return one page of query, ordered by the columns in keys.
+
+    Rather than an OFFSET, the page starts just past a cursor holding the
+    sort keys of the row on the edge of the previous page, so fetching any
+    page costs the same however deep it is. keys must identify rows
+    uniquely. after and before are cursors from an earlier Page; one that
+    isn't raises InvalidCursor.
+    """
+
+    after = decode_cursor(after, len(keys))
+    before = decode_cursor(before, len(keys))
+
+    if before is not None:
+        query = query.filter(_past(keys, before, backwards=True))
+        query = query.order_by(*[key.desc() for key in keys])
+    else:
+        if after is not None:
+            query = query.filter(_past(keys, after))
+        query = query.order_by(*keys)
+
+    items = query.limit(page_size + 1).all()
+    more = len(items) > page_size
+    items = items[:page_size]
+
+    if before is not None:
+        items.reverse()
+        has_prev, has_next = more, True
+    else:
+        has_prev, has_next = after is not None, more
+
+    def cursor_for(item):
+        return encode_cursor([getattr(item, key.key) for key in keys])
+
+    prev_cursor = cursor_for(items[0]) if items and has_prev else None
+    next_cursor = cursor_for(items[-1]) if items and has_next else None
+
+    return Page(items, prev_cursor, next_cursor)
+
+
+def _past(keys, values, backwards=False):
+    """Return a filter for rows whose keys sort after (or before) values.
+
+    Several keys are compared as one row value, (a, b) > (x, y), which
+    PostgreSQL can start an index range scan on; the equivalent
+    a > x OR (a = x AND b > y) makes it scan from the start of the index.
+    """
+
+    if len(keys) == 1:
+        key, value = keys[0], values[0]
+    else:
+        key, value = tuple_(*keys), tuple_(*values)
+
+    return key < value if backwards else key > value
+
+
+def encode_cursor(values):
+    """Return an opaque, URL-safe cursor for a row's sort keys."""
+
+    return urlsafe_b64encode(json.dumps(values))
+
+
+def decode_cursor(cursor, size):
+    """Return the size sort keys in a cursor, or None if it's missing.
+
+    Raises InvalidCursor unless the cursor holds a list of size scalars.
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        values = json.loads(urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidCursor(cursor)
+
+    if not isinstance(values, list) or len(values) != size or not all(
+            value is None or isinstance(value, (basestring, int, long, float))
+            for value in values):
+        raise InvalidCursor(cursor)
+
+    return values
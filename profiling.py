@@ -0,0 +1,158 @@
+"""Opt-in profiling of individual requests, and a report across them.
+
+With PROFILE_DIR set, a request is run under cProfile when it carries the
+PROFILE_HEADER header with PROFILE_TOKEN as its value or when it's picked
+at random at PROFILE_SAMPLE_RATE. Without a PROFILE_TOKEN the header is
+ignored, so clients can't have any request they like profiled. Stats are
+written in pstats format to PROFILE_DIR/<route>/, and the response names
+the file in the same header. Requests that aren't picked run without a
+profiler.
+
+Running this module merges the saved profiles by route and prints the
+costliest functions, optionally writing the merged stats for viewers such
+as snakeviz or flameprof:
+
+    python profiling.py profiles --route movies --output movies.prof
+"""
+
+import cProfile
+import hmac
+import itertools
+import os
+import pstats
+import random
+import re
+import time
+
+from flask import g, request
+
+_sequence = itertools.count()
+
+
+def install(app):
+    """Profile the requests that app's PROFILE_* settings pick."""
+
+    app.before_request(lambda: _start_profile(app.config))
+    app.after_request(lambda response: _name_profile(app.config, response))
+    app.teardown_request(lambda exception: _save_profile())
+
+
+def route_directory(rule):
+    """Return the directory name profiles of a URL rule are saved under."""
+
+    return re.sub(r'[^A-Za-z0-9]+', '_', rule).strip('_') or 'root'
+
+
+def _as_bytes(value, encoding):
+    """Return value as bytes, or None if it can't be encoded."""
+
+    if not isinstance(value, unicode):
+        return value
+
+    try:
+        return value.encode(encoding)
+    except UnicodeError:
+        return None
+
+
+def _picked(config):
+    # Headers arrive decoded as latin-1, or as the raw bytes under some
+    # servers; compare them as the bytes sent
+    header = _as_bytes(request.headers.get(config['PROFILE_HEADER']),
+                       'latin-1')
+
+    token = _as_bytes(config['PROFILE_TOKEN'], 'utf-8')
+
+    if token is not None and header is not None and hmac.compare_digest(
+            header, token):
+        return True
+
+    return random.random() < config['PROFILE_SAMPLE_RATE']
+
+
+def _start_profile(config):
+    if config['PROFILE_DIR'] is None or not _picked(config):
+        return
+
+    rule = request.url_rule.rule if request.url_rule else 'unmatched'
+    directory = os.path.join(config['PROFILE_DIR'], route_directory(rule))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    g.profile_path = os.path.join(directory, '%d-%d-%d.prof' % (
+        time.time() * 1000, os.getpid(), next(_sequence)))
+    g.profiler = cProfile.Profile()
+    g.profiler.enable()
+
+
+def _name_profile(config, response):
+    if getattr(g, 'profiler', None) is not None:
+        response.headers[config['PROFILE_HEADER']] = \
+            os.path.basename(g.profile_path)
+
+    return response
+
+
+def _save_profile():
+    # Runs after failed requests too, which are worth a look
+    profiler = getattr(g, 'profiler', None)
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(g.profile_path)
+        g.profiler = None
+
+
+def aggregate(directory, route=None):
+    """Merge saved profiles by route.
+
+    Returns {route directory: (number of profiles, pstats.Stats)} for the
+    route directories whose names contain route (default: all of them).
+    """
+
+    merged = {}
+
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not os.path.isdir(path) or (route and route not in name):
+            continue
+
+        files = [os.path.join(path, profile)
+                 for profile in sorted(os.listdir(path))
+                 if profile.endswith('.prof')]
+
+        if files:
+            merged[name] = (len(files), pstats.Stats(*files))
+
+    return merged
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Merge saved request profiles by route and report them.")
+    parser.add_argument('directory', help="the app's PROFILE_DIR")
+    parser.add_argument('--route', help="only routes whose directory name "
+                                        "contains this")
+    parser.add_argument('--sort', default='cumulative',
+                        help="pstats sort key (default: cumulative)")
+    parser.add_argument('--limit', type=int, default=25,
+                        help="functions to print per route")
+    parser.add_argument('--output', help="also write the merged stats here, "
+                                         "when one route matches")
+    args = parser.parse_args()
+
+    merged = aggregate(args.directory, args.route)
+
+    for name in sorted(merged):
+        count, stats = merged[name]
+        print "=== %s: %d requests, %.3fs per request" % (
+            name, count, stats.total_tt / count)
+        stats.sort_stats(args.sort).print_stats(args.limit)
+
+    if args.output:
+        if len(merged) != 1:
+            parser.error("--output needs --route to match exactly one route "
+                         "(matched %d)" % len(merged))
+        merged.values()[0][1].dump_stats(args.output)
@@ -0,0 +1,512 @@
+"""Compact in-memory user x movie ratings matrix."""
+
+import hashlib
+
+import numpy as np
+
+
+class RatingsMatrix(object):
+    """Every rating, held as int8 scores in compressed sparse arrays.
+
+    The ratings are stored twice: by user (CSR, for a user's ratings) and by
+    movie (CSC, for a movie's raters). Users and movies are addressed by
+    index; user_ids/movie_ids and user_index/movie_index map between ids
+    and indexes. Per-user and per-movie counts and score sums are kept so
+    means are O(1).
+
+    When the CSR and CSC arrays are read-only, as when they're mapped from
+    a snapshot that several processes share, changed users' rows and
+    movies' columns are kept whole in row_overlay and col_overlay instead,
+    and read in place of the mapped ones. The next snapshot absorbs them.
+    """
+
+    # Every array attribute, as saved in a snapshot
+    ARRAYS = ['row_ptr', 'row_movies', 'row_scores',
+              'col_ptr', 'col_users', 'col_scores',
+              'row_counts', 'row_sums', 'col_counts', 'col_sums']
+
+    def __init__(self, user_ids, movie_ids, scores):
+        """Build the matrix from parallel arrays of ids and scores.
+
+        If a (user, movie) pair appears more than once, the last score wins.
+        """
+
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        scores = np.asarray(scores, dtype=np.int8)
+
+        self.user_ids = sorted(set(user_ids.tolist()))
+        self.movie_ids = sorted(set(movie_ids.tolist()))
+        self.user_index = dict((user_id, i)
+                               for i, user_id in enumerate(self.user_ids))
+        self.movie_index = dict((movie_id, j)
+                                for j, movie_id in enumerate(self.movie_ids))
+
+        rows = np.searchsorted(self.user_ids, user_ids)
+        cols = np.searchsorted(self.movie_ids, movie_ids)
+
+        # Keep only the last score for each cell
+        cells = rows * max(len(self.movie_ids), 1) + cols
+        last = len(cells) - 1 - np.unique(cells[::-1], return_index=True)[1]
+        rows, cols, scores = rows[last], cols[last], scores[last]
+
+        self._build(rows, cols, scores)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build the matrix from (user_id, movie_id, score) rows."""
+
+        rows = list(rows)
+        if not rows:
+            return cls([], [], [])
+
+        user_ids, movie_ids, scores = zip(*rows)
+        return cls(user_ids, movie_ids, scores)
+
+    @classmethod
+    def from_file(cls, path, separator='\t'):
+        """Build the matrix from a MovieLens u.data style file."""
+
+        data = np.loadtxt(path, delimiter=separator, usecols=(0, 1, 2),
+                          dtype=np.int64, ndmin=2)
+        return cls(data[:, 0], data[:, 1], data[:, 2])
+
+    @classmethod
+    def from_arrays(cls, user_ids, movie_ids, arrays):
+        """Wrap existing arrays (named as in ARRAYS) without copying them.
+
+        The arrays may be read-only, as when they're mapped from a
+        snapshot; rating changes then go in the overlays.
+        """
+
+        matrix = cls.__new__(cls)
+
+        matrix.user_ids = list(user_ids)
+        matrix.movie_ids = list(movie_ids)
+        matrix.user_index = dict((user_id, i)
+                                 for i, user_id in enumerate(matrix.user_ids))
+        matrix.movie_index = dict((movie_id, j) for j, movie_id
+                                  in enumerate(matrix.movie_ids))
+
+        for name in cls.ARRAYS:
+            setattr(matrix, name, arrays[name])
+
+        matrix.row_overlay = {}
+        matrix.col_overlay = {}
+
+        return matrix
+
+    def _build(self, rows, cols, scores):
+        """Lay out (row, col, score) triples as CSR and CSC arrays."""
+
+        num_users = len(self.user_ids)
+        num_movies = len(self.movie_ids)
+
+        by_row = np.lexsort((cols, rows))
+        self.row_ptr = _pointers(rows, num_users)
+        self.row_movies = cols[by_row].astype(np.int32)
+        self.row_scores = scores[by_row]
+
+        by_col = np.lexsort((rows, cols))
+        self.col_ptr = _pointers(cols, num_movies)
+        self.col_users = rows[by_col].astype(np.int32)
+        self.col_scores = scores[by_col]
+
+        # With no ratings, bincount gives integer sums even with weights,
+        # and set_scores can't add float changes to those
+        self.row_counts = np.bincount(rows, minlength=num_users)
+        self.row_sums = np.bincount(rows, weights=scores,
+                                    minlength=num_users).astype(float)
+        self.col_counts = np.bincount(cols, minlength=num_movies)
+        self.col_sums = np.bincount(cols, weights=scores,
+                                    minlength=num_movies).astype(float)
+
+        self.row_overlay = {}
+        self.col_overlay = {}
+
+    def transposed(self):
+        """Return a movie x user copy of the matrix, sharing its arrays.
+
+        Rows become movies and columns users, so anything written for users
+        (like SimilarityEngine) can be run over movies instead. The copy
+        doesn't see later set_score calls.
+        """
+
+        view = RatingsMatrix.__new__(RatingsMatrix)
+
+        view.user_ids = list(self.movie_ids)
+        view.movie_ids = list(self.user_ids)
+        view.user_index = dict(self.movie_index)
+        view.movie_index = dict(self.user_index)
+        view.row_ptr, view.col_ptr = self.col_ptr, self.row_ptr
+        view.row_movies, view.col_users = self.col_users, self.row_movies
+        view.row_scores, view.col_scores = self.col_scores, self.row_scores
+        view.row_counts, view.col_counts = self.col_counts, self.row_counts
+        view.row_sums, view.col_sums = self.col_sums, self.row_sums
+        view.row_overlay = dict(self.col_overlay)
+        view.col_overlay = dict(self.row_overlay)
+
+        return view
+
+    @property
+    def nnz(self):
+        """Return the number of ratings."""
+
+        return int(self.row_counts.sum())
+
+    @property
+    def shape(self):
+        return len(self.user_ids), len(self.movie_ids)
+
+    def row(self, i):
+        """Return (movie indexes, scores) of user i's ratings."""
+
+        return _group(self.row_ptr, self.row_movies, self.row_scores,
+                      self.row_overlay, i)
+
+    def column(self, j):
+        """Return (user indexes, scores) of movie j's ratings."""
+
+        return _group(self.col_ptr, self.col_users, self.col_scores,
+                      self.col_overlay, j)
+
+    def gather_rows(self, rows):
+        """Return the ratings of several users as flat arrays.
+
+        Returns (owners, movie indexes, scores), where owners[n] is the
+        position in rows of the user who gave rating n.
+        """
+
+        return _gather(self.row_ptr, self.row_movies, self.row_scores,
+                       self.row_overlay, rows)
+
+    def gather_columns(self, cols):
+        """Return the ratings of several movies as flat arrays.
+
+        Returns (owners, user indexes, scores), where owners[n] is the
+        position in cols of the movie that got rating n.
+        """
+
+        return _gather(self.col_ptr, self.col_users, self.col_scores,
+                       self.col_overlay, cols)
+
+    def arrays(self):
+        """Return every array named in ARRAYS, with the overlays merged in."""
+
+        if not self.row_overlay:
+            return dict((name, getattr(self, name)) for name in self.ARRAYS)
+
+        arrays = {'row_counts': self.row_counts, 'row_sums': self.row_sums,
+                  'col_counts': self.col_counts, 'col_sums': self.col_sums}
+
+        owners, arrays['row_movies'], arrays['row_scores'] = \
+            self.gather_rows(np.arange(len(self.user_ids)))
+        arrays['row_ptr'] = _pointers(owners, len(self.user_ids))
+
+        owners, arrays['col_users'], arrays['col_scores'] = \
+            self.gather_columns(np.arange(len(self.movie_ids)))
+        arrays['col_ptr'] = _pointers(owners, len(self.movie_ids))
+
+        return arrays
+
+    def user_mean(self, i):
+        """Return user i's mean score, or None if they haven't rated."""
+
+        if self.row_counts[i]:
+            return self.row_sums[i] / self.row_counts[i]
+        else:
+            return None
+
+    def user_means(self):
+        """Return every user's mean score (0 for users with no ratings)."""
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = self.row_sums / self.row_counts
+
+        means[self.row_counts == 0] = 0
+        return means
+
+    def movie_mean(self, j):
+        """Return movie j's mean score, or None if it hasn't been rated."""
+
+        if self.col_counts[j]:
+            return self.col_sums[j] / self.col_counts[j]
+        else:
+            return None
+
+    def co_rated(self, i, k):
+        """Return aligned score arrays for the movies users i and k both rated."""
+
+        movies_i, scores_i = self.row(i)
+        movies_k, scores_k = self.row(k)
+
+        common = np.intersect1d(movies_i, movies_k, assume_unique=True)
+
+        return (scores_i[np.searchsorted(movies_i, common)],
+                scores_k[np.searchsorted(movies_k, common)])
+
+    def to_dense(self):
+        """Return dense float (scores, rated) user x movie matrices."""
+
+        return self.dense_rows(0, len(self.user_ids))
+
+    def dense_rows(self, start, stop, dtype=float):
+        """Return dense (scores, rated) matrices for user indexes start:stop."""
+
+        scores = np.zeros((stop - start, len(self.movie_ids)), dtype=dtype)
+        rated = np.zeros(scores.shape, dtype=dtype)
+
+        # Rows past the end of the CSR arrays are all in the overlay
+        end = max(min(stop, len(self.row_ptr) - 1), start)
+        first, last = self.row_ptr[start], self.row_ptr[end]
+        rows = np.repeat(np.arange(end - start),
+                         np.diff(self.row_ptr[start:end + 1]))
+        scores[rows, self.row_movies[first:last]] = self.row_scores[first:last]
+        rated[rows, self.row_movies[first:last]] = 1
+
+        for i, (movies, row_scores) in self.row_overlay.items():
+            if start <= i < stop:
+                scores[i - start] = 0
+                rated[i - start] = 0
+                scores[i - start, movies] = row_scores
+                rated[i - start, movies] = 1
+
+        return scores, rated
+
+    def set_score(self, user_id, movie_id, score):
+        """Record a new or changed rating."""
+
+        self.set_scores(user_id, [movie_id], [score])
+
+    def set_scores(self, user_id, movie_ids, scores):
+        """Record many new or changed ratings by one user.
+
+        Changed scores are updated in place. New ratings are inserted into
+        the CSR and CSC arrays all at once, which costs one copy of each
+        however many there are. movie_ids must not repeat. If the arrays
+        are read-only, the changed row and columns go in the overlays.
+        """
+
+        if not self.row_movies.flags.writeable:
+            self._set_overlay_scores(user_id, movie_ids, scores)
+            return
+
+        if user_id not in self.user_index:
+            self.user_index[user_id] = len(self.user_ids)
+            self.user_ids.append(user_id)
+            self.row_ptr = np.append(self.row_ptr, self.row_ptr[-1])
+            self.row_counts = np.append(self.row_counts, 0)
+            self.row_sums = np.append(self.row_sums, 0)
+
+        for movie_id in movie_ids:
+            if movie_id not in self.movie_index:
+                self.movie_index[movie_id] = len(self.movie_ids)
+                self.movie_ids.append(movie_id)
+                self.col_ptr = np.append(self.col_ptr, self.col_ptr[-1])
+                self.col_counts = np.append(self.col_counts, 0)
+                self.col_sums = np.append(self.col_sums, 0)
+
+        i = self.user_index[user_id]
+        cols = np.array([self.movie_index[movie_id] for movie_id in movie_ids],
+                        dtype=int)
+        scores = np.asarray(scores, dtype=self.row_scores.dtype)
+
+        order = np.argsort(cols)
+        cols = cols[order]
+        scores = scores[order]
+
+        start, end = self.row_ptr[i], self.row_ptr[i + 1]
+        row_pos = start + np.searchsorted(self.row_movies[start:end], cols)
+        col_pos = np.array([self.col_ptr[j] + np.searchsorted(
+            self.col_users[self.col_ptr[j]:self.col_ptr[j + 1]], i)
+            for j in cols], dtype=int)
+
+        exists = np.zeros(len(cols), dtype=bool)
+        inside = row_pos < end
+        exists[inside] = self.row_movies[row_pos[inside]] == cols[inside]
+
+        changes = (scores[exists].astype(float) -
+                   self.row_scores[row_pos[exists]])
+        self.row_scores[row_pos[exists]] = scores[exists]
+        self.col_scores[col_pos[exists]] = scores[exists]
+        self.row_sums[i] += changes.sum()
+        self.col_sums[cols[exists]] += changes
+
+        new = ~exists
+        if not new.any():
+            return
+
+        self.row_movies = np.insert(self.row_movies, row_pos[new], cols[new])
+        self.row_scores = np.insert(self.row_scores, row_pos[new], scores[new])
+        self.row_ptr[i + 1:] += new.sum()
+        self.col_users = np.insert(self.col_users, col_pos[new], i)
+        self.col_scores = np.insert(self.col_scores, col_pos[new], scores[new])
+        self.col_ptr[1:] += np.cumsum(np.bincount(cols[new],
+                                                  minlength=len(self.movie_ids)))
+
+        self.row_counts[i] += new.sum()
+        self.row_sums[i] += scores[new].sum()
+        self.col_counts[cols[new]] += 1
+        self.col_sums[cols[new]] += scores[new]
+
+    def _set_overlay_scores(self, user_id, movie_ids, scores):
+        """set_scores for read-only arrays: copy only what changes."""
+
+        # The counts and sums are one number per user or movie, so small
+        for name in ['row_counts', 'row_sums', 'col_counts', 'col_sums']:
+            if not getattr(self, name).flags.writeable:
+                setattr(self, name, np.array(getattr(self, name)))
+
+        if user_id not in self.user_index:
+            self.user_index[user_id] = len(self.user_ids)
+            self.user_ids.append(user_id)
+            self.row_counts = np.append(self.row_counts, 0)
+            self.row_sums = np.append(self.row_sums, 0)
+
+        for movie_id in movie_ids:
+            if movie_id not in self.movie_index:
+                self.movie_index[movie_id] = len(self.movie_ids)
+                self.movie_ids.append(movie_id)
+                self.col_counts = np.append(self.col_counts, 0)
+                self.col_sums = np.append(self.col_sums, 0)
+
+        i = self.user_index[user_id]
+        movies, row_scores = self.row(i)
+        row = dict(zip(movies.tolist(), row_scores.tolist()))
+
+        for movie_id, score in zip(movie_ids, scores):
+            j = self.movie_index[movie_id]
+            score = int(score)
+            old_score = row.get(j)
+            row[j] = score
+
+            users, col_scores = self.column(j)
+            at = np.searchsorted(users, i)
+
+            if old_score is None:
+                self.row_counts[i] += 1
+                self.col_counts[j] += 1
+                self.row_sums[i] += score
+                self.col_sums[j] += score
+                self.col_overlay[j] = (
+                    np.insert(users, at, i).astype(self.col_users.dtype),
+                    np.insert(col_scores, at, score).astype(
+                        self.col_scores.dtype))
+            else:
+                self.row_sums[i] += score - old_score
+                self.col_sums[j] += score - old_score
+                col_scores = np.array(col_scores)
+                col_scores[at] = score
+                self.col_overlay[j] = (users, col_scores)
+
+        movies = sorted(row)
+        self.row_overlay[i] = (
+            np.array(movies, dtype=self.row_movies.dtype),
+            np.array([row[j] for j in movies], dtype=self.row_scores.dtype))
+
+    def fingerprint(self):
+        """Return a hash of every rating, for spotting stale data.
+
+        The ids and (user_id, movie_id, score) triples are hashed in id
+        order, so matrices holding the same ratings agree however they were
+        built.
+        """
+
+        user_ids = np.array(self.user_ids, dtype=np.int64)
+        movie_ids = np.array(self.movie_ids, dtype=np.int64)
+        user_order = np.argsort(user_ids, kind='mergesort')
+        rows, movies, scores = self.gather_rows(user_order)
+
+        rating_users = user_ids[user_order][rows]
+        rating_movies = movie_ids[movies]
+
+        # Within a row, ratings are in movie index order, which is only id
+        # order until a new movie is appended
+        if np.any(np.diff(movie_ids) < 0):
+            order = np.lexsort((rating_movies, rating_users))
+            rating_users = rating_users[order]
+            rating_movies = rating_movies[order]
+            scores = scores[order]
+
+        digest = hashlib.sha1()
+        for array in (np.sort(user_ids), np.sort(movie_ids), rating_users,
+                      rating_movies, scores.astype(np.int8)):
+            digest.update(np.ascontiguousarray(array).tostring())
+
+        return "%d-%s" % (self.nnz, digest.hexdigest())
+
+
+def _pointers(indexes, length):
+    """Return CSR-style offsets for sorted groups of indexes."""
+
+    pointers = np.zeros(length + 1, dtype=np.int64)
+    np.cumsum(np.bincount(indexes, minlength=length), out=pointers[1:])
+    return pointers
+
+
+def _group(pointers, indexes, values, overlay, group):
+    """Return (indexes, values) of one CSR group, or its overlay."""
+
+    if group in overlay:
+        return overlay[group]
+
+    # Users or movies added since the arrays were built have no group
+    if group + 1 >= len(pointers):
+        return indexes[:0], values[:0]
+
+    start, end = pointers[group], pointers[group + 1]
+    return indexes[start:end], values[start:end]
+
+
+def _gather(pointers, indexes, values, overlay, groups):
+    """Return (owners, indexes, values) of several groups, as flat arrays.
+
+    Groups in the overlay are read from there, the rest from the CSR
+    arrays, keeping groups in the order given.
+    """
+
+    if not overlay:
+        owners, positions = gather_groups(pointers, groups)
+        return owners, indexes[positions], values[positions]
+
+    groups = np.asarray(groups, dtype=np.int64)
+    patched = np.in1d(groups, np.fromiter(overlay, dtype=np.int64,
+                                          count=len(overlay)))
+    kept = np.flatnonzero(~patched)
+
+    lengths = np.zeros(len(groups), dtype=np.int64)
+    lengths[kept] = pointers[groups[kept] + 1] - pointers[groups[kept]]
+    for n in np.flatnonzero(patched):
+        lengths[n] = len(overlay[groups[n]][0])
+    offsets = np.cumsum(lengths) - lengths
+
+    gathered_indexes = np.empty(lengths.sum(), dtype=indexes.dtype)
+    gathered_values = np.empty(lengths.sum(), dtype=values.dtype)
+
+    owners, positions = gather_groups(pointers, groups[kept])
+    slots = (offsets[kept][owners] + positions -
+             pointers[groups[kept]][owners])
+    gathered_indexes[slots] = indexes[positions]
+    gathered_values[slots] = values[positions]
+
+    for n in np.flatnonzero(patched):
+        group_indexes, group_values = overlay[groups[n]]
+        gathered_indexes[offsets[n]:offsets[n] + lengths[n]] = group_indexes
+        gathered_values[offsets[n]:offsets[n] + lengths[n]] = group_values
+
+    return (np.repeat(np.arange(len(groups)), lengths), gathered_indexes,
+            gathered_values)
+
+
+def gather_groups(pointers, groups):
+    """Return (owners, positions) of every entry in the given groups."""
+
+    groups = np.asarray(groups, dtype=np.int64)
+    starts = pointers[groups]
+    lengths = pointers[groups + 1] - starts
+
+    owners = np.repeat(np.arange(len(groups)), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths,
+                                                   lengths)
+
+    return owners, starts[owners] + offsets
@@ -1,93 +1,422 @@
 """Utility file to seed ratings database from MovieLens data in seed_data/"""
 
+from contextlib import contextmanager
+from io import BytesIO, StringIO
 from sqlalchemy import func
+from sqlalchemy.engine.reflection import Inspector
 from model import User
 from model import Rating
 from model import Movie
-
-from model import connect_to_db, db
+from model import MovieSimilarity
+from model import Prediction
+from model import RatingChange, DERIVED_DATA_CONSUMER
+from model import latest_change_id, set_consumer_offset
+from model import get_similarity_engine, get_neighbor_index
+from model import get_item_neighbors, get_factor_model, predict_many
+
+from model import connect_to_db, db, rebuild_movie_rating_summaries
+from model import is_postgres
 from server import app
+import argparse
+import csv
 import datetime
+import itertools
+import math
+import multiprocessing
+import os
+import sys
+import time
+import numpy as np
+from similarity import SimilarityEngine
+from ratings_matrix import RatingsMatrix
+from all_pairs import AllPairs
+from item_similarity import movie_neighbor_rows
+
+# Each MovieLens release names and lays out its files differently. These are
+# the (file name, field separator) pairs we read from each; a separator of
+# None means the file is CSV with a header row.
+FORMATS = [
+    {'name': '100k', 'encoding': 'latin-1',
+     'users': ('u.user', '|'),
+     'movies': ('u.item', '|'),
+     'ratings': ('u.data', '\t')},
+    {'name': '1m', 'encoding': 'latin-1',
+     'users': ('users.dat', '::'),
+     'movies': ('movies.dat', '::'),
+     'ratings': ('ratings.dat', '::')},
+    {'name': '10m', 'encoding': 'latin-1',
+     'users': None,
+     'movies': ('movies.dat', '::'),
+     'ratings': ('ratings.dat', '::')},
+    {'name': '20m', 'encoding': 'utf-8',
+     'users': None,
+     'movies': ('movies.csv', None),
+     'ratings': ('ratings.csv', None)},
+]
+
+
+def find_format(data_dir):
+    """Return the first MovieLens format whose files are all in data_dir.
+
+    1M and 10M share file names, but only 1M has a user file.
+    """
+
+    for data_format in FORMATS:
+        files = [data_format[kind] for kind in ['users', 'movies', 'ratings']
+                 if data_format[kind]]
+        if all(os.path.exists(os.path.join(data_dir, filename))
+               for filename, separator in files):
+            return data_format
+
+    raise IOError("No MovieLens ratings file found in %s" % data_dir)
+
+
+def read_rows(data_dir, data_format, kind):
+    """Stream the split fields of each line of one of the format's files."""
+
+    filename, separator = data_format[kind]
+    encoding = data_format['encoding']
+
+    with open(os.path.join(data_dir, filename)) as data_file:
+        if separator is None:
+            lines = csv.reader(data_file)
+            next(lines)  # Skip the header
+        else:
+            lines = (line.rstrip('\r\n').split(separator)
+                     for line in data_file)
+
+        for fields in lines:
+            yield [field.decode(encoding) for field in fields]
+
+
+def parse_title(title_with_year):
+    """Return a movie's title without the year in parentheses."""
+
+    title_pieces = title_with_year.split("(")
+    return title_pieces[0].rstrip()
+
+
+def parse_score(score):
+    """Return a whole-star score; half-star ratings round up."""
+
+    return int(math.ceil(float(score)))
+
+
+def clear_table(table):
+    """Delete every row in a table, and rows in tables that depend on it."""
+
+    if is_postgres():
+        db.session.execute("TRUNCATE %s CASCADE" % table.name)
+    else:
+        db.session.execute(table.delete())
+
+
+def bulk_insert(table, columns, rows, batch_size, label):
+    """Insert rows (tuples matching columns) into table in batches.
+
+    PostgreSQL gets each batch through COPY; other databases get a
+    multi-row insert. Progress and throughput are printed per batch.
+    """
+
+    started = time.time()
+    total = 0
+
+    for batch in chunks(rows, batch_size):
+        if is_postgres():
+            copy_rows(table, columns, batch)
+        else:
+            db.session.execute(table.insert(),
+                               [dict(zip(columns, row)) for row in batch])
+
+        total += len(batch)
+        elapsed = max(time.time() - started, 1e-6)
+        print "  %s: %d rows, %d rows/sec" % (label, total, total / elapsed)
+
+    db.session.commit()
+    return total
+
+
+def chunks(rows, size):
+    """Yield lists of up to size items from an iterable."""
+
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
 
-def load_users():
-    """Load users from u.user into database."""
+
+def copy_rows(table, columns, batch):
+    """Send a batch of rows to PostgreSQL with COPY ... FROM STDIN."""
+
+    buf = StringIO()
+    for row in batch:
+        buf.write(u"\t".join(copy_value(value) for value in row))
+        buf.write(u"\n")
+
+    buf = BytesIO(buf.getvalue().encode('utf-8'))
+
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert("COPY %s (%s) FROM STDIN" % (table.name,
+                                                   ", ".join(columns)), buf)
+
+
+def copy_value(value):
+    """Format one value for COPY's text format."""
+
+    if value is None:
+        return u"\\N"
+
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+
+    return (unicode(value).replace(u"\\", u"\\\\").replace(u"\t", u"\\t")
+            .replace(u"\n", u"\\n").replace(u"\r", u"\\r"))
+
+
+@contextmanager
+def constraints_deferred(table):
+    """Drop a table's secondary indexes and foreign keys while loading it.
+
+    They're put back afterwards, so each is built once over the loaded
+    data rather than maintained row by row.
+    """
+
+    connection = db.session.connection()
+    inspector = Inspector.from_engine(connection)
+
+    existing = set(index['name'] for index in inspector.get_indexes(table.name))
+    indexes = [index for index in table.indexes if index.name in existing]
+    foreign_keys = []
+    if is_postgres():
+        foreign_keys = inspector.get_foreign_keys(table.name)
+
+    for index in indexes:
+        index.drop(bind=connection)
+    for foreign_key in foreign_keys:
+        connection.execute("ALTER TABLE %s DROP CONSTRAINT %s"
+                           % (table.name, foreign_key['name']))
+
+    yield
+
+    connection = db.session.connection()
+    for index in indexes:
+        index.create(bind=connection)
+    for foreign_key in foreign_keys:
+        connection.execute(
+            "ALTER TABLE %s ADD CONSTRAINT %s FOREIGN KEY (%s) "
+            "REFERENCES %s (%s)" % (table.name, foreign_key['name'],
+                                    ", ".join(foreign_key['constrained_columns']),
+                                    foreign_key['referred_table'],
+                                    ", ".join(foreign_key['referred_columns'])))
+    db.session.commit()
+
+
+def load_users(data_dir, data_format, batch_size):
+    """Load users from the user file into database."""
 
     print "Users"
 
     # Delete all rows in table, so if we need to run this a second time,
     # we won't be trying to add duplicate users
-    User.query.delete()
+    clear_table(User.__table__)
 
-    # Read u.user file and insert data
-    for row in open("seed_data/u.user"):
-        row = row.rstrip()
-        user_id, age, gender, occupation, zipcode = row.split("|")
+    # Releases without a user file get their users from the ratings instead
+    if not data_format['users']:
+        return
 
-        user = User(user_id=user_id,
-                    age=age,
-                    zipcode=zipcode)
+    def parse(fields):
+        if data_format['name'] == '100k':
+            user_id, age, gender, occupation, zipcode = fields
+        else:
+            user_id, gender, age, occupation, zipcode = fields
+        return int(user_id), int(age), zipcode
 
-        # We need to add to the session or it won't ever be stored
-        db.session.add(user)
+    rows = (parse(fields)
+            for fields in read_rows(data_dir, data_format, 'users'))
+    bulk_insert(User.__table__, ['user_id', 'age', 'zipcode'], rows,
+                batch_size, "Users")
 
-    # Once we're done, we should commit our work
-    db.session.commit()
 
+def load_users_from_ratings():
+    """Create a bare user for every user_id in ratings without one."""
 
-def load_movies():
-    """Load movies from u.item into database."""
+    print "Users from ratings"
+
+    db.session.execute(
+        User.__table__.insert().from_select(
+            ['user_id'],
+            db.session.query(Rating.user_id).distinct().filter(
+                ~Rating.user_id.in_(db.session.query(User.user_id)))))
+    db.session.commit()
 
-    print "Movies"
 
-    Movie.query.delete()
+def load_movies(data_dir, data_format, batch_size):
+    """Load movies from the movie file into database."""
 
-    for row in open("seed_data/u.item"):
-        row = row.rstrip()
-        movie_data = row.split("|")
+    print "Movies"
 
-        title_with_year = movie_data[1]
-        title_pieces = title_with_year.split("(")
-        title = title_pieces[0].rstrip()
+    clear_table(Movie.__table__)
 
+    def parse(fields):
+        if data_format['name'] == '100k':
+            movie_id, title_with_year, released_str, video, imdb_url = fields[:5]
+        else:
+            movie_id, title_with_year = fields[:2]
+            released_str = imdb_url = ''
 
-        released_str = movie_data[2]
         if released_str:
             # make safer
             released_at = datetime.datetime.strptime(released_str, "%d-%b-%Y")
         else:
             released_at = None
 
-        movie = Movie(movie_id=movie_data[0], 
-                      title=title, 
-                      released_at=released_at, 
-                      imdb_url=movie_data[4])
-
-        db.session.add(movie)
+        return int(movie_id), parse_title(title_with_year), released_at, imdb_url
 
-    db.session.commit()
+    rows = (parse(fields)
+            for fields in read_rows(data_dir, data_format, 'movies'))
+    bulk_insert(Movie.__table__,
+                ['movie_id', 'title', 'released_at', 'imdb_url'], rows,
+                batch_size, "Movies")
 
 
-def load_ratings():
-    """Load ratings from u.data into database."""
+def load_ratings(data_dir, data_format, batch_size):
+    """Load ratings from the ratings file into database."""
 
     print "Ratings"
 
-    Rating.query.delete()
+    clear_table(Rating.__table__)
 
-    for row in open("seed_data/u.data"):
-        row = row.rstrip()
+    rows = ((int(fields[0]), int(fields[1]), parse_score(fields[2]))
+            for fields in read_rows(data_dir, data_format, 'ratings'))
 
-        user_id, movie_id, score, timestamp = row.split("\t")
+    with constraints_deferred(Rating.__table__):
+        bulk_insert(Rating.__table__, ['user_id', 'movie_id', 'score'], rows,
+                    batch_size, "Ratings")
 
-        rating = Rating(user_id=user_id,
-                        movie_id=movie_id,
-                        score=score)
+        if not data_format['users']:
+            load_users_from_ratings()
 
-        db.session.add(rating)
+    log_loaded_ratings()
+    rebuild_movie_rating_summaries()
 
+
+def log_loaded_ratings():
+    """Append every rating just loaded to the rating change log."""
+
+    columns = db.session.query(Rating.user_id, Rating.movie_id,
+                               db.literal(None), Rating.score,
+                               db.literal(datetime.datetime.now()))
+
+    db.session.execute(RatingChange.__table__.insert().from_select(
+        ['user_id', 'movie_id', 'old_score', 'new_score', 'changed_at'],
+        columns))
     db.session.commit()
 
 
+def load_movie_similarities(batch_size):
+    """Compute each movie's most similar movies for item-item predictions."""
+
+    print "Movie similarities"
+
+    clear_table(MovieSimilarity.__table__)
+
+    rows = db.session.query(Rating.user_id, Rating.movie_id, Rating.score)
+    matrix = RatingsMatrix.from_rows(rows)
+
+    bulk_insert(MovieSimilarity.__table__,
+                ['movie_id', 'other_movie_id', 'similarity'],
+                movie_neighbor_rows(matrix, app.config['ITEM_NEIGHBOR_COUNT']),
+                batch_size, "Movie similarities")
+
+
+def save_neighbor_index():
+    """Rebuild the saved top-k neighbor index for the freshly loaded ratings."""
+
+    if app.config['NEIGHBOR_COUNT'] is None:
+        return
+
+    print "Neighbors"
+
+    rows = db.session.query(Rating.user_id, Rating.movie_id, Rating.score)
+    engine = SimilarityEngine(RatingsMatrix.from_rows(rows))
+
+    all_pairs = AllPairs(engine.matrix, app.config['ALL_PAIRS_DIR'],
+                         app.config['NEIGHBOR_COUNT'],
+                         app.config['ALL_PAIRS_MEMORY_MB'] * 2 ** 20)
+    all_pairs.run()
+    all_pairs.neighbor_index(engine).save(app.config['NEIGHBOR_INDEX_PATH'])
+
+
+def load_predictions(batch_size, processes, incremental=False):
+    """Precompute every user's predictions for the movies they haven't rated.
+
+    Users are sharded across a pool of worker processes, which inherit the
+    ratings (and neighbor index, movie similarities or factors) loaded here
+    before the pool starts. With incremental, only users with no stored
+    predictions are computed: new users, and those whose predictions were
+    cleared because their ratings changed since the last run.
+    """
+
+    print "Predictions"
+
+    engine = get_similarity_engine()
+    get_neighbor_index()
+    if app.config['PREDICTOR'] == 'item':
+        get_item_neighbors()
+    elif app.config['PREDICTOR'] == 'factors':
+        get_factor_model()
+
+    user_ids = engine.user_ids
+
+    if incremental:
+        done = set(user_id for user_id,
+                   in db.session.query(Prediction.user_id).distinct())
+        user_ids = [user_id for user_id in user_ids if user_id not in done]
+    else:
+        clear_table(Prediction.__table__)
+        db.session.commit()
+
+    # Don't let the workers share this process's database connections
+    db.session.remove()
+    db.engine.dispose()
+
+    computed_at = datetime.datetime.now()
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        shards = pool.imap_unordered(predict_users, chunks(user_ids, 20))
+        rows = ((user_id, movie_id, score, computed_at)
+                for shard in shards
+                for user_id, movie_id, score in shard)
+
+        bulk_insert(Prediction.__table__,
+                    ['user_id', 'movie_id', 'predicted_score', 'computed_at'],
+                    rows, batch_size, "Predictions")
+    finally:
+        pool.close()
+        pool.join()
+
+
+def predict_users(user_ids):
+    """Return (user_id, movie_id, prediction) for each user's unrated movies."""
+
+    engine = get_similarity_engine()
+    rows = []
+
+    for user_id in user_ids:
+        rated = set(engine.movies_rated_by(user_id))
+        candidates = [movie_id for movie_id in engine.movie_ids
+                      if movie_id not in rated]
+        predictions = predict_many(user_id, candidates)
+
+        rows.extend((user_id, candidates[i], float(predictions[i]))
+                    for i in np.flatnonzero(~np.isnan(predictions)))
+
+    return rows
+
+
 def set_val_user_id():
     """Set value for the next user_id after seeding database"""
 
@@ -102,13 +431,64 @@ def set_val_user_id():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('command', nargs='?', default='all',
+                        choices=['all', 'summaries', 'similar-movies',
+                                 'predictions'],
+                        help="'summaries' just repairs the movie rating "
+                             "summaries; 'similar-movies' just rebuilds the "
+                             "movie similarity table; 'predictions' just "
+                             "refills the predictions table")
+    parser.add_argument('--data-dir', default='seed_data',
+                        help="directory holding a MovieLens 100k, 1M, 10M "
+                             "or 20M release")
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help="rows per insert batch")
+    parser.add_argument('--skip-similarity', action='store_true',
+                        help="don't build the neighbor index and movie "
+                             "similarities, which need dense user x user and "
+                             "movie x movie matrices")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="worker processes for the predictions job "
+                             "(default: one per CPU)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only compute predictions for users who have "
+                             "none stored")
+    args = parser.parse_args()
+
     connect_to_db(app)
+    app.config['SQLALCHEMY_ECHO'] = False
 
     # In case tables haven't been created, create them
     db.create_all()
 
+    if args.command == 'summaries':
+        rebuild_movie_rating_summaries()
+        sys.exit()
+
+    if args.command == 'similar-movies':
+        load_movie_similarities(args.batch_size)
+        sys.exit()
+
+    if args.command == 'predictions':
+        load_predictions(args.batch_size, args.processes, args.incremental)
+        sys.exit()
+
+    data_format = find_format(args.data_dir)
+    print "Loading MovieLens %s from %s" % (data_format['name'], args.data_dir)
+
     # Import different types of data
-    load_users()
-    load_movies()
-    load_ratings()
+    load_users(args.data_dir, data_format, args.batch_size)
+    load_movies(args.data_dir, data_format, args.batch_size)
+    load_ratings(args.data_dir, data_format, args.batch_size)
+
+    if not args.skip_similarity:
+        save_neighbor_index()
+        load_movie_similarities(args.batch_size)
+
+    # Everything derived was just built from scratch, so the change log's
+    # consumer can skip the load
+    set_consumer_offset(DERIVED_DATA_CONSUMER, latest_change_id())
+    db.session.commit()
+
     set_val_user_id()
@@ -1,11 +1,28 @@
 """Movie Ratings."""
 
+import csv
+
 from jinja2 import StrictUndefined
 
 from flask import Flask, render_template, redirect, request, flash, session
+from flask import jsonify
 from flask_debugtoolbar import DebugToolbarExtension
 
-from model import connect_to_db, db, User, Rating, Movie
+import cache
+import metrics
+import profiling
+from model import connect_to_db, db, User, Rating, Movie, MovieSimilarity
+from model import SCORES
+from model import get_ratings_matrix
+from model import get_factor_model
+from model import add_user_to_index
+from model import check_snapshot, catch_up_ratings, apply_user_scores
+from model import update_movie_rating_summaries
+from model import get_stored_prediction, clear_predictions, upsert_ratings
+from model import log_rating_changes, latest_change_id
+from model import MovieRatingSummary, Prediction
+from eye import get_eye
+from pagination import paginate, InvalidCursor
 
 from sqlalchemy.orm.exc import NoResultFound
 
@@ -19,6 +36,33 @@ app.secret_key = "ABC"
 # error.
 app.jinja_env.undefined = StrictUndefined
 
+# Rows per page on the users, movies and movie ratings lists
+app.config['PAGE_SIZE'] = 50
+
+# Most ratings accepted by one /ratings/bulk request
+app.config['MAX_BULK_RATINGS'] = 10000
+
+# Seconds a proxy may serve /api responses before revalidating
+app.config['API_MAX_AGE'] = 60
+
+# Who updates rating summaries when ratings change: 'inline' while saving
+# them, or 'consumer' for the changelog.py process reading the rating
+# change log. Stored predictions are deleted inline either way, and the
+# consumer computes them again.
+app.config['DERIVED_UPDATES'] = 'inline'
+
+# Per-route request timings and SQL counts, served at /metrics
+metrics.instrument(app)
+
+# Save a cProfile of requests to PROFILE_DIR (None turns this off): those
+# sent with a PROFILE_HEADER header matching PROFILE_TOKEN (never, if it's
+# None), and a random PROFILE_SAMPLE_RATE fraction of the rest
+app.config['PROFILE_DIR'] = None
+app.config['PROFILE_HEADER'] = 'X-Profile'
+app.config['PROFILE_TOKEN'] = None
+app.config['PROFILE_SAMPLE_RATE'] = 0
+profiling.install(app)
+
 ALERT_TYPES = {
     'blue': 'info',
     'red': 'danger',
@@ -26,6 +70,8 @@ ALERT_TYPES = {
     'green': 'success'
 }
 
+MAX_RECOMMENDATIONS = 100
+
 BERATEMENT_MESSAGES = [
         "I suppose you don't have such bad taste after all.",
         "I regret every decision that I've ever made that has " +
@@ -37,6 +83,18 @@ BERATEMENT_MESSAGES = [
     ]
 
 
+@app.before_request
+def pick_up_snapshot():
+    """Keep the in-memory ratings current before each request.
+
+    A newly published snapshot is swapped in, and ratings other processes
+    have written since are applied.
+    """
+
+    check_snapshot()
+    catch_up_ratings()
+
+
 @app.route('/')
 def index():
     """Homepage."""
@@ -48,8 +106,8 @@ def index():
 def users():
     """Show list of user."""
 
-    users = User.query.all()
-    return render_template("users.html", users=users)
+    page = paginate(User.query, [User.user_id], **page_args())
+    return render_template("users.html", users=page.items, page=page)
 
 
 @app.route('/users/<user_id>')
@@ -59,12 +117,48 @@ def user_profile(user_id):
     user = get_user_by_id(user_id)
 
     if user:
-        return render_template("user_profile.html", user=user)
+        ratings = get_ratings_with_titles(user.user_id)
+        return render_template("user_profile.html", user=user, ratings=ratings)
     else:
         flash_message('That user does not exist.', ALERT_TYPES['red'])
         return redirect('/')
 
 
+def get_ratings_with_titles(user_id):
+    """Return (movie_id, title, score) rows for a user's ratings in one query."""
+
+    return (db.session.query(Rating.movie_id, Movie.title, Rating.score)
+            .join(Rating.movie)
+            .filter(Rating.user_id == user_id)
+            .order_by(Rating.rating_id)
+            .all())
+
+
+@app.route('/users/<user_id>/recommendations')
+def user_recommendations(user_id):
+    """Show the movies a user is predicted to like most."""
+
+    user = get_user_by_id(user_id)
+
+    if not user:
+        flash_message('That user does not exist.', ALERT_TYPES['red'])
+        return redirect('/')
+
+    n = min(request.args.get('n', 10, type=int), MAX_RECOMMENDATIONS)
+    recommendations = user.recommend(max(n, 1))
+
+    movies = Movie.query.filter(
+        Movie.movie_id.in_([movie_id for movie_id, score in recommendations]))
+    movies_by_id = dict((movie.movie_id, movie) for movie in movies)
+
+    recommendations = [(movies_by_id[movie_id], safe_round(score))
+                       for movie_id, score in recommendations]
+
+    return render_template("recommendations.html",
+                           user=user,
+                           recommendations=recommendations)
+
+
 def get_user_by_id(user_id):
     """Return a user, given a user_id."""
 
@@ -78,9 +172,9 @@ def get_user_by_id(user_id):
 def movies():
     """Show list of movies."""
 
-    movies = Movie.query.order_by('title').all()
+    page = paginate(Movie.query, [Movie.title, Movie.movie_id], **page_args())
 
-    return render_template("movies.html", movies=movies)
+    return render_template("movies.html", movies=page.items, page=page)
 
 
 @app.route('/movies/<movie_id>')
@@ -102,19 +196,64 @@ def movie_details(movie_id):
             prediction = get_prediction_of_user_rating(movie)
 
     avg_rating = get_average_rating_for_movie(movie)
+    histogram = get_rating_histogram_for_movie(movie)
     effective_rating = get_effective_rating(prediction, user_rating)
     eye_rating = get_eye_rating(movie)
     beratement = fetch_insult(effective_rating, eye_rating)
 
+    page = paginate(Rating.query.filter_by(movie_id=movie.movie_id),
+                    [Rating.rating_id], **page_args())
+
     return render_template("movie_details.html",
                            movie=movie,
-                           ratings=movie.ratings,
+                           ratings=page.items,
+                           page=page,
                            prediction=prediction,
                            average=avg_rating,
+                           histogram=histogram,
                            eye_rating=eye_rating,
                            beratement=beratement)
 
 
+@app.route('/movies/<movie_id>/similar')
+def similar_movies(movie_id):
+    """Show the movies most similar to a movie."""
+
+    movie = get_movie_by_id(movie_id)
+    if not movie:
+        flash_message("This movie doesn't exist yet.", ALERT_TYPES['red'])
+        return redirect('/movies')
+
+    similar = (db.session.query(Movie, MovieSimilarity.similarity)
+               .select_from(MovieSimilarity)
+               .join(MovieSimilarity.other_movie)
+               .filter(MovieSimilarity.movie_id == movie.movie_id)
+               .order_by(MovieSimilarity.similarity.desc())
+               .all())
+
+    return render_template("similar_movies.html",
+                           movie=movie,
+                           similar=similar)
+
+
+def page_args():
+    """Return the paginate() arguments for the current request."""
+
+    return {'after': request.args.get('after'),
+            'before': request.args.get('before'),
+            'page_size': app.config['PAGE_SIZE']}
+
+
+@app.errorhandler(InvalidCursor)
+def invalid_cursor(error):
+    """Reject a page cursor that paginate() can't use."""
+
+    if request.path.startswith('/api/'):
+        return jsonify(error="Bad page cursor."), 400
+
+    return "Bad page cursor.", 400
+
+
 def get_movie_by_id(movie_id):
     """Returns a movie, given an id."""
 
@@ -139,19 +278,33 @@ def get_rating_by_movie_id(movie_id):
 def get_average_rating_for_movie(movie):
     """Returns the average user rating for a particular movie."""
 
-    rating_score = [rating.score for rating in movie.ratings]
-    avg_rating = float(sum(rating_score)) / len(rating_score)
+    matrix = get_ratings_matrix()
+
+    if movie.movie_id not in matrix.movie_index:
+        return None
+
+    return safe_round(matrix.movie_mean(matrix.movie_index[movie.movie_id]))
 
-    return safe_round(avg_rating)
+
+def get_rating_histogram_for_movie(movie):
+    """Returns (score, count) pairs for how often a movie got each score."""
+
+    summary = movie.rating_summary
+
+    if summary is None:
+        return []
+
+    return summary.histogram()
 
 
 def get_prediction_of_user_rating(movie):
     """Returns what a user will probably rate a movie they have not yet seen."""
 
-    prediction = None
+    prediction = get_stored_prediction(session['user_id'], movie.movie_id)
 
-    user = get_user_by_id(session['user_id'])
-    prediction = user.get_predicted_rating(movie.movie_id)
+    if prediction is None:
+        user = get_user_by_id(session['user_id'])
+        prediction = user.get_predicted_rating(movie.movie_id)
 
     return safe_round(prediction)
 
@@ -170,15 +323,17 @@ def get_effective_rating(prediction, user_rating):
 def get_eye_rating(movie):
     """Returns a value that represents the eye's [likely] opinion of a movie."""
 
-    the_eye = User.query.filter_by(email='the-eye@of-judgment.com').one()
-    eye_rating = Rating.query.filter_by(user_id=the_eye.user_id, movie_id=movie.movie_id).first()
+    the_eye = get_eye()
 
-    if eye_rating is None:
-        eye_rating = the_eye.get_predicted_rating(movie.movie_id)
-    else:
-        eye_rating = eye_rating.score
+    if the_eye is None:
+        return None
+
+    judgment = get_stored_prediction(the_eye.user_id, movie.movie_id)
+
+    if judgment is None:
+        judgment = the_eye.judgment(movie.movie_id)
 
-    return safe_round(eye_rating)
+    return safe_round(judgment)
 
 
 def fetch_insult(effective_rating, eye_rating):
@@ -226,6 +381,14 @@ def update_rating():
         movie = get_movie_by_id(movie_id)
 
         if movie:
+            try:
+                new_score = whole_number(new_score)
+            except ValueError:
+                new_score = None
+
+            if new_score not in SCORES:
+                return "Scores are whole numbers from 1 to 5.", 400
+
             update_rating_in_db(movie.movie_id, new_score)
 
             flash_message("Your rating has been saved.", ALERT_TYPES['green'])
@@ -243,19 +406,290 @@ def update_rating():
 def update_rating_in_db(movie_id, new_score):
     """Update a user's rating if it exists, if not, create a new rating."""
 
-    rating = get_rating_by_movie_id(movie_id)
-    user_id = session['user_id']
+    save_ratings(session['user_id'], {int(movie_id): int(new_score)})
+
+
+@app.route('/ratings/bulk', methods=['POST'])
+def bulk_update_ratings():
+    """Save many of the logged-in user's ratings in one request.
+
+    The body is JSON, either a list of {"movie_id": ..., "score": ...}
+    objects or {"ratings": [...]} wrapping one, or CSV lines of
+    movie_id,score. Nothing is saved unless every row is valid.
+    """
+
+    if not is_logged_in():
+        return jsonify(error="Please sign in to submit ratings."), 401
+
+    rows = parse_bulk_ratings()
+    if rows is None:
+        return jsonify(error="Send a JSON list of ratings or CSV lines of "
+                             "movie_id,score."), 400
+
+    if len(rows) > app.config['MAX_BULK_RATINGS']:
+        return jsonify(error="At most %d ratings per request."
+                             % app.config['MAX_BULK_RATINGS']), 413
+
+    errors = []
+    new_scores = {}
+
+    for line, (movie_id, score) in enumerate(rows, 1):
+        try:
+            movie_id, score = whole_number(movie_id), whole_number(score)
+        except ValueError:
+            errors.append({'row': line, 'error': "not a whole number"})
+            continue
+
+        if score not in SCORES:
+            errors.append({'row': line, 'error': "score must be 1-5"})
+        else:
+            new_scores[movie_id] = score
+
+    known = set()
+    if new_scores:
+        known = set(movie_id for movie_id, in db.session.query(Movie.movie_id)
+                    .filter(Movie.movie_id.in_(list(new_scores))))
+
+    errors.extend({'movie_id': movie_id, 'error': "no such movie"}
+                  for movie_id in sorted(set(new_scores) - known))
+
+    if errors:
+        return jsonify(errors=errors), 400
+
+    changed = save_ratings(session['user_id'], new_scores)
+
+    return jsonify(saved=len(new_scores), changed=changed)
 
-    if rating:
-        rating.score = new_score
-    else:
-        new_rating = Rating(movie_id=movie_id,
-                            user_id=user_id,
-                            score=new_score)
-        db.session.add(new_rating)
+
+def parse_bulk_ratings():
+    """Return the request body's (movie_id, score) pairs, or None if unreadable."""
+
+    if request.mimetype == 'text/csv':
+        lines = request.get_data().decode('utf-8').splitlines()
+        rows = [row for row in csv.reader(lines) if row]
+
+        if rows and not rows[0][0].strip().isdigit():
+            rows = rows[1:]
+
+        if any(len(row) != 2 for row in rows):
+            return None
+
+        return rows
+
+    body = request.get_json(silent=True)
+
+    if isinstance(body, dict):
+        body = body.get('ratings')
+
+    if not isinstance(body, list):
+        return None
+
+    if not all(isinstance(row, dict) for row in body):
+        return None
+
+    return [(row.get('movie_id'), row.get('score')) for row in body]
+
+
+def whole_number(value):
+    """Return a JSON or CSV value as an int, or raise ValueError.
+
+    int() alone would truncate 4.9 and 4.5 to 4.
+    """
+
+    if isinstance(value, bool):
+        raise ValueError(value)
+
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError(value)
+        return int(value)
+
+    if isinstance(value, (int, long, basestring)):
+        return int(value)
+
+    raise ValueError(value)
+
+
+def save_ratings(user_id, new_scores):
+    """Create or update many of a user's ratings in one transaction.
+
+    new_scores maps movie_id to score. The ratings are written by
+    upsert_ratings and logged as rating changes. The in-memory matrix and
+    caches, and (unless DERIVED_UPDATES leaves them to the change log's
+    consumer) the rating summaries, are each updated once for the whole
+    batch. The user's stored predictions are deleted either way. Returns
+    how many scores changed.
+    """
+
+    changes = upsert_ratings(user_id, new_scores)
+
+    if changes:
+        log_rating_changes(user_id, changes)
+
+        if app.config['DERIVED_UPDATES'] == 'inline':
+            update_movie_rating_summaries(changes)
+
+        # Otherwise the old ones would be served until the consumer
+        # recomputes them
+        clear_predictions([user_id])
 
     db.session.commit()
 
+    if not changes:
+        return 0
+
+    apply_user_scores(user_id, [change[0] for change in changes],
+                      [change[2] for change in changes])
+
+    return len(changes)
+
+
+@app.route('/cache_stats')
+def cache_stats():
+    """Show hit, miss and eviction counts for the similarity caches."""
+
+    return jsonify(cache.stats())
+
+
+@app.route('/metrics')
+def show_metrics():
+    """Expose request, SQL and hot-path metrics for Prometheus to scrape."""
+
+    return metrics.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+
+# JSON API
+#
+# Responses carry an ETag computed from the database rows behind them: the
+# newest logged rating change, or the movie's rating summary. Every worker
+# gives the same ETag for the same data, whichever process (or job) wrote
+# it, and a client revalidating with If-None-Match gets a 304 after that
+# one small query.
+
+@app.route('/api/movies/<int:movie_id>')
+def api_movie(movie_id):
+    """A movie and a summary of its ratings."""
+
+    summary = MovieRatingSummary.query.get(movie_id)
+    histogram = summary.histogram() if summary else []
+
+    def build():
+        movie = get_movie_by_id(movie_id)
+        if movie is None:
+            return None
+
+        return {'movie_id': movie.movie_id,
+                'title': movie.title,
+                'released_at': (movie.released_at.isoformat()
+                                if movie.released_at else None),
+                'imdb_url': movie.imdb_url,
+                'count': summary.count if summary else 0,
+                'average': summary.average() if summary else None,
+                'histogram': dict((str(score), count)
+                                  for score, count in histogram)}
+
+    return conditional_json(
+        ratings_etag('movie', movie_id,
+                     *[count for score, count in histogram]), build)
+
+
+@app.route('/api/movies/<int:movie_id>/ratings')
+def api_movie_ratings(movie_id):
+    """One page of a movie's ratings."""
+
+    def build():
+        page = paginate(Rating.query.filter_by(movie_id=movie_id),
+                        [Rating.rating_id], **page_args())
+
+        return {'ratings': [{'user_id': rating.user_id,
+                             'score': rating.score}
+                            for rating in page.items],
+                'prev_cursor': page.prev_cursor,
+                'next_cursor': page.next_cursor}
+
+    return conditional_json(
+        ratings_etag('movie-ratings', movie_id,
+                     latest_change_id(movie_id=movie_id)), build)
+
+
+@app.route('/api/users/<int:user_id>')
+def api_user(user_id):
+    """A user and their ratings."""
+
+    def build():
+        user = get_user_by_id(user_id)
+        if user is None:
+            return None
+
+        return {'user_id': user.user_id,
+                'age': user.age,
+                'zipcode': user.zipcode,
+                'ratings': [{'movie_id': movie_id, 'title': title,
+                             'score': score} for movie_id, title, score
+                            in get_ratings_with_titles(user.user_id)]}
+
+    return conditional_json(
+        ratings_etag('user', user_id, latest_change_id(user_id=user_id)),
+        build)
+
+
+@app.route('/api/users/<int:user_id>/predictions/<int:movie_id>')
+def api_prediction(user_id, movie_id):
+    """A user's predicted score for a movie."""
+
+    stored = Prediction.query.get((user_id, movie_id))
+
+    def build():
+        if stored is not None:
+            prediction = stored.predicted_score
+        else:
+            user = get_user_by_id(user_id)
+            if user is None:
+                return None
+            prediction = user.get_predicted_rating(movie_id)
+
+        return {'user_id': user_id,
+                'movie_id': movie_id,
+                'prediction': prediction}
+
+    # A live prediction can move with anyone's ratings; a stored one moves
+    # when the predictions job rewrites it
+    if stored is not None:
+        version = stored.computed_at.strftime('%Y%m%d%H%M%S%f')
+    else:
+        version = latest_change_id()
+
+    return conditional_json(
+        ratings_etag('prediction', user_id, movie_id, version), build)
+
+
+def ratings_etag(*parts):
+    """Return an ETag for a resource from the database state behind it."""
+
+    return "-".join(str(part) for part in parts)
+
+
+def conditional_json(etag, build):
+    """Return build()'s JSON, or a 304 if the client already has etag.
+
+    build is only called when the client's copy is missing or stale. It
+    returns None for a resource that doesn't exist, giving a 404.
+    """
+
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        body = build()
+        if body is None:
+            return jsonify(error="Not found."), 404
+        response = jsonify(body)
+
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['API_MAX_AGE']
+
+    return response
+
 
 @app.route('/register', methods=['GET'])
 def register():
@@ -307,6 +741,7 @@ def add_user_to_db(email, password):
     user = User(email=email, password=password)
     db.session.add(user)
     db.session.commit()
+    add_user_to_index(user.user_id)
 
     add_session_info(user)
     flash_message("Account created.", ALERT_TYPES['green'])
@@ -365,6 +800,11 @@ if __name__ == "__main__":
 
     connect_to_db(app)
 
+    # Load the factor model and the eye's judgments before taking requests
+    with app.app_context():
+        get_factor_model()
+        get_eye()
+
     # Use the DebugToolbar
     DebugToolbarExtension(app)
 
@@ -0,0 +1,196 @@
+"""Vectorized Pearson similarity between users."""
+
+import numpy as np
+
+from correlation import pearson_from_stats_many
+
+
+class SimilarityEngine(object):
+    """Pearson similarity, computed in bulk over a RatingsMatrix.
+
+    For one user against everyone, the ratings of every movie the user has
+    rated are gathered from the matrix's columns and the co-rated sums that
+    Pearson needs are accumulated per rater with np.bincount, so the work is
+    proportional to how many ratings those movies have.
+    """
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+    @property
+    def user_ids(self):
+        return self.matrix.user_ids
+
+    @property
+    def user_index(self):
+        return self.matrix.user_index
+
+    @property
+    def movie_ids(self):
+        return self.matrix.movie_ids
+
+    @property
+    def movie_index(self):
+        return self.matrix.movie_index
+
+    def set_score(self, user_id, movie_id, score):
+        """Record a new or changed rating."""
+
+        self.matrix.set_score(user_id, movie_id, score)
+
+    def set_scores(self, user_id, movie_ids, scores):
+        """Record many new or changed ratings by one user."""
+
+        self.matrix.set_scores(user_id, movie_ids, scores)
+
+    def fingerprint(self):
+        """Return a checksum of every rating, for spotting stale data."""
+
+        return self.matrix.fingerprint()
+
+    def similarity(self, user_id, other_user_id):
+        """Return the Pearson similarity between two users."""
+
+        if (user_id not in self.user_index or
+                other_user_id not in self.user_index):
+            return 0
+
+        mine, theirs = self.matrix.co_rated(self.user_index[user_id],
+                                            self.user_index[other_user_id])
+        mine = mine.astype(float)
+        theirs = theirs.astype(float)
+
+        return pearson_from_stats_many(np.array([len(mine)], dtype=float),
+                                       mine.sum(), theirs.sum(),
+                                       mine.dot(mine), theirs.dot(theirs),
+                                       mine.dot(theirs))[0]
+
+    def similarities(self, user_id):
+        """Return an array of user_id's similarity to every user.
+
+        The array is aligned with self.user_ids. Users with nothing rated in
+        common get 0, as does every user when user_id has no ratings.
+        """
+
+        if user_id not in self.user_index:
+            return np.zeros(len(self.user_ids))
+
+        return pearson_from_stats_many(*self.user_pair_sums(user_id))
+
+    def user_pair_sums(self, user_id):
+        """Return the co-rated sums Pearson needs, for user_id and everyone.
+
+        Returns arrays aligned with self.user_ids, like pair_sums does for
+        one row: (size, sum_1, sum_2, squares_1, squares_2, product_sum),
+        with the "_1" sums over user_id's scores. user_id must be known.
+        """
+
+        num_users = len(self.user_ids)
+
+        movies, my_scores = self.matrix.row(self.user_index[user_id])
+        owners, raters, their_scores = self.matrix.gather_columns(movies)
+
+        mine = my_scores[owners].astype(float)
+        theirs = their_scores.astype(float)
+
+        def total(weights=None):
+            return np.bincount(raters, weights=weights, minlength=num_users)
+
+        return (total().astype(float), total(mine), total(theirs),
+                total(mine * mine), total(theirs * theirs),
+                total(mine * theirs))
+
+    def all_similarities(self):
+        """Return the full user x user similarity matrix."""
+
+        return pearson_from_stats_many(*self.pair_sums())
+
+    def pair_sums(self):
+        """Return the co-rated sums Pearson needs, for every pair of users.
+
+        Returns user x user matrices (size, sum_1, sum_2, squares_1,
+        squares_2, product_sum), where the "_1" sums are over the row user's
+        scores and the "_2" sums over the column user's. This works on a
+        dense copy of the matrix, since the result is dense anyway.
+        """
+
+        scores, rated = self.matrix.to_dense()
+        squares = scores * scores
+        rated_t = rated.T
+
+        size = rated.dot(rated_t)
+        sum_1 = scores.dot(rated_t)
+        sum_2 = sum_1.T
+        squares_1 = squares.dot(rated_t)
+        squares_2 = squares_1.T
+        product_sum = scores.dot(scores.T)
+
+        return size, sum_1, sum_2, squares_1, squares_2, product_sum
+
+    def movies_rated_by(self, user_id):
+        """Return the ids of every movie user_id has rated."""
+
+        if user_id not in self.user_index:
+            return []
+
+        movies, scores = self.matrix.row(self.user_index[user_id])
+        return [self.movie_ids[j] for j in movies]
+
+    def movie_raters(self, movie_id):
+        """Return (user indexes, scores) for everyone who rated movie_id."""
+
+        if movie_id not in self.movie_index:
+            return np.array([], dtype=int), np.array([])
+
+        raters, scores = self.matrix.column(self.movie_index[movie_id])
+        return raters, scores.astype(float)
+
+    def weighted_scores(self, users, weights):
+        """Return per-movie sums of the users' weighted scores and weights.
+
+        Returns two arrays aligned with self.movie_ids: the sum over the
+        users who rated each movie of weight * score, and of weight alone.
+        """
+
+        num_movies = len(self.movie_ids)
+        owners, movies, scores = self.matrix.gather_rows(users)
+        weights = np.asarray(weights, dtype=float)[owners]
+
+        return (np.bincount(movies, weights=weights * scores,
+                            minlength=num_movies),
+                np.bincount(movies, weights=weights, minlength=num_movies))
+
+    def predict_many(self, user_id, movie_ids, neighbor_index=None):
+        """Predict user_id's scores for movie_ids from similar users' scores.
+
+        Each prediction is raters' scores weighted by their similarity to
+        the user. With a NeighborIndex, only the user's nearest neighbors
+        count. Returns an array aligned with movie_ids, holding NaN where
+        there is nothing to predict from.
+        """
+
+        if neighbor_index is None:
+            raters = np.arange(len(self.user_ids))
+            sims = self.similarities(user_id)
+        else:
+            raters, sims = neighbor_index.neighbors(user_id)
+
+        numerators, denominators = self.weighted_scores(raters, sims)
+
+        known = np.array([movie_id in self.movie_index
+                          for movie_id in movie_ids], dtype=bool)
+        columns = np.array([self.movie_index[movie_id]
+                            for movie_id in np.asarray(movie_ids)[known]],
+                           dtype=int)
+
+        numerator = numerators[columns]
+        denominator = denominators[columns]
+
+        predictions = np.empty(len(movie_ids))
+        predictions.fill(np.nan)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            predictions[known] = np.where(denominator != 0,
+                                          numerator / denominator, np.nan)
+
+        return predictions
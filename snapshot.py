@@ -0,0 +1,228 @@
+"""Memory-mapped snapshots of the ratings matrix and neighbor index.
+
+A snapshot file is a JSON header followed by the raw arrays behind a
+RatingsMatrix (and, optionally, a NeighborIndex). The header records how
+far into the rating change log the ratings go, so a worker loading the
+snapshot can replay what was logged after it. Loading one maps the
+file instead of reading it, so every worker process serving the same
+snapshot shares one copy of its pages through the OS page cache.
+
+Snapshots are written side by side in a directory, and a "current"
+symlink names the one to serve. Repointing the link is atomic, so a new
+snapshot can be swapped in while workers are running; see
+model.check_snapshot for how they notice. Running this module builds a
+snapshot from the database and makes it current.
+"""
+
+import glob
+import json
+import os
+import struct
+import time
+
+import numpy as np
+
+from neighbors import NeighborIndex
+from ratings_matrix import RatingsMatrix
+
+MAGIC = 'RATINGS-SNAPSHOT'
+
+# Bumped when the layout changes, so old files aren't misread
+FORMAT_VERSION = 1
+
+# Arrays start on cache-line boundaries
+ALIGNMENT = 64
+
+CURRENT = 'current'
+
+
+def _aligned(size):
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+def write_snapshot(path, matrix, neighbor_index=None, change_id=0, gaps=()):
+    """Write matrix (and neighbor_index, if given) to a snapshot file.
+
+    change_id is the newest rating change the matrix includes, and gaps
+    the ids below it whose transactions hadn't committed when it was read.
+    The file is written under a temporary name and renamed into place.
+    """
+
+    arrays = {'user_ids': np.array(matrix.user_ids, dtype=np.int64),
+              'movie_ids': np.array(matrix.movie_ids, dtype=np.int64)}
+    for name, array in matrix.arrays().items():
+        arrays['matrix.' + name] = array
+
+    if neighbor_index is not None:
+        arrays['neighbors.indexes'] = neighbor_index.indexes
+        arrays['neighbors.sims'] = neighbor_index.sims
+
+    header = {'format_version': FORMAT_VERSION,
+              'created_at': time.time(),
+              'fingerprint': matrix.fingerprint(),
+              'k': neighbor_index.k if neighbor_index is not None else None,
+              'change_id': change_id,
+              'gaps': sorted(gaps),
+              'arrays': {}}
+
+    offset = 0
+    for name in sorted(arrays):
+        array = np.ascontiguousarray(arrays[name])
+        arrays[name] = array
+        header['arrays'][name] = {'dtype': array.dtype.str,
+                                  'shape': array.shape,
+                                  'offset': offset}
+        offset += _aligned(array.nbytes)
+
+    encoded = json.dumps(header)
+    start = _aligned(len(MAGIC) + 8 + len(encoded))
+
+    with open(path + '.tmp', 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(encoded)))
+        f.write(encoded)
+
+        for name in sorted(arrays):
+            f.seek(start + header['arrays'][name]['offset'])
+            f.write(arrays[name].tobytes())
+
+        f.truncate(start + offset)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.rename(path + '.tmp', path)
+
+
+class Snapshot(object):
+    """A snapshot file, mapped read-only into memory."""
+
+    def __init__(self, path):
+        self.path = os.path.realpath(path)
+
+        with open(self.path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s isn't a ratings snapshot" % self.path)
+
+            length, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(length))
+
+        if header['format_version'] != FORMAT_VERSION:
+            raise ValueError("%s has snapshot format %s, expected %s"
+                             % (self.path, header['format_version'],
+                                FORMAT_VERSION))
+
+        self.created_at = header['created_at']
+        self.fingerprint = header['fingerprint']
+        self.k = header['k']
+        # Snapshots written before these were recorded replay the whole log
+        self.change_id = header.get('change_id', 0)
+        self.gaps = header.get('gaps', [])
+
+        data = np.memmap(self.path, dtype=np.uint8, mode='r')
+        start = _aligned(len(MAGIC) + 8 + length)
+
+        self.arrays = {}
+        for name, spec in header['arrays'].items():
+            self.arrays[name] = np.ndarray(tuple(spec['shape']),
+                                           np.dtype(str(spec['dtype'])),
+                                           buffer=data,
+                                           offset=start + spec['offset'])
+
+    def ratings_matrix(self):
+        """Return a RatingsMatrix over the mapped arrays."""
+
+        arrays = dict((name, self.arrays['matrix.' + name])
+                      for name in RatingsMatrix.ARRAYS)
+
+        return RatingsMatrix.from_arrays(self.arrays['user_ids'].tolist(),
+                                         self.arrays['movie_ids'].tolist(),
+                                         arrays)
+
+    def neighbor_index(self, engine, k):
+        """Return the mapped NeighborIndex for engine, or None if k differs."""
+
+        if self.k != k or 'neighbors.indexes' not in self.arrays:
+            return None
+
+        return NeighborIndex(engine, k,
+                             indexes=self.arrays['neighbors.indexes'],
+                             sims=self.arrays['neighbors.sims'])
+
+
+def current_snapshot(directory):
+    """Return the real path of directory's current snapshot, or None."""
+
+    link = os.path.join(directory, CURRENT)
+
+    if not os.path.exists(link):
+        return None
+
+    return os.path.realpath(link)
+
+
+def publish(directory, matrix, neighbor_index=None, keep=3, change_id=0,
+            gaps=()):
+    """Write a new snapshot to directory and make it the current one.
+
+    The newest keep snapshots are kept. Older ones are deleted; workers
+    still mapping one keep its pages until they switch over. Returns the
+    new snapshot's path.
+    """
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # Name snapshots by creation time, so they sort oldest first
+    stamp = int(time.time() * 1000)
+    while os.path.exists(os.path.join(directory, 'ratings-%d.snap' % stamp)):
+        stamp += 1
+
+    name = 'ratings-%d.snap' % stamp
+    path = os.path.join(directory, name)
+    write_snapshot(path, matrix, neighbor_index, change_id, gaps)
+
+    # Point a new link at the snapshot, then rename it over the old one
+    link = os.path.join(directory, CURRENT)
+    if os.path.lexists(link + '.tmp'):
+        os.remove(link + '.tmp')
+    os.symlink(name, link + '.tmp')
+    os.rename(link + '.tmp', link)
+
+    snapshots = sorted(glob.glob(os.path.join(directory, 'ratings-*.snap')))
+    for old in snapshots[:-keep]:
+        os.remove(old)
+
+    return path
+
+
+if __name__ == "__main__":
+    from all_pairs import AllPairs
+    from server import app
+    from model import connect_to_db, db, Rating, ChangeCursor
+    from model import latest_change_id
+    from similarity import SimilarityEngine
+
+    connect_to_db(app)
+    app.config['SQLALCHEMY_ECHO'] = False
+
+    with app.app_context():
+        # Taken first, so any change the ratings miss is replayed
+        cursor = ChangeCursor.at(latest_change_id())
+        rows = db.session.query(Rating.user_id, Rating.movie_id, Rating.score)
+        engine = SimilarityEngine(RatingsMatrix.from_rows(rows))
+
+    k = app.config['NEIGHBOR_COUNT']
+    index = None
+
+    if k is not None:
+        index = NeighborIndex.load(app.config['NEIGHBOR_INDEX_PATH'], engine, k)
+
+        if index is None:
+            all_pairs = AllPairs(engine.matrix, app.config['ALL_PAIRS_DIR'], k,
+                                 app.config['ALL_PAIRS_MEMORY_MB'] * 2 ** 20)
+            all_pairs.run()
+            index = all_pairs.neighbor_index(engine)
+
+    path = publish(app.config['SNAPSHOT_DIR'] or 'snapshots', engine.matrix,
+                   index, change_id=cursor.change_id, gaps=cursor.gaps)
+    print "Published %s (%d ratings)" % (path, engine.matrix.nnz)
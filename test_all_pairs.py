@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from all_pairs import AllPairs, tile_width
+from neighbors import NeighborIndex
+from ratings_matrix import RatingsMatrix
+from similarity import SimilarityEngine
+from test_similarity import make_rows
+
+
+class allPairsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.engine = SimilarityEngine(RatingsMatrix.from_rows(make_rows()))
+        self.directory = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def all_pairs(self, k=None, processes=1):
+        """Return a builder whose memory ceiling forces 7-user tiles."""
+
+        num_movies = len(self.engine.movie_ids)
+        memory_limit = processes * (6 * num_movies * 4 * 7 + 80 * 7 * 7 + 100)
+        all_pairs = AllPairs(self.engine.matrix, self.directory, k,
+                             memory_limit, processes)
+
+        self.assertEqual(all_pairs.width, 7)
+        return all_pairs
+
+
+    def test_tile_width_fits_ceiling(self):
+        """Wider tiles are picked for bigger ceilings and fewer processes."""
+
+        self.assertTrue(tile_width(1000, 2 ** 30, 1) >
+                        tile_width(1000, 2 ** 30, 4) >
+                        tile_width(1000, 2 ** 20, 4) >= 1)
+
+
+    def test_tiles_match_dense(self):
+        """Stitched tiles equal the dense all-pairs matrix."""
+
+        all_pairs = self.all_pairs(processes=2)
+        all_pairs.run()
+
+        np.testing.assert_array_equal(all_pairs.similarities(),
+                                      self.engine.all_similarities())
+
+
+    def test_neighbor_index_matches_build(self):
+        """Merging each tile's top k gives every user's overall top k."""
+
+        all_pairs = self.all_pairs(k=5)
+        all_pairs.run()
+        tiled = all_pairs.neighbor_index(self.engine)
+        built = NeighborIndex(self.engine, 5)
+
+        for user_id in self.engine.user_ids:
+            indexes, sims = tiled.neighbors(user_id)
+            self.assertNotIn(self.engine.user_index[user_id], indexes)
+            self.assertEqual(sorted(sims), sorted(built.neighbors(user_id)[1]))
+
+
+    def test_resumes_after_crash(self):
+        """A rerun computes only the tiles missing from disk."""
+
+        all_pairs = self.all_pairs(k=5)
+        self.assertEqual(all_pairs.run(), len(all_pairs.tiles))
+
+        os.remove(os.path.join(self.directory, 'tile-0-7.npz'))
+        self.assertEqual(all_pairs.run(), 1)
+
+        self.engine.set_score(1, 999, 5)
+        self.assertEqual(all_pairs.run(), len(all_pairs.tiles))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import seed
+from benchmarks import compare, generate, scaling
+
+
+class generateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def test_files_load_as_movielens_100k(self):
+        """The files parse like MovieLens 100k, with skewed popularity."""
+
+        summary = generate.generate(self.directory, 5000, 100, 300)
+        data_format = seed.find_format(self.directory)
+        self.assertEqual(data_format['name'], '100k')
+
+        users = list(seed.read_rows(self.directory, data_format, 'users'))
+        movies = list(seed.read_rows(self.directory, data_format, 'movies'))
+        ratings = np.array([map(int, fields[:3]) for fields in
+                            seed.read_rows(self.directory, data_format,
+                                           'ratings')])
+
+        self.assertEqual((len(users), len(movies)), (100, 300))
+        self.assertEqual(len(ratings), summary['ratings'])
+        self.assertEqual(summary['ratings'], 5000)
+        self.assertEqual(seed.parse_title(movies[0][1]), "Synthetic Movie 1")
+
+        pairs = ratings[:, 0] * 1000 + ratings[:, 1]
+        self.assertEqual(len(np.unique(pairs)), len(pairs))
+        self.assertTrue(set(ratings[:, 2]) <= set(range(1, 6)))
+        self.assertGreaterEqual(np.bincount(ratings[:, 0])[1:].min(),
+                                generate.MIN_RATINGS)
+
+        popularity = np.sort(np.bincount(ratings[:, 1]))[::-1]
+        self.assertGreater(popularity[0], 4 * np.median(popularity))
+
+
+class compareTestCase(unittest.TestCase):
+    def results(self, **medians):
+        return {'meta': {}, 'results': dict(
+            (name, {'median': median}) for name, median in medians.items())}
+
+
+    def test_flags_regressions(self):
+        """Only slowdowns past both the threshold and the minimum count."""
+
+        rows = compare.compare(self.results(a=0.010, b=0.010, c=0.00001,
+                                            d=0.010),
+                               self.results(a=0.020, b=0.005, c=0.00005,
+                                            e=0.010),
+                               threshold=0.25)
+
+        self.assertEqual([(name, verdict) for name, old, new, ratio, verdict
+                          in rows],
+                         [('a', 'regression'), ('b', 'improvement'),
+                          ('c', 'same'), ('d', 'removed'), ('e', 'added')])
+
+
+
+class scalingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def test_scaling_table(self):
+        """Each process count is timed, relative to the first."""
+
+        generate.generate(self.directory, 2000, 60, 100)
+        matrix = scaling.load_matrix(self.directory)
+        self.assertEqual(matrix.nnz, 2000)
+
+        rows = scaling.scaling(matrix, [1, 2], k=5, memory_limit=2 ** 20)
+        self.assertEqual([row[0] for row in rows], [1, 2])
+        self.assertEqual(rows[0][2:], (1.0, 1.0))
+        self.assertAlmostEqual(rows[1][3], rows[1][2] / 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+import cache
+
+
+class lruCacheTestCase(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        """The entry untouched for longest goes first."""
+
+        lru = cache.LRUCache(maxsize=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIs(lru.get('b'), cache.MISSING)
+        self.assertEqual(lru.evictions, 1)
+
+
+    def test_expired_entries_miss(self):
+        """Entries past their ttl are not served."""
+
+        lru = cache.LRUCache(ttl=-1)
+        lru.set('a', None)
+
+        self.assertIs(lru.get('a'), cache.MISSING)
+        self.assertEqual(lru.expirations, 1)
+
+
+    def test_versions_change_keys(self):
+        """Rating something moves the user's and their movies' versions."""
+
+        versions = cache.RatingsVersions()
+        versions.bump(1, [10, 11])
+
+        self.assertEqual(versions.user(1), 1)
+        self.assertEqual(versions.movie(11), 1)
+        self.assertEqual(versions.movie(12), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
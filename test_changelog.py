@@ -0,0 +1,199 @@
+import datetime
+import os
+import tempfile
+import unittest
+
+import changelog
+import eye
+import model
+import server
+from model import db, User, Movie, Rating, MovieRatingSummary
+from model import RatingChange, Prediction
+from neighbors import NeighborIndex
+from ratings_matrix import RatingsMatrix
+from similarity import SimilarityEngine
+
+
+class changelogTestCase(unittest.TestCase):
+    def setUp(self):
+        """Create a scratch SQLite database with a few users' ratings."""
+        self.db, server.app.config['DATABASE'] = tempfile.mkstemp()
+        server.app.config['TESTING'] = True
+        server.app.config['NEIGHBOR_COUNT'] = None
+        server.app.config['DERIVED_UPDATES'] = 'consumer'
+        server.connect_to_db(server.app, 'sqlite:///' + server.app.config['DATABASE'])
+        server.app.config['SQLALCHEMY_ECHO'] = False
+
+        self.context = server.app.app_context()
+        self.context.push()
+        db.create_all()
+
+        for movie_id in range(1, 6):
+            db.session.add(Movie(movie_id=movie_id, title="Movie %d" % movie_id,
+                                 imdb_url=""))
+        for user_id in range(1, 5):
+            db.session.add(User(user_id=user_id, email="u%d" % user_id))
+            for movie_id in range(1, 5):
+                db.session.add(Rating(user_id=user_id, movie_id=movie_id,
+                                      score=(user_id * movie_id) % 5 + 1))
+        db.session.commit()
+        model.reload_ratings()
+        model.rebuild_movie_rating_summaries()
+
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+        server.app.config['DERIVED_UPDATES'] = 'inline'
+        model.reload_ratings()
+        eye._eye = None
+        os.close(self.db)
+        os.unlink(server.app.config['DATABASE'])
+
+
+    def assertSummariesMatchRatings(self):
+        """Every movie's summary is what a rebuild from its ratings gives."""
+
+        def summaries():
+            return [(summary.movie_id, summary.count, summary.score_sum,
+                     summary.histogram()) for summary in
+                    MovieRatingSummary.query.order_by(MovieRatingSummary.movie_id)]
+
+        kept = summaries()
+        model.rebuild_movie_rating_summaries()
+        self.assertEqual(kept, summaries())
+
+
+    def test_consumer_catches_up(self):
+        """Writes are logged, and the consumer brings derived data up to date."""
+
+        server.save_ratings(1, {1: 5, 5: 2})
+        server.save_ratings(2, {5: 4})
+
+        self.assertEqual(RatingChange.query.count(), 3)
+        self.assertEqual(MovieRatingSummary.query.get(5), None)
+        self.assertEqual(changelog.lag()[0], 3)
+
+        self.assertEqual(changelog.consume(batch_size=2, settle=0), 2)
+        self.assertEqual(changelog.consume(batch_size=2, settle=0), 1)
+        self.assertEqual(changelog.consume(batch_size=2, settle=0), 0)
+        self.assertEqual(changelog.lag(), (0, 0.0))
+
+        summary = MovieRatingSummary.query.get(5)
+        self.assertEqual((summary.count, summary.score_sum), (2, 6))
+        self.assertEqual(MovieRatingSummary.query.get(1).score_sum,
+                         sum(rating.score for rating in
+                             Rating.query.filter_by(movie_id=1)))
+
+        self.assertSummariesMatchRatings()
+
+
+    def test_replaying_a_batch_is_harmless(self):
+        """Applying the same changes twice leaves the same derived data."""
+
+        server.save_ratings(3, {2: 1, 5: 5})
+        changes = RatingChange.query.all()
+
+        changelog.apply_changes(changes)
+        db.session.commit()
+
+        self.assertSummariesMatchRatings()
+        self.assertEqual(MovieRatingSummary.query.get(5).count, 1)
+
+
+    def log_change(self, change_id, user_id, movie_id, score):
+        """Log a change under change_id, as a transaction committing then would."""
+
+        rating = Rating.query.filter_by(user_id=user_id, movie_id=movie_id).first()
+        old_score = rating.score if rating else None
+        if rating:
+            rating.score = score
+        else:
+            db.session.add(Rating(user_id=user_id, movie_id=movie_id,
+                                  score=score))
+        db.session.add(RatingChange(change_id=change_id, user_id=user_id,
+                                    movie_id=movie_id, old_score=old_score,
+                                    new_score=score,
+                                    changed_at=datetime.datetime.now()))
+        db.session.commit()
+
+
+    def test_late_commit_is_not_skipped(self):
+        """A change committed after a later id was read is still applied."""
+
+        self.log_change(1, 1, 5, 3)
+        self.log_change(3, 2, 5, 4)
+        self.assertEqual(changelog.consume(settle=0), 2)
+
+        cursor = model.get_consumer_cursor(model.DERIVED_DATA_CONSUMER)
+        self.assertEqual((cursor.change_id, sorted(cursor.gaps)), (3, [2]))
+
+        # The transaction holding change 2 commits now
+        self.log_change(2, 3, 5, 1)
+        self.assertEqual(changelog.consume(settle=0), 1)
+        self.assertEqual(changelog.consume(settle=0), 0)
+
+        self.assertEqual(MovieRatingSummary.query.get(5).count, 3)
+        self.assertEqual(
+            model.get_consumer_cursor(model.DERIVED_DATA_CONSUMER).gaps, {})
+        self.assertSummariesMatchRatings()
+
+
+    def test_consumer_refreshes_neighbors(self):
+        """The consumer's neighbors match a fresh build after a change."""
+
+        # setUp's connect_to_db turned neighbors off
+        model._neighbor_count = 2
+        model._neighbor_index_path = \
+            server.app.config['DATABASE'] + '.neighbors.npz'
+        model.reload_ratings()
+        model.get_neighbor_index()
+
+        self.log_change(1, 1, 1, 1)
+        self.log_change(2, 1, 2, 5)
+        self.log_change(3, 1, 3, 1)
+        self.assertEqual(changelog.consume(settle=0), 3)
+
+        rows = db.session.query(Rating.user_id, Rating.movie_id, Rating.score)
+        engine = SimilarityEngine(RatingsMatrix.from_rows(rows))
+        fresh = NeighborIndex(engine, 2)
+        index = model.get_neighbor_index()
+
+        for user_id in engine.user_ids:
+            self.assertEqual(sorted(index.neighbors(user_id)[1]),
+                             sorted(fresh.neighbors(user_id)[1]))
+
+
+    def test_gaps_expire(self):
+        """An id that never shows up, as after a rollback, is given up on."""
+
+        cursor = model.ChangeCursor(5)
+        self.log_change(8, 1, 5, 3)
+        changes = cursor.read()
+        self.assertTrue(cursor.advance(changes))
+        self.assertEqual(sorted(cursor.gaps), [6, 7])
+
+        later = (datetime.datetime.now() +
+                 datetime.timedelta(seconds=model.GAP_TIMEOUT + 1))
+        self.assertEqual(cursor.read(), [])
+        self.assertTrue(cursor.advance([], now=later))
+        self.assertEqual((cursor.change_id, cursor.gaps), (8, {}))
+        self.assertFalse(cursor.advance([], now=later))
+
+
+    def test_consumer_mode_clears_predictions_inline(self):
+        """A rating deletes the user's stored predictions before the consumer runs."""
+
+        db.session.add(Prediction(user_id=1, movie_id=5, predicted_score=1.0,
+                                  computed_at=datetime.datetime.now()))
+        db.session.add(Prediction(user_id=2, movie_id=5, predicted_score=1.0,
+                                  computed_at=datetime.datetime.now()))
+        db.session.commit()
+
+        server.save_ratings(1, {1: 5})
+        self.assertEqual([p.user_id for p in Prediction.query], [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
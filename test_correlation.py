@@ -0,0 +1,64 @@
+import unittest
+import random
+
+import correlation
+
+
+class pearsonTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pairs = [(5, 4), (3, 3), (1, 2), (4, 5), (2, 2)]
+
+
+    def stats_for(self, pairs):
+        """Return the running sums for pairs."""
+
+        return (len(pairs),
+                sum(x for x, y in pairs),
+                sum(y for x, y in pairs),
+                sum(x * x for x, y in pairs),
+                sum(y * y for x, y in pairs),
+                sum(x * y for x, y in pairs))
+
+
+    def test_pearson_from_stats_matches_pearson(self):
+        """Running sums give the same correlation as the pairs."""
+
+        self.assertEqual(correlation.pearson_from_stats(*self.stats_for(self.pairs)),
+                         correlation.pearson(self.pairs))
+
+
+    def test_zero_denominator(self):
+        """A constant series has no correlation."""
+
+        self.assertEqual(correlation.pearson([(3, 1), (3, 5), (3, 2)]), 0)
+        self.assertEqual(correlation.pearson_from_stats(0, 0, 0, 0, 0, 0), 0)
+
+
+class pearsonManyTestCase(unittest.TestCase):
+    def test_streams_a_generator(self):
+        """pearson reads pairs from any iterable."""
+
+        pairs = [(5, 4), (3, 3), (1, 2), (4, 5)]
+        self.assertEqual(correlation.pearson(iter(pairs)),
+                         correlation.pearson(pairs))
+
+
+    def test_matches_pearson(self):
+        """pearson_many equals pearson over each candidate's co-rated pairs."""
+
+        rand = random.Random(2)
+        reference = [rand.choice([0, 1, 2, 3, 4, 5]) for i in range(30)]
+        candidates = [[rand.choice([0, 0, 3, 3, 4, 5]) for i in range(30)]
+                      for j in range(20)]
+        candidates.append([0] * 30)
+        candidates.append([3 if x else 0 for x in reference])
+
+        results = correlation.pearson_many(reference, candidates)
+
+        for row, result in zip(candidates, results):
+            pairs = [(x, y) for x, y in zip(reference, row) if x and y]
+            self.assertEqual(result, correlation.pearson(pairs))
+
+
+if __name__ == '__main__':
+    unittest.main()
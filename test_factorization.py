@@ -0,0 +1,79 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from factorization import FactorModel, train
+from ratings_matrix import RatingsMatrix
+from test_similarity import make_rows
+
+
+class factorModelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.matrix = RatingsMatrix.from_rows(make_rows(num_users=40))
+        self.model = train(self.matrix, factors=4, iterations=5)
+
+    def test_fits_training_ratings(self):
+        """Training error is well below that of always guessing the mean."""
+
+        errors, baseline = [], []
+        for i, user_id in enumerate(self.matrix.user_ids):
+            movies, scores = self.matrix.row(i)
+            movie_ids = [self.matrix.movie_ids[j] for j in movies]
+            errors.extend(self.model.predict_many(user_id, movie_ids) - scores)
+            baseline.extend(self.model.mean - scores)
+
+        self.assertTrue(np.sqrt(np.mean(np.square(errors))) <
+                        np.sqrt(np.mean(np.square(baseline))))
+
+    def test_predict_matches_predict_many(self):
+        """Single and batch predictions agree; unknown movies are NaN/None."""
+
+        user_id = self.matrix.user_ids[0]
+        movie_ids = self.matrix.movie_ids[:5] + [-1]
+        predictions = self.model.predict_many(user_id, movie_ids)
+
+        for movie_id, prediction in zip(movie_ids[:5], predictions):
+            self.assertAlmostEqual(self.model.predict(user_id, movie_id),
+                                   prediction)
+            self.assertTrue(1 <= prediction <= 5)
+
+        self.assertTrue(np.isnan(predictions[-1]))
+        self.assertEqual(self.model.predict(user_id, -1), None)
+
+    def test_fold_in_new_user(self):
+        """A folded-in user gets predictions that follow their ratings."""
+
+        movie_ids = self.matrix.movie_ids[:10]
+        self.model.fold_in(999, movie_ids, [5] * 10)
+        high = self.model.predict_many(999, movie_ids).mean()
+
+        self.model.fold_in(999, movie_ids, [1] * 10)
+        low = self.model.predict_many(999, movie_ids).mean()
+
+        self.assertTrue(high > low)
+
+    def test_save_and_load_latest(self):
+        """The newest saved artifact is the one loaded."""
+
+        directory = tempfile.mkdtemp()
+        try:
+            self.assertEqual(FactorModel.load_latest(directory), None)
+
+            self.model.save(directory)
+            self.model.trained_at += 1
+            self.model.mean += 1
+            self.model.save(directory)
+
+            loaded = FactorModel.load_latest(directory)
+            self.assertEqual(loaded.mean, self.model.mean)
+            self.assertEqual(loaded.movie_ids, self.model.movie_ids)
+            np.testing.assert_array_equal(loaded.user_factors,
+                                          self.model.user_factors)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
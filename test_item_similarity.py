@@ -0,0 +1,36 @@
+import unittest
+
+from item_similarity import ItemNeighbors, movie_neighbor_rows
+from ratings_matrix import RatingsMatrix
+from test_similarity import make_rows
+
+
+class itemNeighborsTestCase(unittest.TestCase):
+    def test_weighted_mean_of_rated_neighbors(self):
+        """Predictions average the user's scores on similar movies."""
+
+        neighbors = ItemNeighbors([(1, 2, 0.5), (1, 3, 1.0), (1, 4, 0.25),
+                                   (2, 1, 0.5)])
+
+        predictions = neighbors.predict_many([2, 3, 9], [4, 1, 5], [1, 2, 7])
+
+        self.assertAlmostEqual(predictions[0], (0.5 * 4 + 1.0 * 1) / 1.5)
+        self.assertTrue(all(p != p for p in predictions[1:]))
+
+
+    def test_neighbor_rows(self):
+        """Each movie gets at most k positive, non-self neighbors."""
+
+        matrix = RatingsMatrix.from_rows(make_rows(num_users=60))
+        rows = list(movie_neighbor_rows(matrix, 3, min_overlap=2))
+
+        self.assertTrue(rows)
+        for movie_id in matrix.movie_ids:
+            mine = [row for row in rows if row[0] == movie_id]
+            self.assertTrue(len(mine) <= 3)
+            self.assertTrue(all(other != movie_id and sim > 0
+                                for _, other, sim in mine))
+
+
+if __name__ == '__main__':
+    unittest.main()
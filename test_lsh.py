@@ -0,0 +1,63 @@
+import unittest
+
+from lsh import LSHIndex, recall_at_k
+from neighbors import NeighborIndex
+from ratings_matrix import RatingsMatrix
+from similarity import SimilarityEngine
+from test_similarity import make_rows
+
+
+class lshIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.engine = SimilarityEngine(RatingsMatrix.from_rows(make_rows()))
+
+
+    def test_full_coverage_matches_exact(self):
+        """With enough tables, every user is a candidate and results are exact."""
+
+        index = LSHIndex(self.engine, 5, tables=32, bits=1)
+        exact = NeighborIndex(self.engine, 5)
+
+        for user_id in self.engine.user_ids:
+            indexes, sims = index.neighbors(user_id)
+            exact_indexes, exact_sims = exact.neighbors(user_id)
+            self.assertEqual(sorted(sims.round(12)),
+                             sorted(exact_sims.round(12)))
+
+        recall, candidates = recall_at_k(index, self.engine,
+                                         self.engine.user_ids, 5)
+        self.assertEqual(recall, 1.0)
+
+
+    def test_candidates_are_a_subset(self):
+        """Narrow buckets score fewer users than exhaustive search."""
+
+        index = LSHIndex(self.engine, 5, tables=2, bits=8)
+        i = self.engine.user_index[4]
+        candidates = index.candidates(i)
+
+        self.assertNotIn(i, candidates)
+        self.assertLess(len(candidates), len(self.engine.user_ids) - 1)
+
+
+    def test_insert_new_user(self):
+        """A new user is hashed once they have ratings, and found by others."""
+
+        index = LSHIndex(self.engine, 5, tables=32, bits=1)
+
+        self.engine.set_scores(1000, [], [])
+        self.assertEqual(index.refresh_user(1000), [1000])
+        self.assertEqual(len(index.neighbors(1000)[0]), 0)
+
+        self.engine.set_scores(1000, [1, 2, 3], [5, 1, 4])
+        affected = index.refresh_user(1000)
+        self.assertEqual(affected[0], 1000)
+        self.assertGreater(len(affected), 1)
+
+        i = self.engine.user_index[1000]
+        self.assertIn(i, index.candidates(self.engine.user_index[affected[1]]))
+        self.assertEqual(len(index.neighbors(1000)[0]), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+
+from flask import Flask
+
+import metrics
+
+
+class metricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registered = list(metrics.registry)
+
+
+    def tearDown(self):
+        metrics.registry[:] = self.registered
+
+
+    def test_histogram_text_format(self):
+        """Buckets are cumulative and end with +Inf, sum and count."""
+
+        latency = metrics.Histogram('test_seconds', "Test.", ['route'],
+                                    buckets=(0.1, 1))
+        for value in (0.05, 0.5, 5):
+            latency.labels('/a"b').observe(value)
+
+        self.assertEqual(latency.render(), [
+            '# HELP test_seconds Test.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{route="/a\\"b",le="0.1"} 1',
+            'test_seconds_bucket{route="/a\\"b",le="1"} 2',
+            'test_seconds_bucket{route="/a\\"b",le="+Inf"} 3',
+            'test_seconds_sum{route="/a\\"b"} 5.55',
+            'test_seconds_count{route="/a\\"b"} 3'])
+
+
+    def test_timed(self):
+        """A timed function records one observation per call, even if it fails."""
+
+        @metrics.timed('test_path')
+        def fails():
+            raise ValueError()
+
+        child = metrics.hot_path_seconds.labels('test_path')
+        self.assertRaises(ValueError, fails)
+        self.assertRaises(ValueError, fails)
+        self.assertEqual(child.count, 2)
+        self.assertIn('hot_path_duration_seconds_count{path="test_path"} 2',
+                      metrics.render())
+        del metrics.hot_path_seconds.children[('test_path',)]
+
+
+    def test_failed_requests_are_recorded(self):
+        """A request that raises is timed and counted as a 500."""
+
+        app = Flask(__name__)
+        app.logger.disabled = True
+        metrics.instrument(app)
+
+        @app.route('/test-fails')
+        def fails():
+            raise ValueError()
+
+        client = app.test_client()
+        self.assertEqual(client.get('/test-fails').status_code, 500)
+        self.assertEqual(client.get('/test-missing').status_code, 404)
+
+        self.assertEqual(metrics.requests_total.labels(
+            '/test-fails', 'GET', '500').value, 1)
+        self.assertEqual(metrics.request_seconds.labels(
+            '/test-fails', 'GET').count, 1)
+        self.assertEqual(metrics.requests_total.labels(
+            'unmatched', 'GET', '404').value, 1)
+
+        for route in '/test-fails', 'unmatched':
+            for metric in metrics.requests_total, metrics.request_seconds, \
+                    metrics.request_statements, metrics.request_sql_seconds:
+                for values in list(metric.children):
+                    if values[0] == route:
+                        del metric.children[values]
+
+
+if __name__ == '__main__':
+    unittest.main()
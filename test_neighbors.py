@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from neighbors import NeighborIndex
+from ratings_matrix import RatingsMatrix
+from similarity import SimilarityEngine
+from test_similarity import make_rows
+
+
+class neighborIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.engine = SimilarityEngine(RatingsMatrix.from_rows(make_rows()))
+        self.index = NeighborIndex(self.engine, 5)
+
+
+    def assertNeighborsMatchRebuild(self):
+        """Every row of the index has the same sims as a fresh build."""
+
+        fresh = NeighborIndex(self.engine, 5)
+        for user_id in self.engine.user_ids:
+            indexes, sims = self.index.neighbors(user_id)
+            fresh_indexes, fresh_sims = fresh.neighbors(user_id)
+            self.assertEqual(sorted(sims.round(12)),
+                             sorted(fresh_sims.round(12)))
+
+
+    def test_neighbors_exclude_self(self):
+        """A user is never their own neighbor."""
+
+        i = self.engine.user_index[4]
+        indexes, sims = self.index.neighbors(4)
+        self.assertEqual(len(indexes), 5)
+        self.assertNotIn(i, indexes)
+
+
+    def test_refresh_matches_rebuild(self):
+        """Incremental refreshes agree with rebuilding from scratch."""
+
+        for user_id, movie_id, score in [(3, 1, 5), (3, 2, 1), (17, 8, 2),
+                                         (40, 1, 5), (40, 2, 1)]:
+            self.engine.set_score(user_id, movie_id, score)
+            self.index.refresh_user(user_id)
+
+        self.assertNeighborsMatchRebuild()
+
+
+    def test_refresh_lone_user(self):
+        """The only user has no neighbors until a second one rates."""
+
+        engine = SimilarityEngine(RatingsMatrix.from_rows([(1, 1, 4)]))
+        index = NeighborIndex(engine, 5)
+        self.assertEqual(index.refresh_user(1), [1])
+        self.assertEqual(len(index.neighbors(1)[0]), 0)
+
+        engine.set_score(2, 1, 5)
+        index.refresh_user(2)
+        self.assertEqual(list(index.neighbors(1)[0]),
+                         [engine.user_index[2]])
+
+
+
+    def test_save_and_load(self):
+        """A saved index loads back; an unreadable file doesn't load."""
+
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'neighbors.npz')
+
+        try:
+            self.index.save(path)
+            self.assertEqual(os.listdir(directory), ['neighbors.npz'])
+
+            loaded = NeighborIndex.load(path, self.engine, 5)
+            self.assertEqual(loaded.indexes.tolist(),
+                             self.index.indexes.tolist())
+            self.assertIsNone(NeighborIndex.load(path, self.engine, 4))
+
+            with open(path, 'rb') as f:
+                saved = f.read()
+            for contents in ['', saved[:len(saved) // 2]]:
+                with open(path, 'wb') as f:
+                    f.write(contents)
+                self.assertIsNone(NeighborIndex.load(path, self.engine, 5))
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
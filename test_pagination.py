@@ -0,0 +1,72 @@
+import unittest
+
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from pagination import paginate, encode_cursor, InvalidCursor
+
+Base = declarative_base()
+
+
+class Item(Base):
+    __tablename__ = "items"
+
+    item_id = Column(Integer, primary_key=True)
+    name = Column(String(10))
+
+
+class paginateTestCase(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+
+        # Repeated names, so ties have to be broken by item_id
+        for item_id in range(1, 24):
+            self.session.add(Item(item_id=item_id, name="n%d" % (item_id % 5)))
+        self.session.commit()
+
+        self.keys = [Item.name, Item.item_id]
+        self.expected = [(item.name, item.item_id) for item in
+                         self.session.query(Item).order_by(*self.keys)]
+
+
+    def page(self, **kwargs):
+        return paginate(self.session.query(Item), self.keys, page_size=5,
+                        **kwargs)
+
+
+    def test_walk_forward_and_back(self):
+        """Following next and then prev cursors visits every row once."""
+
+        seen = []
+        page = self.page()
+        self.assertIsNone(page.prev_cursor)
+        pages = [page]
+        while page.next_cursor:
+            page = self.page(after=page.next_cursor)
+            pages.append(page)
+        for page in pages:
+            seen.extend((item.name, item.item_id) for item in page.items)
+
+        self.assertEqual(seen, self.expected)
+
+        back = self.page(before=pages[-1].prev_cursor)
+        self.assertEqual(back.items, pages[-2].items)
+
+
+    def test_bad_cursors_are_rejected(self):
+        """A cursor that isn't a list of one scalar per key is an error."""
+
+        for cursor in ['not a cursor', encode_cursor({'a': 1}),
+                       encode_cursor(["n1"]), encode_cursor(["n1", 2, 3]),
+                       encode_cursor(["n1", [2]]), encode_cursor(["n1", {}])]:
+            self.assertRaises(InvalidCursor, self.page, after=cursor)
+            self.assertRaises(InvalidCursor, self.page, before=cursor)
+
+        self.assertEqual(self.page(after='').items, self.page().items)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import profiling
+import server
+
+
+class profilingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        server.app.config['TESTING'] = True
+        server.app.config['PROFILE_DIR'] = self.directory
+        server.app.config['PROFILE_TOKEN'] = 'secret'
+        self.client = server.app.test_client()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        server.app.config['PROFILE_DIR'] = None
+        server.app.config['PROFILE_TOKEN'] = None
+        server.app.config['PROFILE_SAMPLE_RATE'] = 0
+
+
+    def profiles(self):
+        return [name for path, dirs, names in os.walk(self.directory)
+                for name in names]
+
+
+    def test_only_picked_requests_are_profiled(self):
+        """The header (with the right token) or sampling picks requests."""
+
+        self.client.get('/')
+        self.client.get('/', headers={'X-Profile': 'wrong'})
+        self.assertEqual(self.profiles(), [])
+
+        result = self.client.get('/', headers={'X-Profile': 'secret'})
+        self.assertEqual(self.profiles(), [result.headers['X-Profile']])
+
+        server.app.config['PROFILE_SAMPLE_RATE'] = 1
+        self.client.get('/')
+        self.assertEqual(len(self.profiles()), 2)
+
+        server.app.config['PROFILE_DIR'] = None
+        self.client.get('/', headers={'X-Profile': 'secret'})
+        self.assertEqual(len(self.profiles()), 2)
+
+
+    def test_header_needs_a_token(self):
+        """Without a PROFILE_TOKEN, the header profiles nothing."""
+
+        server.app.config['PROFILE_TOKEN'] = None
+        self.client.get('/', headers={'X-Profile': '1'})
+        self.client.get('/', headers={'X-Profile': ''})
+        self.assertEqual(self.profiles(), [])
+
+
+    def test_non_ascii_headers(self):
+        """Non-ASCII headers and tokens are compared as bytes, not a 500."""
+
+        result = self.client.get('/', headers={'X-Profile': '\xe9t\xe9'})
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(self.profiles(), [])
+
+        # A token from a byte-string config, then the same one as unicode
+        for token in ['s\xc3\xa9cret', u's\xe9cret']:
+            server.app.config['PROFILE_TOKEN'] = token
+            result = self.client.get('/', headers={'X-Profile':
+                                                   's\xc3\xa9cret'})
+            self.assertEqual(result.status_code, 200)
+            self.assertIn(result.headers['X-Profile'], self.profiles())
+
+        # Servers that hand over the raw header bytes
+        self.assertEqual(profiling._as_bytes('\xe9t\xe9', 'latin-1'),
+                         '\xe9t\xe9')
+        self.assertIsNone(profiling._as_bytes(u'\u20ac', 'latin-1'))
+
+
+    def test_aggregate_by_route(self):
+        """Profiles are merged per route."""
+
+        for _ in range(3):
+            self.client.get('/', headers={'X-Profile': 'secret'})
+
+        merged = profiling.aggregate(self.directory)
+        self.assertEqual(merged.keys(), ['root'])
+        count, stats = merged['root']
+        self.assertEqual(count, 3)
+        self.assertTrue(stats.total_calls > 0)
+        self.assertEqual(profiling.aggregate(self.directory, 'movies'), {})
+        self.assertEqual(profiling.route_directory('/movies/<movie_id>'),
+                         'movies_movie_id')
+
+
+if __name__ == '__main__':
+    unittest.main()
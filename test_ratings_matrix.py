@@ -0,0 +1,197 @@
+import unittest
+
+import numpy as np
+
+from ratings_matrix import RatingsMatrix
+from test_similarity import make_rows
+
+
+class ratingsMatrixTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rows = make_rows()
+        self.matrix = RatingsMatrix.from_rows(self.rows)
+
+
+    def dense(self, rows):
+        """Return {(user_id, movie_id): score} for rows."""
+
+        return dict(((u, m), s) for u, m, s in rows)
+
+
+    def assertMatchesRows(self, rows):
+        """The CSR and CSC halves both hold exactly rows."""
+
+        expected = self.dense(rows)
+        by_row = {}
+        by_col = {}
+        for i, user_id in enumerate(self.matrix.user_ids):
+            movies, scores = self.matrix.row(i)
+            for j, score in zip(movies, scores):
+                by_row[(user_id, self.matrix.movie_ids[j])] = score
+        for j, movie_id in enumerate(self.matrix.movie_ids):
+            users, scores = self.matrix.column(j)
+            for i, score in zip(users, scores):
+                by_col[(self.matrix.user_ids[i], movie_id)] = score
+
+        self.assertEqual(by_row, expected)
+        self.assertEqual(by_col, expected)
+
+
+    def test_builds_csr_and_csc(self):
+        """Rows and columns hold the same ratings as the input."""
+
+        self.assertMatchesRows(self.rows)
+        self.assertEqual(self.matrix.nnz, len(self.rows))
+
+
+    def test_set_score(self):
+        """Changed and new ratings show up in both layouts and the means."""
+
+        user_id, movie_id, score = self.rows[0]
+        self.matrix.set_score(user_id, movie_id, 6 - score)
+        self.matrix.set_score(user_id, 999, 5)
+        self.matrix.set_score(500, movie_id, 2)
+
+        rows = self.dense(self.rows)
+        rows[(user_id, movie_id)] = 6 - score
+        rows[(user_id, 999)] = 5
+        rows[(500, movie_id)] = 2
+        self.assertMatchesRows([(u, m, s) for (u, m), s in rows.items()])
+
+        i = self.matrix.user_index[user_id]
+        mine = [s for (u, m), s in rows.items() if u == user_id]
+        self.assertAlmostEqual(self.matrix.user_mean(i),
+                               float(sum(mine)) / len(mine))
+
+
+    def test_set_scores(self):
+        """A batch of one user's ratings matches rebuilding from scratch."""
+
+        mine = dict((m, s) for u, m, s in self.rows if u == 3)
+        changed = sorted(mine)[:3]
+        new_scores = dict((m, 6 - mine[m]) for m in changed)
+        new_scores.update({998: 1, 999: 4, 40: 3})
+        self.matrix.set_scores(3, list(new_scores), list(new_scores.values()))
+
+        rows = self.dense(self.rows)
+        rows.update(((3, m), s) for m, s in new_scores.items())
+        rows = [(u, m, s) for (u, m), s in rows.items()]
+        self.assertMatchesRows(rows)
+
+        rebuilt = RatingsMatrix.from_rows(rows)
+        for movie_id in rebuilt.movie_ids:
+            self.assertAlmostEqual(
+                self.matrix.movie_mean(self.matrix.movie_index[movie_id]),
+                rebuilt.movie_mean(rebuilt.movie_index[movie_id]))
+        self.assertAlmostEqual(
+            self.matrix.user_mean(self.matrix.user_index[3]),
+            rebuilt.user_mean(rebuilt.user_index[3]))
+
+
+    def test_set_scores_on_empty_matrix(self):
+        """The first ratings can be added to a matrix built from no rows."""
+
+        self.matrix = RatingsMatrix.from_rows([])
+        self.matrix.set_scores(1, [], [])
+        self.matrix.set_scores(1, [10, 20], [4, 1])
+        self.matrix.set_score(2, 10, 5)
+
+        self.assertMatchesRows([(1, 10, 4), (1, 20, 1), (2, 10, 5)])
+        self.assertEqual(self.matrix.user_mean(self.matrix.user_index[1]), 2.5)
+        self.assertEqual(self.matrix.movie_mean(self.matrix.movie_index[10]),
+                         4.5)
+
+
+    def test_set_scores_on_read_only_arrays(self):
+        """Read-only arrays stay untouched; the overlay reads like a rebuild."""
+
+        arrays = {}
+        for name in RatingsMatrix.ARRAYS:
+            arrays[name] = np.array(getattr(self.matrix, name))
+            arrays[name].flags.writeable = False
+        self.matrix = RatingsMatrix.from_arrays(self.matrix.user_ids,
+                                                self.matrix.movie_ids, arrays)
+
+        mine = dict((m, s) for u, m, s in self.rows if u == 3)
+        new_scores = dict((m, 6 - mine[m]) for m in sorted(mine)[:3])
+        new_scores.update({999: 4, 40: 3})
+        self.matrix.set_scores(3, list(new_scores), list(new_scores.values()))
+        self.matrix.set_scores(500, [], [])
+        self.matrix.set_scores(500, [1, 999], [2, 5])
+
+        rows = self.dense(self.rows)
+        rows.update(((3, m), s) for m, s in new_scores.items())
+        rows.update({(500, 1): 2, (500, 999): 5})
+        rows = [(u, m, s) for (u, m), s in rows.items()]
+        self.assertMatchesRows(rows)
+
+        for name in RatingsMatrix.ARRAYS[:6]:
+            self.assertIs(getattr(self.matrix, name), arrays[name])
+
+        rebuilt = RatingsMatrix.from_rows(rows)
+        self.assertEqual(self.matrix.user_ids, rebuilt.user_ids)
+        self.assertEqual(self.matrix.movie_ids, rebuilt.movie_ids)
+        self.assertEqual(self.matrix.nnz, rebuilt.nnz)
+        self.assertEqual(self.matrix.fingerprint(), rebuilt.fingerprint())
+
+        merged = self.matrix.arrays()
+        for name in RatingsMatrix.ARRAYS:
+            self.assertEqual(merged[name].tolist(),
+                             getattr(rebuilt, name).tolist(), name)
+
+        users = [0, len(rebuilt.user_ids) - 1, self.matrix.user_index[3], 5]
+        for got, expected in zip(self.matrix.gather_rows(users),
+                                 rebuilt.gather_rows(users)):
+            self.assertEqual(got.tolist(), expected.tolist())
+        movies = [rebuilt.movie_index[999], 0, rebuilt.movie_index[40]]
+        for got, expected in zip(self.matrix.gather_columns(movies),
+                                 rebuilt.gather_columns(movies)):
+            self.assertEqual(got.tolist(), expected.tolist())
+
+        stop = len(rebuilt.user_ids)
+        for got, expected in zip(self.matrix.dense_rows(2, stop),
+                                 rebuilt.dense_rows(2, stop)):
+            self.assertEqual(got.tolist(), expected.tolist())
+        self.assertEqual(self.matrix.user_means().tolist(),
+                         rebuilt.user_means().tolist())
+
+
+    def test_fingerprint(self):
+        """Any change moves the fingerprint; the order ids came in doesn't."""
+
+        # -2 on movie 12 and +1 on movie 24 cancel in a weighted sum
+        before = self.matrix.fingerprint()
+        scores = self.dense(self.rows)
+        self.matrix.set_scores(3, [12, 24], [scores[(3, 12)] - 2,
+                                             scores[(3, 24)] + 1])
+        self.assertNotEqual(self.matrix.fingerprint(), before)
+
+        # User 1 and movie 1 come back last, after every other id
+        rest = [(u, m, s) for u, m, s in self.rows if u != 1 and m != 1]
+        appended = RatingsMatrix.from_rows(rest)
+        mine = [(m, s) for u, m, s in self.rows if u == 1]
+        appended.set_scores(1, *zip(*mine))
+        for u, m, s in self.rows:
+            if m == 1:
+                appended.set_score(u, m, s)
+        self.assertEqual(appended.user_ids[-1], 1)
+        self.assertEqual(appended.movie_ids[-1], 1)
+        self.assertEqual(appended.fingerprint(),
+                         RatingsMatrix.from_rows(self.rows).fingerprint())
+
+
+    def test_co_rated(self):
+        """co_rated aligns two users' scores on their common movies."""
+
+        mine = dict((m, s) for u, m, s in self.rows if u == 2)
+        theirs = dict((m, s) for u, m, s in self.rows if u == 3)
+        common = sorted(set(mine) & set(theirs))
+
+        scores_2, scores_3 = self.matrix.co_rated(self.matrix.user_index[2],
+                                                  self.matrix.user_index[3])
+        self.assertEqual(list(scores_2), [mine[m] for m in common])
+        self.assertEqual(list(scores_3), [theirs[m] for m in common])
+
+
+if __name__ == '__main__':
+    unittest.main()
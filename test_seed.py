@@ -0,0 +1,138 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import model
+import seed
+import server
+from model import db, User, Movie, Rating, MovieRatingSummary
+
+# A few lines of each MovieLens release's files, laid out as the real ones
+FIXTURES = {
+    '100k': {'u.user': "1|24|M|technician|85711\n"
+                       "2|53|F|other|94043\n",
+             'u.item': "1|Toy Story (1995)|01-Jan-1995||"
+                       "http://example.com/1|0|0|1\n"
+                       "2|GoldenEye (1995)|01-Jan-1995||"
+                       "http://example.com/2|1|0|0\n",
+             'u.data': "1\t1\t5\t874965758\n"
+                       "1\t2\t3\t876893171\n"
+                       "2\t1\t4\t878542960\n"},
+    '1m': {'users.dat': "1::F::1::10::48067\n"
+                        "2::M::56::16::70072\n",
+           'movies.dat': "1::Toy Story (1995)::Animation|Children's|Comedy\n"
+                         "2::GoldenEye (1995)::Action|Adventure|Thriller\n",
+           'ratings.dat': "1::1::5::978300760\n"
+                          "1::2::3::978302109\n"
+                          "2::1::4::978301968\n"},
+    '10m': {'movies.dat': "1::Toy Story (1995)::Adventure|Animation\n"
+                          "2::GoldenEye (1995)::Action|Adventure\n",
+            'ratings.dat': "1::1::5::838985046\n"
+                           "1::2::2.5::838983525\n"
+                           "2::1::4::838983392\n"},
+    '20m': {'movies.csv': "movieId,title,genres\n"
+                          "1,Toy Story (1995),Adventure|Animation\n"
+                          "2,\"GoldenEye (1995)\",Action|Adventure\n",
+            'ratings.csv': "userId,movieId,rating,timestamp\n"
+                           "1,1,5.0,1112486027\n"
+                           "1,2,2.5,1112484676\n"
+                           "2,1,4.0,1112484819\n"},
+}
+
+
+class seedFormatsTestCase(unittest.TestCase):
+    def setUp(self):
+        """Create a scratch SQLite database and a directory for the files."""
+
+        self.db, server.app.config['DATABASE'] = tempfile.mkstemp()
+        server.connect_to_db(server.app,
+                             'sqlite:///' + server.app.config['DATABASE'])
+        server.app.config['SQLALCHEMY_ECHO'] = False
+
+        self.context = server.app.app_context()
+        self.context.push()
+        db.create_all()
+
+        self.directory = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+        model.reload_ratings()
+        os.close(self.db)
+        os.unlink(server.app.config['DATABASE'])
+        shutil.rmtree(self.directory)
+
+
+    def load(self, name):
+        """Write a release's fixture files, then seed the database from them."""
+
+        for filename, contents in FIXTURES[name].items():
+            with open(os.path.join(self.directory, filename), 'w') as f:
+                f.write(contents)
+
+        data_format = seed.find_format(self.directory)
+        self.assertEqual(data_format['name'], name)
+
+        seed.load_users(self.directory, data_format, 2)
+        seed.load_movies(self.directory, data_format, 2)
+        seed.load_ratings(self.directory, data_format, 2)
+
+
+    def assertLoaded(self):
+        """Both users, both movies and all three ratings were loaded."""
+
+        self.assertEqual([user_id for user_id, in db.session.query(
+            User.user_id).order_by(User.user_id)], [1, 2])
+        self.assertEqual(db.session.query(Movie.movie_id, Movie.title)
+                         .order_by(Movie.movie_id).all(),
+                         [(1, "Toy Story"), (2, "GoldenEye")])
+        self.assertEqual(db.session.query(Rating.user_id, Rating.movie_id,
+                                          Rating.score)
+                         .order_by(Rating.user_id, Rating.movie_id).all(),
+                         [(1, 1, 5), (1, 2, 3), (2, 1, 4)])
+        self.assertEqual(MovieRatingSummary.query.get(1).count, 2)
+
+
+    def test_100k(self):
+        """MovieLens 100k loads, with users' ages."""
+
+        self.load('100k')
+        self.assertLoaded()
+        self.assertEqual(User.query.get(2).age, 53)
+
+
+    def test_1m(self):
+        """MovieLens 1M loads, with users from users.dat."""
+
+        self.load('1m')
+        self.assertLoaded()
+        self.assertEqual(User.query.get(2).zipcode, "70072")
+
+
+    def test_10m(self):
+        """MovieLens 10M, which has no user file, gets users from ratings."""
+
+        self.load('10m')
+        self.assertLoaded()
+        self.assertIsNone(User.query.get(2).zipcode)
+
+
+    def test_20m(self):
+        """MovieLens 20M's CSV files load, users coming from ratings."""
+
+        self.load('20m')
+        self.assertLoaded()
+
+
+    def test_missing_ratings(self):
+        """A directory with no ratings file isn't any format."""
+
+        self.assertRaises(IOError, seed.find_format, self.directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,19 @@ import server
 import tempfile
 import os
 
+import cache
+import eye
+import model
+import datetime
+import json
+import metrics
+import pagination
+from model import db, User, Movie, Rating, Prediction, MovieRatingSummary
+from model import RatingChange
+from neighbors import NeighborIndex
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+
 
 class homepageTestCase(unittest.TestCase):
     def setUp(self):
@@ -84,5 +97,476 @@ class movieTestCase(unittest.TestCase):
         os.unlink(server.app.config['DATABASE'])
 
 
+class scratchDatabaseTestCase(unittest.TestCase):
+    """A browser backed by a scratch SQLite database, for tests to share."""
+
+    # Predict from every rater unless a test case sets k
+    neighbor_count = None
+
+    def setUp(self):
+        """Create a browser backed by a scratch SQLite database."""
+        self.db, server.app.config['DATABASE'] = tempfile.mkstemp()
+        server.app.config['TESTING'] = True
+        server.app.config['NEIGHBOR_COUNT'] = self.neighbor_count
+        server.app.config['NEIGHBOR_INDEX_PATH'] = server.app.config['DATABASE'] + '.neighbors.npz'
+        server.app.config['EYE_JUDGMENT_PATH'] = server.app.config['DATABASE'] + '.npz'
+        self.client = server.app.test_client()
+        server.connect_to_db(server.app, 'sqlite:///' + server.app.config['DATABASE'])
+        server.app.config['SQLALCHEMY_ECHO'] = False
+
+        self.context = server.app.app_context()
+        self.context.push()
+        db.create_all()
+        db.session.add(Movie(movie_id=1, title="Only Movie", imdb_url=""))
+        db.session.commit()
+
+        self.statements = 0
+        event.listen(db.engine, 'before_cursor_execute', self.count)
+
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self.count)
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+        model.reload_ratings()
+        eye._eye = None
+        os.close(self.db)
+        os.unlink(server.app.config['DATABASE'])
+
+
+    def count(self, *args):
+        self.statements += 1
+
+
+    def add_raters(self, first_user_id, how_many):
+        """Add users who each rate the movie and a movie of their own."""
+
+        for user_id in range(first_user_id, first_user_id + how_many):
+            db.session.add(User(user_id=user_id, email="u%d" % user_id))
+            db.session.add(Movie(movie_id=user_id + 1, title="Movie %d" % user_id,
+                                 imdb_url=""))
+            db.session.add(Rating(user_id=user_id, movie_id=1, score=3))
+            db.session.add(Rating(user_id=user_id, movie_id=user_id + 1, score=4))
+        db.session.commit()
+        model.reload_ratings()
+
+
+    def log_in(self, user_id):
+        """Log the browser in as user_id."""
+
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = user_id
+            sess['email'] = 'u%d' % user_id
+
+
+    def statements_for(self, url):
+        """Return how many SQL statements a warm GET of url runs."""
+
+        self.client.get(url)
+        self.statements = 0
+        self.client.get(url)
+        return self.statements
+
+
+class queryCountTestCase(scratchDatabaseTestCase):
+    def test_query_counts_do_not_grow(self):
+        """Profile and movie pages run a fixed number of queries."""
+
+        self.add_raters(1, 3)
+        self.log_in(1)
+
+        profile = self.statements_for('/users/1')
+        details = self.statements_for('/movies/1')
+
+        self.add_raters(10, 30)
+        db.session.add_all([Rating(user_id=1, movie_id=movie_id, score=2)
+                            for movie_id in range(11, 40)])
+        db.session.commit()
+
+        self.assertEqual(self.statements_for('/users/1'), profile)
+        self.assertEqual(self.statements_for('/movies/1'), details)
+
+
+class storedPredictionTestCase(scratchDatabaseTestCase):
+    def test_stored_prediction_until_rating_changes(self):
+        """Stored predictions are served until the user rates something."""
+
+        self.add_raters(1, 3)
+        db.session.add(Prediction(user_id=1, movie_id=3, predicted_score=1.0,
+                                  computed_at=datetime.datetime.now()))
+        db.session.commit()
+
+        with server.app.test_request_context():
+            server.session['user_id'] = 1
+            movie = Movie.query.get(3)
+            self.assertEqual(server.get_prediction_of_user_rating(movie), 1.0)
+
+            server.update_rating_in_db(1, 5)
+            self.assertEqual(Prediction.query.count(), 0)
+            self.assertNotEqual(server.get_prediction_of_user_rating(movie),
+                                1.0)
+
+
+class bulkRatingsTestCase(scratchDatabaseTestCase):
+    def test_bulk_ratings(self):
+        """A batch is saved whole, or not at all if any row is bad."""
+
+        self.add_raters(1, 3)
+        model.rebuild_movie_rating_summaries()
+        self.assertEqual(self.client.post('/ratings/bulk').status_code, 401)
+
+        self.log_in(1)
+
+        rv = self.client.post('/ratings/bulk', content_type='application/json',
+                              data=json.dumps({'ratings': [
+                                  {'movie_id': 1, 'score': 5},
+                                  {'movie_id': 3, 'score': 2}]}))
+        self.assertEqual(json.loads(rv.data), {'saved': 2, 'changed': 2})
+
+        rv = self.client.post('/ratings/bulk', content_type='text/csv',
+                              data="movie_id,score\n4,1\n999,3\n4,9\n")
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(len(json.loads(rv.data)['errors']), 2)
+
+        rv = self.client.post('/ratings/bulk', content_type='application/json',
+                              data=json.dumps([
+                                  {'movie_id': 4, 'score': 4.9},
+                                  {'movie_id': 4, 'score': "4.5"},
+                                  {'movie_id': 4, 'score': 4.5},
+                                  {'movie_id': 4, 'score': True},
+                                  {'movie_id': 4.0, 'score': "2"}]))
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(json.loads(rv.data)['errors'],
+                         [{'row': row, 'error': "not a whole number"}
+                          for row in range(1, 5)])
+
+        rv = self.client.post('/ratings/bulk', content_type='text/csv',
+                              data="4,2.5\n")
+        self.assertEqual(json.loads(rv.data)['errors'],
+                         [{'row': 1, 'error': "not a whole number"}])
+
+        rv = self.client.post('/ratings/bulk', content_type='text/csv',
+                              data="4,1\n")
+        self.assertEqual(rv.status_code, 200)
+
+        scores = dict((r.movie_id, r.score)
+                      for r in Rating.query.filter_by(user_id=1))
+        self.assertEqual(scores, {1: 5, 2: 4, 3: 2, 4: 1})
+
+        matrix = model.get_ratings_matrix()
+        self.assertEqual(matrix.movie_mean(matrix.movie_index[1]),
+                         (5 + 3 + 3) / 3.0)
+
+        summaries = [(m.movie_id, m.histogram())
+                     for m in MovieRatingSummary.query.order_by('movie_id')]
+        model.rebuild_movie_rating_summaries()
+        self.assertEqual(summaries,
+                         [(m.movie_id, m.histogram()) for m in
+                          MovieRatingSummary.query.order_by('movie_id')])
+
+
+    def test_single_rating_is_validated(self):
+        """/update_rating takes only whole scores from 1 to 5, like bulk."""
+
+        self.add_raters(1, 3)
+        self.log_in(1)
+
+        for score in [300, 0, 4.5, "4.5", "abc", ""]:
+            rv = self.client.post('/update_rating',
+                                  data={'rating': score, 'movieId': 2})
+            self.assertEqual(rv.status_code, 400, score)
+        self.assertEqual(Rating.query.filter_by(user_id=1, movie_id=2)
+                         .one().score, 4)
+
+        rv = self.client.post('/update_rating',
+                              data={'rating': "5", 'movieId': 2})
+        self.assertEqual(rv.status_code, 302)
+        self.assertEqual(Rating.query.filter_by(user_id=1, movie_id=2)
+                         .one().score, 5)
+
+
+class ratingPairsTestCase(scratchDatabaseTestCase):
+    def test_rating_pairs_are_unique(self):
+        """A user can't end up with two ratings for one movie."""
+
+        self.add_raters(1, 1)
+        db.session.add(Rating(user_id=1, movie_id=1, score=5))
+        self.assertRaises(IntegrityError, db.session.commit)
+        db.session.rollback()
+
+
+class apiTestCase(scratchDatabaseTestCase):
+    def test_api_conditional_get(self):
+        """A current ETag gets a 304 after one query; a rating changes it."""
+
+        self.add_raters(1, 3)
+        model.rebuild_movie_rating_summaries()
+
+        rv = self.client.get('/api/movies/1')
+        etag = rv.headers['ETag']
+        self.assertEqual(json.loads(rv.data)['count'], 3)
+        self.assertIn('max-age', rv.headers['Cache-Control'])
+
+        self.statements = 0
+        rv = self.client.get('/api/movies/1', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(self.statements, 1)
+
+        self.log_in(1)
+        self.client.post('/update_rating', data={'rating': 1, 'movieId': 1})
+
+        rv = self.client.get('/api/movies/1', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotEqual(rv.headers['ETag'], etag)
+        self.assertEqual(json.loads(rv.data)['histogram']['1'], 1)
+
+        self.assertEqual(self.client.get('/api/users/999').status_code, 404)
+        prediction = json.loads(self.client.get('/api/users/2/predictions/2').data)
+        self.assertEqual(prediction['movie_id'], 2)
+
+
+    def test_etags_follow_the_database(self):
+        """ETags agree across processes and see writes made elsewhere."""
+
+        self.add_raters(1, 3)
+        urls = ['/api/users/1', '/api/movies/1/ratings',
+                '/api/users/1/predictions/3']
+        etags = [self.client.get(url).headers['ETag'] for url in urls]
+
+        # Another process starts with its own in-memory versions
+        cache.reset()
+        self.assertEqual([self.client.get(url).headers['ETag']
+                          for url in urls], etags)
+
+        # Another worker's write, which this process never saw
+        db.session.query(Rating).filter_by(user_id=1, movie_id=1).update(
+            {'score': 5})
+        model.log_rating_changes(1, [(1, 3, 5)])
+        db.session.commit()
+
+        for url, etag in zip(urls, etags):
+            rv = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(rv.status_code, 200, url)
+
+        # The predictions job stores a prediction
+        etag = self.client.get(urls[2]).headers['ETag']
+        db.session.add(Prediction(user_id=1, movie_id=3, predicted_score=2.5,
+                                  computed_at=datetime.datetime.now()))
+        db.session.commit()
+
+        rv = self.client.get(urls[2], headers={'If-None-Match': etag})
+        self.assertEqual(json.loads(rv.data)['prediction'], 2.5)
+
+
+    def test_bad_page_cursor(self):
+        """A page cursor that won't decode to the sort keys is a 400."""
+
+        self.add_raters(1, 3)
+        bad = pagination.encode_cursor(["Movie 1", 2, 3])
+
+        rv = self.client.get('/api/movies/1/ratings?after=junk')
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(json.loads(rv.data)['error'], "Bad page cursor.")
+        self.assertEqual(self.client.get('/movies?before=' + bad).status_code,
+                         400)
+        self.assertEqual(self.client.get('/users?after=' + bad).status_code,
+                         400)
+
+
+class metricsTestCase(scratchDatabaseTestCase):
+    def test_metrics_endpoint(self):
+        """Requests are timed by route, with the SQL statements they ran."""
+
+        self.add_raters(1, 3)
+        route = '/movies/<movie_id>'
+        before = metrics.request_statements.labels(route).sum
+
+        self.statements = 0
+        self.client.get('/movies/1')
+        self.assertEqual(metrics.request_statements.labels(route).sum - before,
+                         self.statements)
+
+        result = self.client.get('/metrics')
+        self.assertEqual(result.status_code, 200)
+        self.assertTrue(result.content_type.startswith('text/plain'))
+        self.assertIn('http_request_duration_seconds_count{route="%s",'
+                      'method="GET"}' % route, result.data)
+        self.assertIn('http_requests_total{route="%s",method="GET",'
+                      'status="200"}' % route, result.data)
+        self.assertIn('hot_path_duration_seconds_count{path="predict_many"}',
+                      result.data)
+
+
+class emptyDatabaseTestCase(scratchDatabaseTestCase):
+    def test_first_user_rates_first_movie(self):
+        """With no ratings yet, a new user can sign up and rate."""
+
+        rv = self.client.post('/process_registration',
+                              data={'username': 'first', 'password': 'pass'},
+                              follow_redirects=True)
+        self.assertIn('Account created.', rv.data)
+
+        user = User.query.filter_by(email='first').one()
+        self.assertEqual(server.save_ratings(user.user_id, {1: 4}), 1)
+
+        matrix = model.get_ratings_matrix()
+        self.assertEqual(matrix.movie_mean(matrix.movie_index[1]), 4.0)
+
+
+class neighborsTestCase(scratchDatabaseTestCase):
+    neighbor_count = 2
+
+    def test_first_users_sign_up_and_rate(self):
+        """The first user has no neighbors, and gains one with the second."""
+
+        for email, score in [('first', 4), ('second', 5)]:
+            self.client.post('/process_registration',
+                             data={'username': email, 'password': 'pass'})
+            user = User.query.filter_by(email=email).one()
+            self.assertEqual(server.save_ratings(user.user_id, {1: score}), 1)
+
+        first = User.query.filter_by(email='first').one()
+        indexes, sims = model.get_neighbor_index().neighbors(first.user_id)
+        self.assertEqual(len(indexes), 1)
+
+
+    def test_rating_updates_neighbors(self):
+        """Neighbors follow rating changes, and pages predict from them."""
+
+        self.add_raters(1, 4)
+        self.log_in(1)
+        self.client.post('/update_rating', data={'rating': 1, 'movieId': 3})
+
+        index = model.get_neighbor_index()
+        engine = model.get_similarity_engine()
+        fresh = NeighborIndex(engine, self.neighbor_count)
+        for user_id in engine.user_ids:
+            self.assertEqual(sorted(index.neighbors(user_id)[1].round(12)),
+                             sorted(fresh.neighbors(user_id)[1].round(12)))
+
+        self.assertEqual(self.client.get('/movies/1').status_code, 200)
+        self.assertEqual(self.client.get('/users/1').status_code, 200)
+
+
+class eyeTestCase(scratchDatabaseTestCase):
+    def test_unreadable_judgments_are_recomputed(self):
+        """An empty or half-written judgments file is a cache miss."""
+
+        self.add_raters(1, 3)
+        path = server.app.config['EYE_JUDGMENT_PATH']
+        the_eye = eye.EyeOfJudgment(1, path)
+        self.assertEqual(the_eye.judgment(2), 4)
+
+        with open(path, 'rb') as f:
+            saved = f.read()
+
+        for contents in ['', saved[:len(saved) // 2]]:
+            with open(path, 'wb') as f:
+                f.write(contents)
+
+            reader = eye.EyeOfJudgment(1, path)
+            self.assertEqual(reader.judgment(2), 4)
+            with open(path, 'rb') as f:
+                self.assertEqual(len(f.read()), len(saved))
+
+        os.remove(path)
+
+
+# A scratch PostgreSQL database, which is dropped and recreated, e.g.
+# TEST_POSTGRES_URI=postgresql:///ratings_test
+TEST_POSTGRES_URI = os.environ.get('TEST_POSTGRES_URI')
+
+
+@unittest.skipUnless(TEST_POSTGRES_URI, "TEST_POSTGRES_URI isn't set")
+class postgresUpsertTestCase(unittest.TestCase):
+    def setUp(self):
+        """Connect to the scratch PostgreSQL database with one rating."""
+        server.app.config['TESTING'] = True
+        server.app.config['NEIGHBOR_COUNT'] = None
+        server.connect_to_db(server.app, TEST_POSTGRES_URI)
+        server.app.config['SQLALCHEMY_ECHO'] = False
+
+        self.context = server.app.app_context()
+        self.context.push()
+        db.drop_all()
+        db.create_all()
+        db.session.add(User(user_id=1, email="u1"))
+        db.session.add_all([Movie(movie_id=movie_id, title="Movie %d" % movie_id,
+                                  imdb_url="") for movie_id in range(1, 5)])
+        db.session.add(Rating(user_id=1, movie_id=1, score=3))
+        db.session.commit()
+
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+        model.reload_ratings()
+
+
+    def scores(self):
+        return dict((r.movie_id, r.score)
+                    for r in Rating.query.filter_by(user_id=1))
+
+
+    def test_upsert_reports_changes_with_old_scores(self):
+        """New and changed scores come back with what they replaced."""
+
+        self.assertTrue(model.is_postgres())
+
+        changes = model.upsert_ratings(1, {1: 5, 2: 4})
+        db.session.commit()
+        self.assertEqual(sorted(changes), [(1, 3, 5), (2, None, 4)])
+        self.assertEqual(self.scores(), {1: 5, 2: 4})
+
+
+    def test_upsert_leaves_out_unchanged_scores(self):
+        """Rewriting a score with the same value isn't a change."""
+
+        changes = model.upsert_ratings(1, {1: 3, 3: 2})
+        db.session.commit()
+        self.assertEqual(changes, [(3, None, 2)])
+
+        self.assertEqual(model.upsert_ratings(1, {1: 3, 3: 2}), [])
+        db.session.commit()
+        self.assertEqual(self.scores(), {1: 3, 3: 2})
+        self.assertEqual(Rating.query.count(), 2)
+
+
+    def test_upsert_matches_the_portable_path(self):
+        """PostgreSQL and the read-then-write path agree on a batch."""
+
+        batch = {1: 1, 2: 5, 4: 2}
+        changes = sorted(model.upsert_ratings(1, batch))
+        db.session.rollback()
+
+        is_postgres = model.is_postgres
+        model.is_postgres = lambda: False
+        try:
+            portable = sorted(model.upsert_ratings(1, batch))
+        finally:
+            model.is_postgres = is_postgres
+        db.session.rollback()
+
+        self.assertEqual(changes, portable)
+
+
+    def test_save_ratings_logs_and_summarizes(self):
+        """The whole write path runs on PostgreSQL, logging only changes."""
+
+        model.rebuild_movie_rating_summaries()
+
+        self.assertEqual(server.save_ratings(1, {1: 3, 2: 5}), 1)
+        self.assertEqual(server.save_ratings(1, {1: 4, 2: 5}), 1)
+
+        self.assertEqual([(c.movie_id, c.old_score, c.new_score) for c in
+                          RatingChange.query.order_by(RatingChange.change_id)],
+                         [(2, None, 5), (1, 3, 4)])
+        self.assertEqual(MovieRatingSummary.query.get(1).histogram(),
+                         [(1, 0), (2, 0), (3, 0), (4, 1), (5, 0)])
+        self.assertEqual(model.get_ratings_matrix().nnz, 2)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+import random
+
+import correlation
+from ratings_matrix import RatingsMatrix
+from similarity import SimilarityEngine
+
+
+def make_rows(num_users=30, num_movies=40, seed=1):
+    """Generate random (user_id, movie_id, score) rows."""
+
+    rand = random.Random(seed)
+    rows = []
+    for user_id in range(1, num_users + 1):
+        for movie_id in range(1, num_movies + 1):
+            if rand.random() < 0.3:
+                rows.append((user_id, movie_id, rand.randint(1, 5)))
+    return rows
+
+
+def slow_similarity(rows, user_id, other_user_id):
+    """Pairwise Pearson the way User.similarity used to compute it."""
+
+    mine = dict((m, s) for u, m, s in rows if u == user_id)
+    theirs = dict((m, s) for u, m, s in rows if u == other_user_id)
+    pairs = [(score, theirs[movie_id]) for movie_id, score in mine.items()
+             if movie_id in theirs]
+
+    if pairs:
+        return correlation.pearson(pairs)
+    else:
+        return 0
+
+
+class similarityEngineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rows = make_rows()
+        self.engine = SimilarityEngine(RatingsMatrix.from_rows(self.rows))
+
+
+    def test_matches_pairwise_pearson(self):
+        """One-against-all similarities equal correlation.pearson."""
+
+        for user_id in (1, 7, 22):
+            sims = self.engine.similarities(user_id)
+            for i, other_user_id in enumerate(self.engine.user_ids):
+                expected = slow_similarity(self.rows, user_id, other_user_id)
+                self.assertAlmostEqual(sims[i], expected, places=12)
+
+
+    def test_all_pairs_matches_one_against_all(self):
+        """The all-pairs matrix agrees with each user's row."""
+
+        matrix = self.engine.all_similarities()
+        for user_id in (3, 15):
+            i = self.engine.user_index[user_id]
+            sims = self.engine.similarities(user_id)
+            for j in range(len(sims)):
+                self.assertAlmostEqual(matrix[i, j], sims[j], places=12)
+
+
+    def test_set_score_adds_users_and_movies(self):
+        """New ratings are reflected in later similarity queries."""
+
+        self.engine.set_score(99, 1000, 4)
+        self.engine.set_score(99, 1, 2)
+        rows = self.rows + [(99, 1000, 4), (99, 1, 2)]
+
+        self.assertAlmostEqual(self.engine.similarity(99, 5),
+                               slow_similarity(rows, 99, 5), places=12)
+        raters, scores = self.engine.movie_raters(1000)
+        self.assertEqual(list(scores), [4])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,228 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import cache
+import model
+import server
+import snapshot
+from model import db, Rating
+from neighbors import NeighborIndex
+from ratings_matrix import RatingsMatrix
+from similarity import SimilarityEngine
+from test_similarity import make_rows
+
+
+def rating_arrays_mapped(matrix):
+    """Return whether a matrix's rating arrays are views of a mapped file."""
+
+    for name in RatingsMatrix.ARRAYS[:6]:
+        array = getattr(matrix, name)
+        while array is not None and not isinstance(array, np.memmap):
+            array = array.base
+        if array is None:
+            return False
+
+    return True
+
+
+class snapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.matrix = RatingsMatrix.from_rows(make_rows())
+        self.index = NeighborIndex(SimilarityEngine(self.matrix), 5)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        model._snapshot_dir = None
+        model._snapshot = None
+        model.reload_ratings()
+
+
+    def test_round_trip(self):
+        """A mapped snapshot holds the same ratings and neighbors."""
+
+        path = os.path.join(self.directory, 'test.snap')
+        snapshot.write_snapshot(path, self.matrix, self.index)
+
+        mapped = snapshot.Snapshot(path)
+        matrix = mapped.ratings_matrix()
+        self.assertEqual(matrix.user_ids, self.matrix.user_ids)
+        self.assertEqual(matrix.fingerprint(), self.matrix.fingerprint())
+        for name in RatingsMatrix.ARRAYS:
+            np.testing.assert_array_equal(getattr(matrix, name),
+                                          getattr(self.matrix, name))
+            self.assertFalse(getattr(matrix, name).flags.writeable)
+
+        index = mapped.neighbor_index(SimilarityEngine(matrix), 5)
+        np.testing.assert_array_equal(index.sims, self.index.sims)
+        self.assertEqual(mapped.neighbor_index(SimilarityEngine(matrix), 6),
+                         None)
+
+
+    def test_writes_leave_arrays_mapped(self):
+        """Changing a mapped matrix leaves the file and the mapping alone."""
+
+        path = os.path.join(self.directory, 'test.snap')
+        snapshot.write_snapshot(path, self.matrix, self.index)
+
+        matrix = snapshot.Snapshot(path).ratings_matrix()
+        user_id, movie_id, score = make_rows()[0]
+        matrix.set_score(user_id, movie_id, 6 - score)
+        matrix.set_score(user_id, 999, 5)
+
+        self.assertEqual(snapshot.Snapshot(path).ratings_matrix().fingerprint(),
+                         self.matrix.fingerprint())
+        self.assertNotEqual(matrix.fingerprint(), self.matrix.fingerprint())
+        self.assertTrue(rating_arrays_mapped(matrix))
+
+        # The next snapshot absorbs the changes
+        path = os.path.join(self.directory, 'next.snap')
+        snapshot.write_snapshot(path, matrix)
+        self.assertEqual(snapshot.Snapshot(path).ratings_matrix().fingerprint(),
+                         matrix.fingerprint())
+
+
+class snapshotSwapTestCase(unittest.TestCase):
+    def setUp(self):
+        """Serve a few users' ratings from a scratch database and snapshots."""
+        self.directory = tempfile.mkdtemp()
+        self.db, server.app.config['DATABASE'] = tempfile.mkstemp()
+        server.app.config['TESTING'] = True
+        server.app.config['NEIGHBOR_COUNT'] = 2
+        server.app.config['NEIGHBOR_INDEX_PATH'] = server.app.config['DATABASE'] + '.neighbors.npz'
+        server.app.config['SNAPSHOT_DIR'] = self.directory
+        server.app.config['SNAPSHOT_CHECK_INTERVAL'] = 0
+        server.app.config['RATINGS_CATCH_UP_INTERVAL'] = 0
+        server.connect_to_db(server.app, 'sqlite:///' + server.app.config['DATABASE'])
+        server.app.config['SQLALCHEMY_ECHO'] = False
+
+        self.context = server.app.app_context()
+        self.context.push()
+        db.create_all()
+
+        for user_id in range(1, 6):
+            for movie_id in range(1, 5):
+                db.session.add(Rating(user_id=user_id, movie_id=movie_id,
+                                      score=(user_id * movie_id) % 5 + 1))
+        db.session.commit()
+        model.reload_ratings()
+
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+        for name, value in [('SNAPSHOT_DIR', None),
+                            ('SNAPSHOT_CHECK_INTERVAL', 5),
+                            ('RATINGS_CATCH_UP_INTERVAL', 5)]:
+            server.app.config[name] = value
+        server.connect_to_db(server.app, server.app.config['SQLALCHEMY_DATABASE_URI'])
+        model._snapshot = None
+        model.reload_ratings()
+        shutil.rmtree(self.directory)
+        os.close(self.db)
+        os.unlink(server.app.config['DATABASE'])
+
+
+    def database_state(self):
+        """Return (matrix, neighbor index, cursor) of the database, as of now."""
+
+        cursor = model.ChangeCursor.at(model.latest_change_id())
+        rows = db.session.query(Rating.user_id, Rating.movie_id, Rating.score)
+        matrix = RatingsMatrix.from_rows(rows)
+
+        return matrix, NeighborIndex(SimilarityEngine(matrix), 2), cursor
+
+
+    def publish(self, state, **kwargs):
+        """Publish a snapshot of a database_state."""
+
+        matrix, index, cursor = state
+        return snapshot.publish(self.directory, matrix, index,
+                                change_id=cursor.change_id, gaps=cursor.gaps,
+                                **kwargs)
+
+
+    def assertMatchesDatabase(self):
+        """The in-memory ratings and neighbors are what a rebuild gives."""
+
+        rows = db.session.query(Rating.user_id, Rating.movie_id, Rating.score)
+        rebuilt = RatingsMatrix.from_rows(rows)
+        self.assertEqual(model.get_ratings_matrix().fingerprint(),
+                         rebuilt.fingerprint())
+
+        engine = model.get_similarity_engine()
+        index = model.get_neighbor_index()
+        fresh = NeighborIndex(engine, 2)
+        for user_id in engine.user_ids:
+            self.assertEqual(sorted(index.neighbors(user_id)[1].round(12)),
+                             sorted(fresh.neighbors(user_id)[1].round(12)))
+
+
+    def test_swap_in_new_snapshot(self):
+        """Workers pick up a newly published snapshot."""
+
+        self.publish(self.database_state())
+        self.assertMatchesDatabase()
+
+        total = cache.ratings_versions.total
+        server.save_ratings(1, {1: 5, 9: 4})
+        self.publish(self.database_state(), keep=1)
+        model.check_snapshot()
+
+        self.assertMatchesDatabase()
+        self.assertNotEqual(cache.ratings_versions.total, total)
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+
+    def test_swap_replays_changes_since_the_snapshot(self):
+        """Ratings written after a snapshot was built survive the swap."""
+
+        self.publish(self.database_state())
+        model.get_ratings_matrix()
+
+        # Built before these writes, published after them
+        before = self.database_state()
+        server.save_ratings(2, {1: 5, 9: 1})
+        server.save_ratings(6, {2: 3})
+        self.publish(before)
+
+        model.check_snapshot()
+        self.assertMatchesDatabase()
+
+
+    def test_other_workers_writes_are_caught_up(self):
+        """Ratings another process logged are applied before the next request."""
+
+        self.publish(self.database_state())
+        self.assertMatchesDatabase()
+
+        # Another worker's write, which this process never saw
+        db.session.query(Rating).filter_by(user_id=3, movie_id=2).update(
+            {'score': 1})
+        model.log_rating_changes(3, [(2, 2, 1)])
+        db.session.commit()
+
+        self.assertEqual(model.catch_up_ratings(), [3])
+        self.assertEqual(model.catch_up_ratings(), [])
+        self.assertMatchesDatabase()
+
+
+    def test_writes_leave_the_snapshot_mapped(self):
+        """A worker's writes don't copy the mapped ratings into its memory."""
+
+        self.publish(self.database_state())
+        server.save_ratings(2, {1: 5, 9: 1})
+        server.save_ratings(7, {2: 3})
+
+        self.assertMatchesDatabase()
+        self.assertTrue(rating_arrays_mapped(model.get_ratings_matrix()))
+
+
+if __name__ == '__main__':
+    unittest.main()